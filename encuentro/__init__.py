@@ -16,7 +16,13 @@
 
 """The package."""
 
-import sys
+import importlib.util
+
+try:
+    import importlib.metadata as importlib_metadata
+except ImportError:
+    # Python before 3.8
+    importlib_metadata = None
 
 IMPORT_MSG = """
 ERROR! Problema al importar %(module)r
@@ -26,43 +32,47 @@ el paquete %(package)r versión %(version)s o superior.
 """
 
 
-class NiceImporter:
-    """Show nicely successful and errored imports."""
-    def __init__(self, module, package, version):
-        self.module = module
-        self.package = package
-        self.version = version
+def check_dependency(module, package, distribution, version):
+    """Show nicely if the module is available and its version, or the error.
+
+    The module is only found, not imported (which is slow for some of them and will be
+    done anyway when really used); the version comes from the distribution's metadata.
+    """
+    try:
+        found = importlib.util.find_spec(module) is not None
+    except ImportError:
+        found = False
+    if not found:
+        print(IMPORT_MSG % dict(module=module, package=package, version=version))
+        return
 
-    def __enter__(self):
-        pass
+    found_version = _distribution_version(distribution)
+    if found_version is None:
+        found_version = "<desconocida>"
+    print("Módulo %r encontrado ok, versión %r" % (module, found_version))
 
-    def _get_version(self):
-        """Get the version of a module."""
-        mod = sys.modules[self.module]
-        for attr in ('version', '__version__', 'ver', 'PYQT_VERSION_STR'):
-            v = getattr(mod, attr, None)
-            if v is not None:
-                return v
-        return "<desconocida>"
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None:
-            version = self._get_version()
-            print("Módulo %r importado ok, versión %r" % (self.module, version))
-        else:
-            print(IMPORT_MSG % dict(module=self.module, package=self.package,
-                                    version=self.version))
+def _distribution_version(distribution):
+    """Return the version of the installed distribution, None if can't be found."""
+    if importlib_metadata is not None:
+        try:
+            return importlib_metadata.version(distribution)
+        except importlib_metadata.PackageNotFoundError:
+            return None
 
-        # consume the exception!
-        return True
+    # old Python, use the (slower) setuptools' resources, if available
+    try:
+        import pkg_resources
+    except ImportError:
+        return None
+    try:
+        return pkg_resources.get_distribution(distribution).version
+    except pkg_resources.DistributionNotFound:
+        return None
 
 
 # test the packages
-with NiceImporter('xdg', 'python-xdg', '0.15'):
-    import xdg  # NOQA
-with NiceImporter('requests', 'python-requests', '2.2.1'):
-    import requests  # NOQA
-with NiceImporter('PyQt5.QtCore', 'PyQt5', '5.7'):
-    import PyQt5.QtCore  # NOQA
-with NiceImporter('defer', 'python-defer', '1.0.6'):
-    import defer  # NOQA
+check_dependency('xdg', 'python-xdg', 'pyxdg', '0.15')
+check_dependency('requests', 'python-requests', 'requests', '2.2.1')
+check_dependency('PyQt5.QtCore', 'PyQt5', 'PyQt5', '5.7')
+check_dependency('defer', 'python-defer', 'defer', '1.0.6')
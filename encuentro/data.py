@@ -16,19 +16,32 @@
 
 """Classes to interface to and persist the episodes data."""
 
+import hashlib
 import html
 import logging
 import os
 import pickle
 
 from base64 import b64decode
+from datetime import datetime, timedelta
 from unicodedata import normalize
 
-from encuentro import utils
+from encuentro import profiling, utils
 from encuentro.ui import dialogs
 
 logger = logging.getLogger('encuentro.data')
 
+# the episode fields that come from the backends metadata
+METADATA_FIELDS = (
+    'channel', 'section', 'title', 'duration', 'description', 'episode_id', 'url',
+    'image_url', 'downtype', 'season', 'image_data', 'subtitle')
+
+# how many episodes are merged before letting the GUI work
+MERGE_BATCH_SIZE = 1000
+
+# how long the removed episodes are remembered
+TOMBSTONES_TTL = timedelta(days=30)
+
 
 class Status:
     """Status constants."""
@@ -46,6 +59,12 @@ def prepare_to_filter(text):
     return normalize('NFKD', text).encode('ASCII', 'ignore').decode("ASCII").lower()
 
 
+def _metadata_hash(values):
+    """Return a hash of the episode metadata, to know if it changed."""
+    content = repr(tuple(values[name] for name in METADATA_FIELDS))
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+
 class EpisodeData:
     """Episode data."""
 
@@ -54,6 +73,9 @@ class EpisodeData:
     downtype = None
     image_data = None
     subtitle = None
+    checksum = None
+    metadata_hash = None
+    backend = None
 
     def __init__(self, channel, section, title, duration, description,
                  episode_id, url, image_url, state=None, progress=None,
@@ -101,6 +123,14 @@ class EpisodeData:
             self._normalized_title = prepare_to_filter(self.composed_title)
         return self._normalized_title
 
+    @property
+    def has_image_url(self):
+        """If the episode has an URL for its image.
+
+        The URL is always stored as a string, so a missing one may be "None".
+        """
+        return self.image_url not in (None, '', 'None')
+
     def update(self, channel, section, title, duration, description,
                episode_id, url, image_url, state=None, progress=None,
                filename=None, downtype=None, season=None,
@@ -136,6 +166,24 @@ class EpisodeData:
         # cache the processed title, overwritting what may be old from the past
         self._normalized_title = prepare_to_filter(self.composed_title)
 
+    def update_fields(self, **fields):
+        """Update only some of the episode metadata (with the same processing than above)."""
+        for name, value in fields.items():
+            if name in ('season', 'title') and value is not None:
+                value = html.escape(value)
+            elif name in ('url', 'image_url'):
+                value = str(value)
+            elif name == 'image_data' and value is not None:
+                value = b64decode(value)
+            setattr(self, name, value)
+
+        if 'season' in fields or 'title' in fields:
+            if self.season:
+                self.composed_title = "{}: {}".format(self.season, self.title)
+            else:
+                self.composed_title = self.title
+            self._normalized_title = prepare_to_filter(self.composed_title)
+
     def filter_params(self, text, only_downloaded):
         """Return the filtering params.
 
@@ -166,7 +214,7 @@ class ProgramsData:
     """Holder / interface for programs data."""
 
     # more recent version of the in-disk data
-    last_programs_version = 2
+    last_programs_version = 3
 
     def __init__(self, main_window, filename):
         self.main_window = main_window
@@ -176,29 +224,110 @@ class ProgramsData:
 
         self.version = None
         self.data = None
+        self.tombstones = {}
         self.reset_config_from_migration = False
-        self.load()
-        self.migrate()
+        self.forget_backends_state = False
+        with profiling.startup_phase('data_load') as counts:
+            self.load()
+            counts['items'] = len(self.data)
+        with profiling.startup_phase('data_migrate'):
+            self.migrate()
         logger.info("Episodes metadata loaded (total %d)", len(self.data))
 
-    def merge(self, new_data, episodes_widget):
-        """Merge new data to current programs data."""
-        for d in new_data:
-            names = ['channel', 'section', 'title', 'duration',
-                     'description', 'episode_id', 'url', 'image_url',
-                     'downtype', 'season', 'image_data', 'subtitle']
-            values = dict((name, d.get(name)) for name in names)
-            episode_id = d['episode_id']
+    def merge_steps(self, new_data, changes=None, batch_size=MERGE_BATCH_SIZE):
+        """Merge new data to current programs data, little by little.
 
-            try:
-                ed = self.data[episode_id]
-            except KeyError:
-                self.data[episode_id] = EpisodeData(**values)
-            else:
-                ed.update(**values)
+        The new data is complete episodes (with the backend they come from); the changes
+        (if any) are only some fields of episodes that should already be here. Episodes are
+        not touched if they have the same metadata than before.
 
-        episodes_widget.reload_episodes()
-        self.save()
+        After each batch yield how many items were processed and how many of those really
+        changed something.
+        """
+        processed = changed = 0
+        for pos in range(0, len(new_data), batch_size):
+            for d in new_data[pos:pos + batch_size]:
+                values = dict((name, d.get(name)) for name in METADATA_FIELDS)
+                values_hash = _metadata_hash(values)
+                episode_id = d['episode_id']
+
+                try:
+                    ed = self.data[episode_id]
+                except KeyError:
+                    ed = self.data[episode_id] = EpisodeData(**values)
+                    ed.backend = d.get('backend')
+                    self.tombstones.pop(episode_id, None)
+                else:
+                    ed.backend = d.get('backend')
+                    if ed.metadata_hash == values_hash:
+                        continue
+                    # keep what is known about the episode download
+                    ed.update(state=ed.state, progress=ed.progress, filename=ed.filename,
+                              **values)
+                ed.metadata_hash = values_hash
+                changed += 1
+            processed = min(pos + batch_size, len(new_data))
+            yield processed, changed
+
+        if changes:
+            for episode_id, fields in changes.items():
+                ed = self.data.get(episode_id)
+                if ed is None:
+                    if episode_id not in self.tombstones:
+                        logger.warning("Got changes for unknown episode %r", episode_id)
+                    continue
+                ed.update_fields(**{k: v for k, v in fields.items() if k in METADATA_FIELDS})
+                # not valid anymore, the next full merge will just update it
+                ed.metadata_hash = None
+                changed += 1
+            yield processed + len(changes), changed
+
+    def merge(self, new_data, episodes_widget, changes=None):
+        """Merge new data to current programs data, all at once."""
+        changed = 0
+        for _, changed in self.merge_steps(new_data, changes):
+            pass
+        self.merge_finished(changed, episodes_widget)
+
+    def missing(self, backend, present_ids):
+        """Return the ids of the episodes of the backend that are not in the present ones."""
+        return [episode_id for episode_id, ed in self.data.items()
+                if ed.backend == backend and episode_id not in present_ids]
+
+    def remove(self, episode_ids, keep=()):
+        """Remove episodes that are not in the backends anymore, leaving a tombstone for each.
+
+        Episodes that are downloaded or being downloaded, or which ids are in 'keep', are not
+        removed. Return how many were removed and how many kept.
+        """
+        now = datetime.now()
+        removed = kept = 0
+        for episode_id in episode_ids:
+            ed = self.data.get(episode_id)
+            if ed is None:
+                continue
+            if ed.state != Status.none or episode_id in keep:
+                kept += 1
+                continue
+            del self.data[episode_id]
+            self.tombstones[episode_id] = (ed.backend, now)
+            removed += 1
+
+        # forget the old tombstones
+        limit = now - TOMBSTONES_TTL
+        for episode_id, (_, when) in list(self.tombstones.items()):
+            if when < limit:
+                del self.tombstones[episode_id]
+
+        logger.info("Removed %d episodes (kept %d)", removed, kept)
+        return removed, kept
+
+    def merge_finished(self, changed, episodes_widget):
+        """Refresh the episodes and save the data, if something changed."""
+        logger.info("Merged episodes data, changed %d", changed)
+        if changed:
+            episodes_widget.reload_episodes()
+            self.save()
 
     def load(self):
         """Load the data from the file."""
@@ -223,8 +352,11 @@ class ProgramsData:
             # pre-versioned data
             self.version = 0
             self.data = loaded_programs_data
-        else:
+        elif len(loaded_programs_data) == 2:
+            # before having tombstones
             self.version, self.data = loaded_programs_data
+        else:
+            self.version, self.data, self.tombstones = loaded_programs_data
 
     def migrate(self):
         """Migrate metadata if needed."""
@@ -256,9 +388,16 @@ class ProgramsData:
 
         if self.version == 1:
             logger.info("Migrating from version 1")
-            self.version = self.last_programs_version
+            self.version = 2
             for epis_id, episode in self.data.items():
                 episode.composed_title = episode.title
+
+        if self.version == 2:
+            # the episodes don't know their backend, so all of them need to be merged again
+            # for that to be fixed (and then the removed ones can be found)
+            logger.info("Migrating from version 2")
+            self.version = self.last_programs_version
+            self.forget_backends_state = True
             return
 
         raise ValueError("Don't know how to migrate from %r" % (self.version,))
@@ -289,6 +428,6 @@ class ProgramsData:
 
     def save(self):
         """Save to disk."""
-        to_save = (self.last_programs_version, self.data)
+        to_save = (self.last_programs_version, self.data, self.tombstones)
         with utils.SafeSaver(self.filename) as fh:
             pickle.dump(to_save, fh)
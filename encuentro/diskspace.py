@@ -0,0 +1,149 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Check and reserve disk space for the downloads."""
+
+import errno
+import logging
+import os
+import shutil
+import threading
+
+MB = 1024 ** 2
+
+# always leave this free in the disk, whatever the downloads need
+SAFETY_MARGIN = 50 * MB
+
+logger = logging.getLogger('encuentro.diskspace')
+
+
+class NotEnoughSpace(Exception):
+    """There is not enough free space in disk for the download.
+
+    It can also be built from another NotEnoughSpace, which is what 'defer' does when it
+    raises again an exception that went through a deferred.
+    """
+
+    def __init__(self, needed, available=None):
+        if isinstance(needed, NotEnoughSpace):
+            needed, available = needed.needed, needed.available
+        self.needed = needed
+        self.available = available
+        message = "Not enough space in disk: need %d MB" % (needed // MB,)
+        if available is not None:
+            message += ", have %d MB" % (available // MB,)
+        super(NotEnoughSpace, self).__init__(message)
+
+
+class _Reservations:
+    """Space promised to downloads in progress that is not yet written to disk."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reserved = {}
+
+    def reserve(self, owner, size):
+        """Reserve space for the owner (replacing what it had before)."""
+        with self._lock:
+            self._reserved[id(owner)] = size
+
+    def consume(self, owner, size):
+        """The owner wrote that to disk, so it's not free anymore: reserve that less."""
+        with self._lock:
+            reserved = self._reserved.get(id(owner))
+            if reserved is not None:
+                self._reserved[id(owner)] = max(reserved - size, 0)
+
+    def release(self, owner):
+        """Release what the owner had reserved, if anything."""
+        with self._lock:
+            self._reserved.pop(id(owner), None)
+
+    def total(self):
+        """Return the total reserved space."""
+        with self._lock:
+            return sum(self._reserved.values())
+
+
+reservations = _Reservations()
+
+
+def free_space(path):
+    """Return the free space in the disk for the path (that may not exist yet)."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return shutil.disk_usage(path).free
+
+
+def available(path):
+    """Return the space that can be used for new downloads, considering reservations."""
+    return free_space(path) - reservations.total() - SAFETY_MARGIN
+
+
+def admit(path, owner, size):
+    """Reserve the space for a download, raise NotEnoughSpace if it doesn't fit."""
+    reservations.release(owner)
+    if size is None:
+        # nothing to do if we couldn't estimate the size
+        return
+    avail = available(path)
+    if size > avail:
+        raise NotEnoughSpace(size, max(avail, 0))
+    reservations.reserve(owner, size)
+    logger.debug("Reserved %d MB for %r (available %d MB)", size // MB, owner, avail // MB)
+
+
+def estimate_from_info(info):
+    """Estimate the size of a youtube-dl download from the info it extracted.
+
+    The formats to download are in 'requested_formats' (when joining video and audio) or
+    it's the info itself. If the size is not there, it's estimated from the bitrate (in
+    kbps, as youtube-dl gives it, which is what HLS variants advertise) and the duration.
+    """
+    formats = info.get('requested_formats') or [info]
+    duration = info.get('duration')
+    total = 0
+    for fmt in formats:
+        size = fmt.get('filesize') or fmt.get('filesize_approx')
+        if not size:
+            tbr = fmt.get('tbr')
+            if not tbr or not duration:
+                return
+            size = int(tbr * 1000 / 8 * duration)
+        total += size
+    return total
+
+
+def preallocate(fh, size):
+    """Allocate the space in disk for the rest of the file, from the current position.
+
+    Return if it was allocated (so it's not free space anymore).
+    """
+    if not hasattr(os, 'posix_fallocate') or not size:
+        return False
+    try:
+        os.posix_fallocate(fh.fileno(), fh.tell(), size)
+    except OSError as err:
+        if err.errno == errno.ENOSPC:
+            raise NotEnoughSpace(size, free_space(fh.name))
+        # some filesystems do not support it, no problem
+        logger.debug("Couldn't preallocate %d bytes: %r", size, err)
+        return False
+    return True
@@ -0,0 +1,148 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""The queue of pending downloads."""
+
+import heapq
+import itertools
+
+# default priority for queued episodes; higher goes first
+PRIORITY_NORMAL = 0
+
+
+class QueueEntry:
+    """An episode waiting in the queue, with its scheduling info."""
+
+    __slots__ = ('episode', 'item', 'priority', 'paused', 'held', 'key')
+
+    def __init__(self, episode, item, priority, paused):
+        self.episode = episode
+        self.item = item
+        self.priority = priority
+        self.paused = paused
+        self.held = None  # the bytes needed in disk, if paused for lack of space
+        self.key = None
+
+    @property
+    def episode_id(self):
+        """The id of the queued episode."""
+        return self.episode.episode_id
+
+    def __repr__(self):
+        return "<QueueEntry %s prio=%d paused=%s>" % (self.episode_id, self.priority, self.paused)
+
+
+class DownloadQueue:
+    """Pending downloads, ordered by priority and then by arrival.
+
+    Entries are indexed by episode id, and the order is kept in a heap which is lazily
+    cleaned: when an entry changes its priority (or is removed, or paused) its old position
+    in the heap is just ignored when it's reached.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._heap = []
+        self._arrivals = itertools.count()
+        self._fronts = itertools.count(-1, -1)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, episode_id):
+        return episode_id in self._entries
+
+    def __getitem__(self, episode_id):
+        return self._entries[episode_id]
+
+    def _push(self, entry, seq):
+        """Put the entry in the heap, with the given sequence inside its priority."""
+        entry.key = (-entry.priority, seq)
+        heapq.heappush(self._heap, entry.key + (entry.episode_id,))
+
+        # compact the heap if too much garbage accumulated
+        if len(self._heap) > 2 * len(self._entries) + 32:
+            self._heap = [entry.key + (entry.episode_id,)
+                          for entry in self._entries.values() if entry.key is not None]
+            heapq.heapify(self._heap)
+
+    def add(self, episode, item=None, priority=PRIORITY_NORMAL, paused=False):
+        """Add an episode to the end of its priority level."""
+        if episode.episode_id in self._entries:
+            raise ValueError("Episode already queued: " + str(episode))
+        entry = QueueEntry(episode, item, priority, paused)
+        self._entries[episode.episode_id] = entry
+        if not paused:
+            self._push(entry, next(self._arrivals))
+        return entry
+
+    def remove(self, episode_id):
+        """Remove an episode from the queue, returning its entry."""
+        entry = self._entries.pop(episode_id)
+        entry.key = None
+        return entry
+
+    def set_priority(self, episode_id, priority):
+        """Change the priority of a queued episode."""
+        entry = self._entries[episode_id]
+        entry.priority = priority
+        if not entry.paused:
+            self._push(entry, next(self._arrivals))
+
+    def move_to_front(self, episode_id):
+        """Make the episode the next one to be downloaded."""
+        entry = self._entries[episode_id]
+        entry.priority = max(e.priority for e in self._entries.values())
+        entry.paused = False
+        entry.held = None
+        self._push(entry, next(self._fronts))
+
+    def pause(self, episode_id):
+        """Keep the episode in the queue, but don't download it until resumed."""
+        entry = self._entries[episode_id]
+        entry.paused = True
+        entry.key = None
+
+    def resume(self, episode_id):
+        """Make a paused episode available to be downloaded again."""
+        entry = self._entries[episode_id]
+        entry.held = None
+        if entry.paused:
+            entry.paused = False
+            self._push(entry, next(self._arrivals))
+
+    def pop(self):
+        """Remove and return the next entry to download, None if nothing available."""
+        while self._heap:
+            prio, seq, episode_id = heapq.heappop(self._heap)
+            entry = self._entries.get(episode_id)
+            if entry is None or entry.key != (prio, seq):
+                # removed, paused, or with a newer position
+                continue
+            del self._entries[episode_id]
+            entry.key = None
+            return entry
+
+    def available(self):
+        """Return how many entries can be downloaded (the not paused ones)."""
+        return sum(1 for entry in self._entries.values() if not entry.paused)
+
+    def ordered(self):
+        """Return all entries in the order they would be downloaded, paused ones at the end."""
+        active = sorted((e for e in self._entries.values() if not e.paused),
+                        key=lambda e: e.key)
+        paused = [e for e in self._entries.values() if e.paused]
+        return active + paused
@@ -0,0 +1,276 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""The HTTP client shared by everything that downloads from the program."""
+
+import collections
+import logging
+
+import defer
+
+from PyQt5 import QtNetwork, QtCore
+
+# Qt error for an aborted request
+_OPERATION_CANCELED = 5
+
+# HTTP statuses which body is the content asked for (complete or from the requested offset)
+_CONTENT_STATUSES = (200, 206)
+
+# the headers sent in all the requests
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0',
+    'Accept': '*/*',
+    'Connection': 'keep-alive',
+}
+
+logger = logging.getLogger('encuentro.httpclient')
+
+
+class NetworkError(Exception):
+    """A network problem while downloading, with the Qt error code and HTTP status (if any).
+
+    It can also be built from another NetworkError, which is what 'defer' does when it
+    raises again an exception that went through a deferred.
+    """
+
+    def __init__(self, code, http_status=None, message=''):
+        if isinstance(code, NetworkError):
+            code, http_status, message = code.code, code.http_status, code.message
+        self.code = code
+        self.http_status = http_status
+        self.message = message
+        super(NetworkError, self).__init__(
+            "Network error %s (HTTP status %s): %s" % (code, http_status, message))
+
+
+class Response:
+    """What was received from the server."""
+
+    def __init__(self, status, headers, data):
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+    @property
+    def content_type(self):
+        """The content type of the response, if informed by the server."""
+        return self.headers.get('content-type')
+
+
+class HTTPClient:
+    """A single network manager for all the program.
+
+    Qt keeps a pool of connections per host inside the manager, reusing them (with HTTP
+    keep-alive) for the following requests, so it's important to share it instead of
+    creating one per download.
+    """
+
+    def __init__(self):
+        self.manager = QtNetwork.QNetworkAccessManager()
+        self.manager.encrypted.connect(self._on_encrypted)
+        self.stats = collections.defaultdict(collections.Counter)
+
+    def _on_encrypted(self, reply):
+        """A TLS handshake happened, which means a new connection was opened."""
+        self.stats[reply.url().host()]['handshakes'] += 1
+
+    def record(self, url, key, quantity=1):
+        """Record some metric for the host of the url."""
+        self.stats[QtCore.QUrl(url).host()][key] += quantity
+
+    def get(self, url, headers=None, offset=0):
+        """Start a GET to the url, from the indicated offset (if not zero)."""
+        request = QtNetwork.QNetworkRequest(QtCore.QUrl(url))
+        all_headers = dict(DEFAULT_HEADERS)
+        if headers:
+            all_headers.update(headers)
+        if offset:
+            all_headers['Range'] = 'bytes=%d-' % (offset,)
+        for hk, hv in all_headers.items():
+            request.setRawHeader(hk.encode(), hv.encode())
+        self.record(url, 'requests')
+        return self.manager.get(request)
+
+    def report(self):
+        """Return the metrics, per host.
+
+        Reused connections can only be known for HTTPS, where each new connection implies a
+        handshake; for plain HTTP it's None.
+        """
+        result = {}
+        for host, counter in self.stats.items():
+            info = dict(counter)
+            if counter['handshakes']:
+                info['reused'] = counter['requests'] - counter['handshakes']
+            else:
+                info['reused'] = None
+            result[host] = info
+        return result
+
+
+client = HTTPClient()
+
+
+class Transfer:
+    """A GET that survives stalls, continuing from what was received instead of restarting.
+
+    If nothing arrives for 'stall_timeout' seconds the request is aborted and a new one is
+    done asking only for the missing bytes (if the server doesn't support ranges, everything
+    is received again, and 'on_headers' lets the caller know that with a lower offset).
+
+    The received content is passed to 'on_data', or accumulated and returned in the
+    Response when finished if that callback is not given.
+    """
+
+    def __init__(self, url, headers=None, offset=0, on_headers=None, on_data=None,
+                 on_progress=None, stall_timeout=None):
+        self.url = url
+        self.headers = headers
+        self.deferred = defer.Deferred()
+        self.deferred._store_it_because_qt_needs_or_wont_work = self
+        self.received = offset
+        self.offset = offset
+        self.total = None
+        self.status = None
+        self.reply = None
+        self._on_headers = on_headers
+        self._on_data = on_data
+        self._on_progress = on_progress
+        self._chunks = []
+        self._prev_received = None
+        self._headers_reply = None
+
+        if stall_timeout is None:
+            # imported here because config uses utils, that uses this module
+            from encuentro.config import config
+            stall_timeout = config.get('stall-timeout', 5)
+        self._stall_timer = QtCore.QTimer()
+        self._stall_timer.timeout.connect(self._check_stalled)
+        self._stall_timer.start(int(stall_timeout * 1000))
+        self._start()
+
+    def _start(self):
+        """Do the request, from what was already received."""
+        self.reply = reply = client.get(self.url, self.headers, self.received)
+        reply.metaDataChanged.connect(lambda: self._headers(reply))
+        reply.readyRead.connect(lambda: self._read(reply))
+        reply.error.connect(lambda code: self._error(reply, code))
+        reply.finished.connect(lambda: self._finished(reply))
+        reply.downloadProgress.connect(self._progress)
+
+    def _headers(self, reply):
+        """The response headers arrived."""
+        if reply is not self.reply or reply is self._headers_reply:
+            # Qt may signal this more than once, but the offset must be decided only once
+            return
+        self._headers_reply = reply
+        self.status = reply.attribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute)
+        if not self._is_content():
+            # an error, the transfer will fail with it and what was received is still valid
+            return
+        if self.received and self.status != 206:
+            # the server ignored the range, it's sending everything again
+            logger.debug("Server ignored range for %r, receiving all again", self.url)
+            self.received = 0
+            self._chunks = []
+        self.offset = self.received
+
+        size = reply.header(QtNetwork.QNetworkRequest.ContentLengthHeader)
+        self.total = None if size is None else self.offset + size
+        if self._on_headers is not None:
+            try:
+                self._on_headers(self)
+            except Exception as err:
+                self.fail(err)
+
+    def _read(self, reply):
+        """Get the bytes available."""
+        if reply is not self.reply or self.deferred.called:
+            return
+        data = reply.read(reply.bytesAvailable())
+        if not self._is_content():
+            # the body of an error response, not part of the content
+            return
+        self.received += len(data)
+        client.record(self.url, 'bytes', len(data))
+        if self._on_data is None:
+            self._chunks.append(data)
+        else:
+            try:
+                self._on_data(data)
+            except Exception as err:
+                self.fail(err)
+
+    def _is_content(self):
+        """Tell if what is being received is the content (not an error page)."""
+        return self.status is None or self.status in _CONTENT_STATUSES
+
+    def _progress(self, _, __):
+        """Report the overall progress."""
+        if self._on_progress is not None:
+            try:
+                self._on_progress(self.received, -1 if self.total is None else self.total)
+            except Exception as err:
+                self.fail(err)
+
+    def _check_stalled(self):
+        """Resume the transfer if nothing was received lately."""
+        if self.received == self._prev_received:
+            logger.debug("Transfer stalled for %r at %d bytes, resuming", self.url, self.received)
+            client.record(self.url, 'stalls')
+            old_reply = self.reply
+            self.reply = None
+            old_reply.abort()
+            self._start()
+        self._prev_received = self.received
+
+    def _error(self, reply, code):
+        """The request finished on error."""
+        if reply is not self.reply or code == _OPERATION_CANCELED:
+            # aborted by us
+            return
+        status = reply.attribute(QtNetwork.QNetworkRequest.HttpStatusCodeAttribute)
+        self.fail(NetworkError(code, status, reply.errorString()))
+
+    def _finished(self, reply):
+        """The request finished, fire the deferred if all went ok."""
+        if reply is not self.reply or self.deferred.called:
+            return
+        self._read(reply)
+        self._stall_timer.stop()
+        headers = {bytes(k).decode('ascii').lower(): bytes(v).decode('latin1')
+                   for k, v in reply.rawHeaderPairs()}
+        data = b"".join(self._chunks) if self._on_data is None else None
+        self.deferred.callback(Response(self.status, headers, data))
+
+    def is_finished(self):
+        """Tell if the transfer is done (ok or not)."""
+        return self.deferred.called
+
+    def fail(self, exc):
+        """Abort the transfer, ending it with the given exception."""
+        self._stall_timer.stop()
+        reply = self.reply
+        self.reply = None
+        if reply is not None and not reply.isFinished():
+            reply.abort()
+        if not self.deferred.called:
+            self.deferred.errback(exc)
+
+
+def fetch(url, headers=None):
+    """Download the url to memory; return a deferred with the Response."""
+    return Transfer(url, headers=headers).deferred
@@ -17,57 +17,432 @@
 """Get an image from web and cache it."""
 
 
+import collections
 import logging
 import os
-import glob
+import pickle
+import threading
+import time
 from hashlib import md5
 
-from encuentro import multiplatform, utils
+import defer
+
+from PyQt5.QtCore import QBuffer, QIODevice, Qt
+from PyQt5.QtGui import QImage, QImageReader
+
+from encuentro import httpclient, multiplatform, utils
+from encuentro.config import config, signal
+
+# the file, inside the cache directory, where the index of cached images is kept
+INDEX_FILENAME = 'index.pickle'
+
+# the default limits for the cache, in bytes and quantity of images (can be changed in the
+# config); when any of them is exceeded the least recently used images are removed
+MAX_CACHE_BYTES = 300 * 1024 ** 2
+MAX_CACHE_IMAGES = 30000
+
+# how many images can be downloaded at the same time, in total and for prefetching
+MAX_DOWNLOADS = 4
+PREFETCH_CONCURRENCY = 3
+
+# the biggest size the images are shown, so they are stored in the cache; and the JPEG
+# quality for the ones that are reduced
+DISPLAY_WIDTH, DISPLAY_HEIGHT = 720, 540
+DISPLAY_QUALITY = 85
 
 logger = logging.getLogger('encuentro.image')
 
 
+def prepare_image(content_type, data):
+    """Return the image as it's stored in the cache: its data and file extension.
+
+    Images bigger than what is shown are reduced, and stored as JPEG (or PNG, if they have
+    transparency); the rest are stored as they came. If the server didn't tell the content
+    type, the extension is guessed from the data.
+    """
+    content, _, extension = (content_type or '').split(';')[0].strip().partition('/')
+    if content != 'image':
+        logger.debug("The Content-Type header is not 'image': %r", content_type)
+    if not extension:
+        buffer = QBuffer()
+        buffer.setData(data)
+        buffer.open(QIODevice.ReadOnly)
+        extension = bytes(QImageReader.imageFormat(buffer)).decode('ascii') or 'unknown'
+    qimage = QImage.fromData(data)
+    if qimage.isNull() or (
+            qimage.width() <= DISPLAY_WIDTH and qimage.height() <= DISPLAY_HEIGHT):
+        return data, extension
+
+    qimage = qimage.scaled(
+        DISPLAY_WIDTH, DISPLAY_HEIGHT, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    if qimage.hasAlphaChannel():
+        extension, quality = 'png', -1
+    else:
+        extension, quality = 'jpeg', DISPLAY_QUALITY
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    if not qimage.save(buffer, extension.upper(), quality):
+        raise ValueError("Couldn't encode the image as %r" % (extension,))
+    return bytes(buffer.data()), extension
+
+
+class DownloadCancelled(Exception):
+    """The image is not needed anymore."""
+
+
+class _Download:
+    """The download of an image, that may be wanted by several at the same time."""
+
+    def __init__(self, url_hash, url):
+        self.url_hash = url_hash
+        self.url = url
+        self.waiting = []
+        self.transfer = None
+
+
 class ImageGetter:
     """Image downloader and cache object."""
 
-    def __init__(self, callback):
+    def __init__(self, callback, cache_dir=None):
         self.callback = callback
-        self.cache_dir = os.path.join(multiplatform.cache_dir,
-                                      'encuentro.images')
+        if cache_dir is None:
+            cache_dir = os.path.join(multiplatform.cache_dir, 'encuentro.images')
+        self.cache_dir = cache_dir
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
 
+        # the cached images, from the hash of their URL to the name of the file, its size
+        # and when it was last used, the least recently used first; it's loaded (or built
+        # from the directory, if not saved before) when first needed
+        self._index = None
+        self._index_changed = False
+        self._index_path = os.path.join(self.cache_dir, INDEX_FILENAME)
+        self.total_bytes = 0
+        signal.register(self.save_state)
+
+        # the files already out of the index that are being removed in other thread
+        self._lock = threading.Lock()
+        self._doomed = set()
+
+        # the downloads in progress or waiting to start, per hash of the URL
+        self._downloads = {}
+        self._queue = collections.deque()
+        self._downloading = 0
+
+    @property
+    def index(self):
+        """The index of the cached images."""
+        if self._index is None:
+            self._index = self._load_index()
+            self.total_bytes = sum(size for _, size, _ in self._index.values())
+            self.evict()
+        return self._index
+
+    def _load_index(self):
+        """Load the index from disk, or build it from the files in the cache directory.
+
+        The saved index is reconciled with the directory, as the images cached or removed
+        after it was last saved (e.g. if the program crashed) are not in it.
+        """
+        found = self._scan_directory()
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, 'rb') as fh:
+                    index = pickle.load(fh)
+                if not isinstance(index, collections.OrderedDict):
+                    raise ValueError("Old index format")
+            except Exception as err:
+                logger.warning("Problem loading the images index, rebuilding it: %s", err)
+            else:
+                logger.debug("Images index loaded (%d images)", len(index))
+                self._reconcile(index, found)
+                return index
+
+        index = collections.OrderedDict(found)
+        logger.debug("Images index built from the cache directory (%d images)", len(index))
+        self._index_changed = True
+        return index
+
+    def _scan_directory(self):
+        """Return the images in the cache directory, the least recently modified first."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            file_name = entry.name
+            url_hash, dot, _ = file_name.partition('.')
+            if dot and entry.is_file() and file_name != INDEX_FILENAME and not (
+                    file_name.endswith('.tmp')):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, url_hash, file_name, stat.st_size))
+        entries.sort()
+        return [(url_hash, (file_name, size, last_used))
+                for last_used, url_hash, file_name, size in entries]
+
+    def _reconcile(self, index, found):
+        """Fix the index with what is really in the directory."""
+        found_files = {file_name for _, (file_name, _, _) in found}
+        missing = [url_hash for url_hash, (file_name, _, _) in index.items()
+                   if file_name not in found_files]
+        for url_hash in missing:
+            del index[url_hash]
+        # not in the index, these are the most recent ones
+        added = 0
+        for url_hash, entry in found:
+            if url_hash not in index:
+                index[url_hash] = entry
+                added += 1
+        if missing or added:
+            logger.debug("Images index reconciled with the directory: %d removed, %d added",
+                         len(missing), added)
+            self._index_changed = True
+
+    def save_state(self):
+        """Save the index to disk, if changed."""
+        if not self._index_changed:
+            return
+        with utils.SafeSaver(self._index_path) as fh:
+            pickle.dump(self._index, fh)
+        self._index_changed = False
+
+    def _add(self, url_hash, file_name, size):
+        """Add an image to the index, removing others if the cache is too big."""
+        previous = self.index.pop(url_hash, None)
+        if previous is not None:
+            self.total_bytes -= previous[1]
+        self.index[url_hash] = (file_name, size, time.time())
+        self.total_bytes += size
+        self._index_changed = True
+        self.evict()
+
+    def _touch(self, url_hash):
+        """Mark the image as just used; return its file name."""
+        file_name, size, _ = self.index[url_hash]
+        self.index[url_hash] = (file_name, size, time.time())
+        self.index.move_to_end(url_hash)
+        self._index_changed = True
+        return file_name
+
+    def evict(self):
+        """Remove the least recently used images if the cache exceeds its limits.
+
+        The images are taken out of the index right away, but the files are removed in
+        other thread, which is returned (None if nothing needs to be removed).
+        """
+        max_bytes = config.get('images-cache-max-bytes', MAX_CACHE_BYTES)
+        max_images = config.get('images-cache-max-images', MAX_CACHE_IMAGES)
+        index = self._index
+        victims = []
+        while index and (self.total_bytes > max_bytes or len(index) > max_images):
+            _, (file_name, size, _) = index.popitem(last=False)
+            self.total_bytes -= size
+            victims.append(file_name)
+        if not victims:
+            return
+
+        logger.debug("Removing %d images from the cache, now %d images in %d bytes",
+                     len(victims), len(index), self.total_bytes)
+        self._index_changed = True
+        with self._lock:
+            self._doomed.update(victims)
+        thread = threading.Thread(target=self._remove_files, args=(victims,), daemon=True)
+        thread.start()
+        return thread
+
+    def _remove_files(self, file_names):
+        """Remove the files from disk, unless they were added again in the meantime."""
+        for file_name in file_names:
+            with self._lock:
+                if file_name not in self._doomed:
+                    continue
+                self._doomed.discard(file_name)
+                try:
+                    os.remove(os.path.join(self.cache_dir, file_name))
+                except OSError as err:
+                    logger.warning("Problem removing cached image %r: %s", file_name, err)
+
     def get_image(self, episode_id, url):
         """Get an image and show it using the callback."""
         logger.info("Loading image for episode %s: %r", episode_id, url)
-        file_name = md5(url.encode('utf8')).hexdigest()
-        file_fullname = os.path.join(self.cache_dir, file_name)
-        img_search_result = glob.glob(file_fullname + '.*')
-        if len(img_search_result) > 0:
-            logger.debug("Image already available: %r", file_fullname)
-            self.callback(episode_id, file_fullname)
+        url_hash = md5(url.encode('utf8')).hexdigest()
+        if self._in_cache(url_hash):
+            cached = os.path.join(self.cache_dir, self._touch(url_hash))
+            logger.debug("Image already available: %r", cached)
+            self.callback(episode_id, cached)
             return
 
-        def _d_callback(data, episode_id, file_fullname):
-            """Cache the image and use the callback."""
-            content_type, img_data = data
-            content, extension = content_type.split('/')
-            if content != 'image':
-                logger.debug("The Content-Type header is not 'image'")
-            file_fullname = file_fullname + '.' + extension
-            logger.debug("Image downloaded for episode_id %s, "
-                         "saving to %r, Content-Type= %s",
-                         episode_id, file_fullname, content_type)
-            with utils.SafeSaver(file_fullname) as fh:
-                fh.write(img_data)
-            self.callback(episode_id, file_fullname)
-
         def _d_errback(failure):
             """Log the problem."""
             logger.error("Problem getting image: type: %s error: %s",
                          failure.type, failure.value)
 
         logger.debug("Need to download the image")
-        d = utils.download(url)
-        d.add_callback(_d_callback, episode_id, file_fullname)
-        d.add_errback(_d_errback)
+        deferred = self.download(url, urgent=True)
+        deferred.add_callback(lambda path: self.callback(episode_id, path))
+        deferred.add_errback(_d_errback)
+
+    def is_cached(self, url):
+        """Tell if the image is already in the cache."""
+        return self._in_cache(md5(url.encode('utf8')).hexdigest())
+
+    def _in_cache(self, url_hash):
+        """Tell if the image is in the cache; if its file is not there anymore, forget it."""
+        entry = self.index.get(url_hash)
+        if entry is None:
+            return False
+        file_name, size, _ = entry
+        if os.path.exists(os.path.join(self.cache_dir, file_name)):
+            return True
+        logger.debug("Cached image %r not found, forgetting it", file_name)
+        del self.index[url_hash]
+        self.total_bytes -= size
+        self._index_changed = True
+        return False
+
+    def download(self, url, urgent=False):
+        """Download an image to the cache; return a deferred fired with its path.
+
+        If the image is already being downloaded (or waiting to) no other download is
+        started, the deferred fires when that one finishes. Only some downloads happen at
+        the same time, the urgent ones start before the others.
+        """
+        url_hash = md5(url.encode('utf8')).hexdigest()
+        download = self._downloads.get(url_hash)
+        if download is None:
+            download = self._downloads[url_hash] = _Download(url_hash, url)
+            if urgent:
+                self._queue.appendleft(download)
+            else:
+                self._queue.append(download)
+        elif urgent and download.transfer is None:
+            logger.debug("Image download for %r made urgent", url)
+            self._queue.remove(download)
+            self._queue.appendleft(download)
+        else:
+            logger.debug("Image download for %r already in progress", url)
+
+        deferred = defer.Deferred()
+        download.waiting.append(deferred)
+        self._next_download()
+        return deferred
+
+    def cancel(self, url, deferred):
+        """The image is not wanted anymore by who got the deferred (that will not be fired).
+
+        If nobody else wants it, its download is removed from the queue, or aborted.
+        """
+        download = self._downloads.get(md5(url.encode('utf8')).hexdigest())
+        if download is None or deferred not in download.waiting:
+            return
+        download.waiting.remove(deferred)
+        if download.waiting:
+            return
+
+        logger.debug("Cancelling image download for %r", url)
+        del self._downloads[download.url_hash]
+        if download.transfer is None:
+            self._queue.remove(download)
+        else:
+            download.transfer.fail(DownloadCancelled(url))
+
+    def _next_download(self):
+        """Start the next downloads, if there is room."""
+        while self._queue and self._downloading < MAX_DOWNLOADS:
+            download = self._queue.popleft()
+            self._downloading += 1
+            download.transfer = httpclient.Transfer(download.url)
+            download.transfer.deferred.add_callbacks(
+                self._downloaded, self._downloaded, callback_args=(download,),
+                errback_args=(download,))
+
+    def _downloaded(self, result, download):
+        """A transfer finished: prepare the image in other thread, if all went ok."""
+        self._downloading -= 1
+        self._next_download()
+        if isinstance(result, defer.DeferredException):
+            self._finish(download, result.value)
+            return
+        deferred = utils.run_in_thread(prepare_image, result.content_type, result.data)
+        deferred.add_callbacks(self._prepared, self._prepared, callback_args=(download,),
+                               errback_args=(download,))
+
+    def _prepared(self, result, download):
+        """The image is ready to be stored."""
+        if isinstance(result, defer.DeferredException):
+            self._finish(download, result.value)
+            return
+        data, extension = result
+        try:
+            path = self._save(download.url_hash, data, extension)
+        except Exception as err:
+            self._finish(download, err)
+        else:
+            self._finish(download, None, path)
+
+    def _finish(self, download, error, path=None):
+        """Tell everybody waiting for the image (unless the download was cancelled)."""
+        if self._downloads.get(download.url_hash) is download:
+            del self._downloads[download.url_hash]
+        if isinstance(error, DownloadCancelled):
+            return
+        for deferred in download.waiting:
+            if error is None:
+                deferred.callback(path)
+            else:
+                deferred.errback(error)
+
+    def _save(self, url_hash, data, extension):
+        """Save the image in the cache, return its path."""
+        file_name = url_hash + '.' + extension
+        file_fullname = os.path.join(self.cache_dir, file_name)
+        logger.debug("Image downloaded, saving to %r", file_fullname)
+        with self._lock:
+            # if it was being removed, don't
+            self._doomed.discard(file_name)
+        with utils.SafeSaver(file_fullname) as fh:
+            fh.write(data)
+        self._add(url_hash, file_name, len(data))
+        return file_fullname
+
+
+class Prefetcher:
+    """Get images into the cache before they are needed, only a few at the same time.
+
+    What is wanted is replaced as a whole, in order of priority; what was wanted before
+    but not anymore is forgotten, even cancelling it if it's being downloaded.
+    """
+
+    def __init__(self, getter, concurrency=PREFETCH_CONCURRENCY):
+        self.getter = getter
+        self.concurrency = concurrency
+        self._wanted = []
+        self._running = {}
+
+    def set_wanted(self, urls):
+        """Set the urls of the images that are wanted, the most important first."""
+        urls = list(collections.OrderedDict.fromkeys(urls))
+        still_wanted = set(urls)
+        for url, deferred in list(self._running.items()):
+            if url not in still_wanted:
+                logger.debug("Cancelling image prefetch for %r", url)
+                del self._running[url]
+                self.getter.cancel(url, deferred)
+        self._wanted = [url for url in urls if url not in self._running]
+        self._next()
+
+    def _next(self):
+        """Start the next prefetches, if there is room."""
+        while self._wanted and len(self._running) < self.concurrency:
+            url = self._wanted.pop(0)
+            if self.getter.is_cached(url):
+                continue
+            logger.debug("Prefetching image %r", url)
+            deferred = self._running[url] = self.getter.download(url)
+            deferred.add_callbacks(self._finished, self._finished, callback_args=(url, deferred),
+                                   errback_args=(url, deferred))
+
+    def _finished(self, result, url, deferred):
+        """A prefetch finished, ok or not."""
+        if isinstance(result, defer.DeferredException):
+            logger.debug("Problem prefetching image %r: %s", url, result.value)
+        if self._running.get(url) is deferred:
+            del self._running[url]
+        self._next()
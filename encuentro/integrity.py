@@ -0,0 +1,177 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Verify that downloaded files are complete and sane."""
+
+import hashlib
+import logging
+import os
+import struct
+
+HASH_ALGORITHM = 'sha256'
+
+# how many MP3 frames are followed from the start to validate the stream
+MP3_FRAMES_TO_CHECK = 5
+
+# bitrates (kbps) for MPEG-1 layer 3, and for MPEG-2/2.5 layer 3
+_MP3_BITRATES_V1 = [None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, None]
+_MP3_BITRATES_V2 = [None, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, None]
+_MP3_SAMPLERATES = {
+    3: [44100, 48000, 32000],  # MPEG-1
+    2: [22050, 24000, 16000],  # MPEG-2
+    0: [11025, 12000, 8000],  # MPEG-2.5
+}
+
+logger = logging.getLogger('encuentro.integrity')
+
+
+class IntegrityError(Exception):
+    """The downloaded file is not complete or is broken."""
+
+
+class StreamHasher:
+    """Hash the content while it's being written, to avoid reading the file again."""
+
+    def __init__(self):
+        self._hash = hashlib.new(HASH_ALGORITHM)
+        self.size = 0
+
+    def update(self, data):
+        """Hash another chunk of the content."""
+        self._hash.update(data)
+        self.size += len(data)
+
+    def checksum(self):
+        """Return the checksum of all the content so far."""
+        return "%s:%s" % (HASH_ALGORITHM, self._hash.hexdigest())
+
+
+def file_checksum(path, chunk_size=1024 ** 2):
+    """Return the checksum of a file already in disk."""
+    hasher = StreamHasher()
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.checksum()
+
+
+def verify_checksum(path, checksum):
+    """Tell if the file in disk still has the recorded checksum."""
+    algorithm, _ = checksum.split(':', 1)
+    if algorithm != HASH_ALGORITHM:
+        raise ValueError("Unknown checksum algorithm: %r" % (algorithm,))
+    return file_checksum(path) == checksum
+
+
+def check_size(path, expected):
+    """Check that the file has exactly the expected size (if known)."""
+    if expected is None:
+        return
+    size = os.path.getsize(path)
+    if size != expected:
+        raise IntegrityError("Wrong size: got %d bytes, expected %d" % (size, expected))
+
+
+def check_mp4(fh, size):
+    """Check the MP4 top level boxes cover the whole file, and that the 'moov' is there."""
+    found = set()
+    pos = 0
+    while pos < size:
+        fh.seek(pos)
+        header = fh.read(8)
+        if len(header) < 8:
+            raise IntegrityError("Truncated MP4 box header at %d" % (pos,))
+        box_size, box_type = struct.unpack(">I4s", header)
+        if box_size == 1:
+            # 64 bits size after the type
+            extended = fh.read(8)
+            if len(extended) < 8:
+                raise IntegrityError("Truncated MP4 box header at %d" % (pos,))
+            (box_size,) = struct.unpack(">Q", extended)
+        elif box_size == 0:
+            # the box goes to the end of the file
+            box_size = size - pos
+        if box_size < 8:
+            raise IntegrityError("Invalid MP4 box size %d at %d" % (box_size, pos))
+        found.add(box_type)
+        pos += box_size
+
+    if pos != size:
+        raise IntegrityError("Truncated MP4 box, file ends at %d but box at %d" % (size, pos))
+    for needed in (b'moov', b'mdat'):
+        if needed not in found:
+            raise IntegrityError("MP4 without %r box" % (needed.decode('ascii'),))
+
+
+def _mp3_frame_length(header):
+    """Return the length of the MP3 frame starting with the given 4 bytes, None if invalid."""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_idx = header[2] >> 4
+    samplerate_idx = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer != 1 or samplerate_idx == 3:
+        # reserved version, not layer 3, or reserved sample rate
+        return
+    bitrates = _MP3_BITRATES_V1 if version == 3 else _MP3_BITRATES_V2
+    bitrate = bitrates[bitrate_idx]
+    if bitrate is None:
+        return
+    samplerate = _MP3_SAMPLERATES[version][samplerate_idx]
+    coefficient = 144 if version == 3 else 72
+    return coefficient * bitrate * 1000 // samplerate + padding
+
+
+def check_mp3(fh, size):
+    """Check the MP3 stream starts with a chain of valid frames (after the ID3 tag, if any)."""
+    fh.seek(0)
+    header = fh.read(10)
+    pos = 0
+    if header[:3] == b'ID3':
+        # tag size is "syncsafe" (7 bits per byte), plus the header, plus the footer if flagged
+        tag_size = 0
+        for byte in header[6:10]:
+            tag_size = (tag_size << 7) | (byte & 0x7F)
+        pos = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+
+    for _ in range(MP3_FRAMES_TO_CHECK):
+        if pos >= size:
+            break
+        fh.seek(pos)
+        frame_length = _mp3_frame_length(fh.read(4))
+        if frame_length is None:
+            raise IntegrityError("No MP3 frame sync at %d" % (pos,))
+        pos += frame_length
+
+
+def check_container(path):
+    """Check the file container sanity, according to its content (not its name)."""
+    size = os.path.getsize(path)
+    if size == 0:
+        raise IntegrityError("Empty file")
+    with open(path, 'rb') as fh:
+        start = fh.read(12)
+        if start[4:8] == b'ftyp':
+            check_mp4(fh, size)
+        elif start[:3] == b'ID3' or _mp3_frame_length(start[:4]) is not None:
+            check_mp3(fh, size)
+        else:
+            logger.debug("Unknown container for %r, not checked", path)
@@ -19,8 +19,9 @@
 import logging
 import os
 import sys
+import time
 
-from encuentro import multiplatform
+from encuentro import multiplatform, profiling
 from encuentro.config import config
 from encuentro.ui.main import MainUI
 
@@ -28,24 +29,39 @@ from encuentro.ui.main import MainUI
 # will try to load EpisodeData from this namespace
 from encuentro.data import EpisodeData  # NOQA
 
+from PyQt5.QtCore import QTimer
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QApplication
 
 logger = logging.getLogger('encuentro.init')
 
 
-def start(version, update_source):
+def start(version, update_source, profile_update=None):
     """Rock and roll."""
     # set up config
     fname = os.path.join(multiplatform.config_dir, 'encuentro.conf')
     print("Using configuration file:", repr(fname))
     logger.info("Using configuration file: %r", fname)
-    config.init(fname)
+    with profiling.startup_phase('config'):
+        config.init(fname)
 
     # the order of the lines hereafter are very precise, don't mess with them
-    app = QApplication(sys.argv)
-    icon = QIcon(multiplatform.get_path("encuentro/logos/icon-192.png"))
-    app.setWindowIcon(icon)
+    with profiling.startup_phase('qt_app'):
+        app = QApplication(sys.argv)
+        icon = QIcon(multiplatform.get_path("encuentro/logos/icon-192.png"))
+        app.setWindowIcon(icon)
 
-    MainUI(version, app.quit, update_source)
+    with profiling.startup_phase('main_window'):
+        main_window = MainUI(version, app.quit, update_source, profile_update)
+
+    if profiling.startup is not None:
+        QTimer.singleShot(0, lambda: _startup_profiled(main_window, time.perf_counter()))
     sys.exit(app.exec_())
+
+
+def _startup_profiled(main_window, window_built):
+    """The event loop is running, so all is started: report and quit."""
+    profiling.startup.timer.add('event_loop', time.perf_counter() - window_built)
+    profiling.startup.finish()
+    logger.info("Start up profiled, quitting")
+    main_window.shutdown()
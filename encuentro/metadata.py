@@ -0,0 +1,343 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Decode the backends metadata without blocking the GUI."""
+
+import array
+import bz2
+import codecs
+import itertools
+import json
+import logging
+import lzma
+import queue
+import re
+import struct
+import sys
+import time
+import zlib
+
+from threading import Thread
+
+import defer
+
+from PyQt5 import QtCore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# how much compressed content is decompressed each time
+CHUNK_SIZE = 64 * 1024
+
+# how many episodes are handed to the main thread each time
+BATCH_SIZE = 500
+
+# how frequently (in milliseconds) the main thread looks for decoded episodes
+POLL_PERIOD = 50
+
+# states when parsing a JSON array
+_START, _FIRST, _ITEM, _SEPARATOR, _DONE = range(5)
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# how to build a decompressor for each codec (the file extension) that can be used for
+# the metadata, the faster to decompress first
+DECOMPRESSORS = [
+    ('gz', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    ('xz', lzma.LZMADecompressor),
+    ('bz2', bz2.BZ2Decompressor),
+]
+if zstandard is not None:
+    DECOMPRESSORS.insert(0, ('zst', lambda: zstandard.ZstdDecompressor().decompressobj()))
+
+# the codec always available in the server
+DEFAULT_CODEC = 'bz2'
+
+# the start of the compact binary catalog format, including its version
+ECAT_MAGIC = b'ECAT\x01'
+
+logger = logging.getLogger('encuentro.metadata')
+
+
+def choose_codec(available):
+    """Choose the faster codec to decompress from the available ones."""
+    for codec, _ in DECOMPRESSORS:
+        if codec in available:
+            return codec
+    return DEFAULT_CODEC
+
+
+def iter_raw_decompressed(compressed, codec=DEFAULT_CODEC, chunk_size=CHUNK_SIZE):
+    """Decompress the content little by little, yielding pieces of bytes."""
+    decompressor = dict(DECOMPRESSORS)[codec]()
+    for pos in range(0, len(compressed), chunk_size):
+        data = decompressor.decompress(compressed[pos:pos + chunk_size])
+        if data:
+            yield data
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed content")
+
+
+def _measured(pieces, stats):
+    """Yield the same pieces, accumulating in the stats the time to produce them and their size."""
+    pieces = iter(pieces)
+    while True:
+        tini = time.perf_counter()
+        try:
+            piece = next(pieces)
+        except StopIteration:
+            return
+        finally:
+            stats['decompress'] += time.perf_counter() - tini
+        stats['decompressed_bytes'] += len(piece)
+        yield piece
+
+
+def _new_stats():
+    """Return the stats of a decoding, before starting it."""
+    return {'decompress': 0, 'decompressed_bytes': 0, 'parse': 0}
+
+
+def iter_decompressed(compressed, codec=DEFAULT_CODEC, chunk_size=CHUNK_SIZE, stats=None):
+    """Decompress and decode the content little by little, yielding pieces of text."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    raw = iter_raw_decompressed(compressed, codec, chunk_size)
+    if stats is not None:
+        raw = _measured(raw, stats)
+    for data in raw:
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def iter_array(pieces):
+    """Parse a JSON array from pieces of text, yielding its items as soon as they're complete.
+
+    Only the text of the item being parsed is kept, not the whole document.
+    """
+    decoder = json.JSONDecoder()
+    state = _START
+    buf = ''
+    for piece in itertools.chain(pieces, [None]):
+        final = piece is None
+        if not final:
+            buf += piece
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            char = buf[pos]
+            if state == _START:
+                if char != '[':
+                    raise ValueError("The content is not a JSON array")
+                state = _FIRST
+                pos += 1
+            elif state == _SEPARATOR:
+                if char == ',':
+                    state = _ITEM
+                elif char == ']':
+                    state = _DONE
+                else:
+                    raise ValueError("Bad separator %r in JSON array" % (char,))
+                pos += 1
+            elif state == _DONE:
+                raise ValueError("Extra content after the JSON array")
+            elif state == _FIRST and char == ']':
+                state = _DONE
+                pos += 1
+            else:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    # the item is not complete yet
+                    break
+                if end == len(buf) and not final and not isinstance(value, (dict, list)):
+                    # a number may continue in the next piece
+                    break
+                yield value
+                pos = end
+                state = _SEPARATOR
+        buf = buf[pos:]
+
+    if state != _DONE:
+        raise ValueError("Truncated JSON array")
+
+
+def iter_ecat(content):
+    """Yield the episodes from the compact binary catalog format (see the server helpers)."""
+    if content[:len(ECAT_MAGIC)] != ECAT_MAGIC:
+        raise ValueError("The content is not in the compact binary catalog format")
+    content = memoryview(content)
+    pos = len(ECAT_MAGIC)
+
+    def get_block():
+        """Get the next block."""
+        nonlocal pos
+        (size,) = struct.unpack_from('<I', content, pos)
+        pos += 4
+        if pos + size > len(content):
+            raise ValueError("Truncated compact binary catalog")
+        block = content[pos:pos + size]
+        pos += size
+        return block
+
+    header = json.loads(bytes(get_block()).decode('ascii'))
+    strings = [None] + json.loads(bytes(get_block()).decode('ascii'))
+    names = []
+    columns = []
+    for name, kind in header['fields']:
+        block = get_block()
+        if kind == 'str':
+            indices = array.array('I')
+            indices.frombytes(block)
+            if sys.byteorder == 'big':
+                indices.byteswap()
+            values = [strings[idx] for idx in indices]
+        elif kind == 'json':
+            values = json.loads(bytes(block).decode('ascii'))
+        else:
+            raise ValueError("Unknown column kind %r for field %r" % (kind, name))
+        if len(values) != header['count']:
+            raise ValueError("Wrong column size for field %r" % (name,))
+        names.append(name)
+        columns.append(values)
+
+    missing = [(name, set(rows)) for name, rows in header['missing'].items()]
+    for row, values in enumerate(zip(*columns)):
+        item = dict(zip(names, values))
+        for name, rows in missing:
+            if row in rows:
+                del item[name]
+        yield item
+
+
+def iter_decoded(compressed, extension, stats=None):
+    """Yield the episodes from the content, according to the extension of its file.
+
+    The extension is the codec, maybe preceded by 'ecat.' if it's in the compact binary
+    catalog format (otherwise it's a JSON array).
+
+    If a stats dict is given, the time spent decompressing and the decompressed size are
+    accumulated there.
+    """
+    fmt, _, codec = extension.rpartition('.')
+    if fmt == 'ecat':
+        # columnar, so it needs to be complete
+        raw = iter_raw_decompressed(compressed, codec)
+        if stats is not None:
+            raw = _measured(raw, stats)
+        return iter_ecat(b"".join(raw))
+    return iter_array(iter_decompressed(compressed, codec, stats=stats))
+
+
+def decode(compressed, codec=DEFAULT_CODEC, stats=None):
+    """Decompress and parse the whole content.
+
+    If a stats dict is given, it's filled with the time spent decompressing and parsing,
+    and the decompressed size.
+    """
+    if stats is not None:
+        stats.update(_new_stats())
+    tini = time.perf_counter()
+    result = json.loads("".join(iter_decompressed(compressed, codec, stats=stats)))
+    if stats is not None:
+        stats['parse'] = time.perf_counter() - tini - stats['decompress']
+    return result
+
+
+class _StreamDecoder:
+    """Decode episodes in other thread, passing them to the main thread in batches."""
+
+    _end = object()
+
+    def __init__(self, compressed, extension, on_batch, batch_size, stats):
+        self.compressed = compressed
+        self.extension = extension
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.stats = stats
+        self.quantity = 0
+        self.deferred = defer.Deferred()
+        self.deferred._store_it_because_qt_needs_or_wont_work = self
+        self._queue = queue.Queue()
+
+        self._timer = QtCore.QTimer()
+        self._timer.timeout.connect(self._check)
+        self._timer.start(POLL_PERIOD)
+        Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        """Decode, in the worker thread."""
+        stats = _new_stats()
+        tini = time.perf_counter()
+        try:
+            items = iter_decoded(self.compressed, self.extension, stats)
+            while True:
+                batch = list(itertools.islice(items, self.batch_size))
+                if not batch:
+                    break
+                self._queue.put(batch)
+        except Exception as err:
+            self._queue.put(err)
+        else:
+            stats['parse'] = time.perf_counter() - tini - stats['decompress']
+            if self.stats is not None:
+                self.stats.update(stats)
+            self._queue.put(self._end)
+        self.compressed = None
+
+    def _check(self):
+        """Hand what was decoded so far, in the main thread."""
+        while True:
+            try:
+                result = self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+            if isinstance(result, list):
+                self.quantity += len(result)
+                try:
+                    self.on_batch(result)
+                except Exception as err:
+                    # don't handle more batches, the thread will finish by itself
+                    result = err
+                else:
+                    continue
+
+            self._timer.stop()
+            if result is self._end:
+                self.deferred.callback(self.quantity)
+            else:
+                self.deferred.errback(result)
+            return
+
+
+def decode_in_thread(compressed, extension, on_batch, batch_size=BATCH_SIZE, stats=None):
+    """Decompress and parse the episodes in the content, in other thread.
+
+    The items are passed to 'on_batch', in the main thread, in lists of up to 'batch_size'.
+    Return a deferred that fires with the quantity of items when all is done; at that
+    moment the stats dict (if given) is filled as in 'decode'.
+    """
+    return _StreamDecoder(compressed, extension, on_batch, batch_size, stats).deferred
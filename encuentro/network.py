@@ -18,6 +18,8 @@
 
 import logging
 import os
+import random
+import re
 import sys
 import time
 from urllib import parse
@@ -28,11 +30,11 @@ from threading import Thread, Event
 from queue import Queue, Empty
 
 import defer
-import youtube_dl
-from PyQt5 import QtCore, QtNetwork
+from PyQt5 import QtCore
 
-from encuentro import multiplatform
+from encuentro import diskspace, httpclient, integrity, multiplatform
 from encuentro.config import config
+from encuentro.httpclient import NetworkError
 
 MB = 1024 ** 2
 
@@ -53,6 +55,106 @@ class CancelledError(Exception):
     """The download was cancelled."""
 
 
+# how a download error is classified, to decide if it should be retried
+ERROR_CANCELLED = 'cancelled'
+ERROR_PERMANENT = 'permanent'
+ERROR_TRANSIENT = 'transient'
+
+# HTTP 4xx codes that are worth retrying (timeout and throttling)
+_RETRYABLE_CLIENT_STATUSES = (408, 429)
+
+# youtube-dl errors without HTTP status that will not go away by retrying (e.g. a removed video)
+_PERMANENT_YOUTUBEDL_MESSAGES = (
+    'unavailable', 'not available', 'removed', 'private video', 'unsupported url',
+    'does not exist', 'copyright', 'account associated with this video has been terminated',
+)
+
+
+def _unwrap(err):
+    """Get the original exception if it was rebuilt by 'defer' from it.
+
+    When an exception goes through a deferred and is raised again, 'defer' builds a new one
+    of the same class with the original exception as its only argument.
+    """
+    while len(err.args) == 1 and type(err.args[0]) is type(err):
+        err = err.args[0]
+    return err
+
+
+def _get_http_status(err):
+    """Get the HTTP status from a download error, if any."""
+    status = getattr(err, 'http_status', None)
+    if status is not None:
+        return status
+
+    # youtube-dl wraps the real exception, and also puts the status in the message
+    exc_info = getattr(err, 'exc_info', None)
+    if exc_info is not None:
+        for wrapped in (exc_info[1], getattr(exc_info[1], 'cause', None)):
+            status = getattr(wrapped, 'code', None)
+            if isinstance(status, int):
+                return status
+    m = re.search(r"HTTP (?:Error|status) (\d{3})", str(err))
+    if m:
+        return int(m.group(1))
+
+
+def _is_youtubedl_permanent(err):
+    """Tell if the youtube-dl error (without HTTP status) is something retrying will not fix."""
+    message = str(err).lower()
+    return any(text in message for text in _PERMANENT_YOUTUBEDL_MESSAGES)
+
+
+def classify_error(err):
+    """Classify a download error as cancelled, permanent, or transient."""
+    err = _unwrap(err)
+    if isinstance(err, CancelledError):
+        return ERROR_CANCELLED
+
+    status = _get_http_status(err)
+    if status is not None:
+        if 400 <= status < 500 and status not in _RETRYABLE_CLIENT_STATUSES:
+            return ERROR_PERMANENT
+        return ERROR_TRANSIENT
+
+    # no HTTP status, the network layer or youtube-dl itself failed
+    if isinstance(err, (NetworkError, ConnectionError, TimeoutError, integrity.IntegrityError)):
+        return ERROR_TRANSIENT
+    if err.__class__.__name__ == 'DownloadError':
+        return ERROR_PERMANENT if _is_youtubedl_permanent(err) else ERROR_TRANSIENT
+
+    # anything else is probably a bug or a problem in the disk, retrying is pointless
+    return ERROR_PERMANENT
+
+
+class RetryPolicy:
+    """Decide if and when a failed download should be tried again.
+
+    The delay grows exponentially with each failed attempt (up to a cap), and a random
+    jitter is applied so several clients do not hit the server again all at the same time.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=5, max_delay=300):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_config(cls):
+        """Build the policy according to the configuration."""
+        return cls(max_attempts=config.get('download-retries', 5),
+                   base_delay=config.get('download-retry-delay', 5))
+
+    def should_retry(self, err, attempt):
+        """Tell if after the given failed attempt (starting in 1) the download is retried."""
+        return attempt < self.max_attempts and classify_error(err) == ERROR_TRANSIENT
+
+    def next_delay(self, attempt):
+        """Return the seconds to wait after the given failed attempt (starting in 1)."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+
 class Finished(Exception):
     """Special exception (to be ignored) used by some
     Downloaders to finish themselves."""
@@ -64,6 +166,9 @@ class BaseDownloader:
     def __init__(self):
         self.deferred = defer.Deferred()
         self.cancelled = False
+        self.checksum = None
+        self._target = None
+        self._wait_deferred = None
 
     def log(self, text, *args):
         """Build a better log line."""
@@ -77,10 +182,45 @@ class BaseDownloader:
 
     def cancel(self):
         """Cancel a download."""
+        self.cancelled = True
+        if self._wait_deferred is not None and not self._wait_deferred.called:
+            # waiting to retry, just interrupt that
+            self._wait_deferred.errback(CancelledError("Cancelled by user"))
+            return
         return self._cancel()
 
+    def wait(self, seconds):
+        """Wait some time before retrying; the wait is interrupted if the download is cancelled."""
+        deferred = self._wait_deferred = defer.Deferred()
+
+        def _fire():
+            """Finish the wait, if not cancelled before."""
+            if not deferred.called:
+                deferred.callback(True)
+
+        QtCore.QTimer.singleShot(int(seconds * 1000), _fire)
+        return deferred
+
+    def _admit(self, size):
+        """Check that there is space for the download and reserve it.
+
+        Raise diskspace.NotEnoughSpace if it doesn't fit.
+        """
+        downloaddir = config.get('downloaddir', '')
+        diskspace.admit(downloaddir, self, size)
+
+    def _written(self, size):
+        """Some of the download was written to disk, it doesn't need to be reserved anymore."""
+        diskspace.reservations.consume(self, size)
+
     def _setup_target(self, channel, section, season, title, extension):
-        """Set up the target file to download."""
+        """Set up the target file to download.
+
+        If it's a retry, the same temporary file is used, so the download is resumed.
+        """
+        if self._target is not None:
+            return self._target
+
         # build where to save it
         downloaddir = config.get('downloaddir', '')
         channel = multiplatform.sanitize(channel)
@@ -104,10 +244,40 @@ class BaseDownloader:
             os.makedirs(dirsecc)
 
         tempf = fname + str(time.time())
+        self._target = fname, tempf
         return fname, tempf
 
+    def _finish(self, tempf, fname, expected_size=None, checksum=None):
+        """Verify the downloaded file, move it to its final name, and end.
+
+        If the file is broken it's removed and the download will start from scratch if
+        retried.
+        """
+        try:
+            integrity.check_size(tempf, expected_size)
+            integrity.check_container(tempf)
+        except integrity.IntegrityError as err:
+            self.log("Integrity check failed for %r: %s", tempf, err)
+            self._clean(tempf)
+            self._restart()
+            raise
+
+        self.log("Downloading done, renaming %r to %r", tempf, fname)
+        os.rename(tempf, fname)
+        self.checksum = checksum
+        self.deferred.callback(fname)
+
+    def _restart(self):
+        """Forget what was downloaded, so the next try starts from scratch."""
+        self._target = None
+
     def download(self, channel, section, season, title, url, cb_progress):
-        """Download an episode."""
+        """Download an episode.
+
+        It can be called again after a failure (getting a new deferred each time), to retry.
+        """
+        self.deferred = defer.Deferred()
+
         @defer.inline_callbacks
         def wrapper():
             """Wrapp real download and feed any exception through proper deferred."""
@@ -115,6 +285,8 @@ class BaseDownloader:
                 yield self._download(channel, section, season, title, url, cb_progress)
             except Exception as err:
                 self.deferred.errback(err)
+            finally:
+                diskspace.reservations.release(self)
         QtCore.QTimer.singleShot(50, wrapper)
 
     def _clean(self, filename):
@@ -132,31 +304,32 @@ class BaseDownloader:
 
 
 class _GenericDownloader(BaseDownloader):
-    """Episode downloader for a generic site that works with urllib2."""
+    """Episode downloader for a generic site, using the shared HTTP client."""
 
-    headers = {
-        'User-Agent': 'Mozilla/5.0',
-        'Accept': '*/*',
-    }
-    manager = QtNetwork.QNetworkAccessManager()
     file_extension = None  # to be overwritten by class child
 
     def __init__(self):
         super(_GenericDownloader, self).__init__()
         self._prev_progress = None
-        self.internal_downloader_deferred = None
+        self._received = 0
+        self._hasher = None
+        self.transfer = None
         self.log("Inited")
 
     def _shutdown(self):
         """Quit the download."""
         self.log("Shutdown finished")
 
+    def _restart(self):
+        """Forget what was downloaded, so the next try starts from scratch."""
+        super(_GenericDownloader, self)._restart()
+        self._received = 0
+
     def _cancel(self):
         """Cancel a download."""
-        if self.internal_downloader_deferred is not None:
+        if self.transfer is not None and not self.transfer.is_finished():
             self.log("Cancelled")
-            exc = CancelledError("Cancelled by user")
-            self.internal_downloader_deferred.errback(exc)
+            self.transfer.fail(CancelledError("Cancelled by user"))
 
     @defer.inline_callbacks
     def _download(self, canal, seccion, season, titulo, url, cb_progress):
@@ -166,12 +339,22 @@ class _GenericDownloader(BaseDownloader):
 
         # build where to save it
         fname, tempf = self._setup_target(canal, seccion, season, titulo, self.file_extension)
-        self.log("Downloading to temporal file %r", tempf)
-        fh = open(tempf, "wb")
+        if self._received and os.path.exists(tempf):
+            # a retry, continue from what was already received
+            self.log("Resuming download from byte %d to temporal file %r", self._received, tempf)
+            fh = open(tempf, "r+b")
+            fh.seek(self._received)
+            fh.truncate()
+        else:
+            self._received = 0
+            self._hasher = integrity.StreamHasher()
+            self.log("Downloading to temporal file %r", tempf)
+            fh = open(tempf, "wb")
 
         def report(dloaded, total):
             """Report download."""
-            if total == -1:
+            if total <= 0:
+                # unknown (or nothing to download at all)
                 m = "%d MB" % (dloaded // MB,)
             else:
                 size_mb = total // MB
@@ -181,49 +364,56 @@ class _GenericDownloader(BaseDownloader):
                 cb_progress(m)
                 self._prev_progress = m
 
-        def save():
-            """Save available bytes to disk."""
-            data = req.read(req.bytesAvailable())
+        def check_space(transfer):
+            """Check and reserve the space in disk, when the size is known."""
+            if transfer.offset != self._received:
+                # the server is sending everything again
+                self.log("Server does not support resuming, starting from zero")
+                fh.seek(0)
+                fh.truncate()
+                self._received = 0
+                self._hasher = integrity.StreamHasher()
+
+            remaining = None if transfer.total is None else transfer.total - transfer.offset
+            self._admit(remaining)
+            if diskspace.preallocate(fh, remaining):
+                # already taken from the free space in disk
+                diskspace.reservations.release(self)
+
+        def save(data):
+            """Save the received bytes to disk."""
             fh.write(data)
+            self._hasher.update(data)
+            self._received += len(data)
+            self._written(len(data))
 
-        request = QtNetwork.QNetworkRequest()
-        request.setUrl(QtCore.QUrl(url))
-        for hk, hv in self.headers.items():
-            request.setRawHeader(hk.encode(), hv.encode())
-
-        def end_ok():
-            """Finish Ok politely the deferred."""
-            if not self.internal_downloader_deferred.called:
-                self.internal_downloader_deferred.callback(True)
-
-        def end_fail(exc):
-            """Finish in error politely the deferred."""
-            if not self.internal_downloader_deferred.called:
-                self.internal_downloader_deferred.errback(exc)
-
-        deferred = self.internal_downloader_deferred = defer.Deferred()
-        req = self.manager.get(request)
-        req.downloadProgress.connect(report)
-        req.error.connect(end_fail)
-        req.readyRead.connect(save)
-        req.finished.connect(end_ok)
-
+        transfer = self.transfer = httpclient.Transfer(
+            url, offset=self._received, on_headers=check_space, on_data=save,
+            on_progress=report)
         try:
-            yield deferred
+            yield transfer.deferred
         except Exception as err:
-            self.log("Exception when waiting deferred: %s (request finished? %s)",
-                     err, req.isFinished())
+            self.log("Exception when waiting deferred: %s (transfer finished? %s)",
+                     err, transfer.is_finished())
             raise
         finally:
-            if not req.isFinished():
-                self.log("Aborting QNetworkReply")
-                req.abort()
+            if not transfer.is_finished():
+                self.log("Aborting transfer")
+                transfer.fail(CancelledError("Aborted"))
             fh.close()
 
-        # rename to final name and end
-        logger.info("Downloading done, renaming temp to %r", fname)
-        os.rename(tempf, fname)
-        self.deferred.callback(fname)
+        # only the content was saved (not the body of redirections and such), which is kept
+        # to continue from there if retried
+        if transfer.status not in (None, 200, 206):
+            raise NetworkError(0, transfer.status, "Unexpected response")
+
+        # verify, rename to final name and end
+        if transfer.total is not None and self._received != transfer.total:
+            self._clean(tempf)
+            self._restart()
+            raise integrity.IntegrityError("Received %d bytes, expected %d" % (
+                self._received, transfer.total))
+        self._finish(tempf, fname, transfer.total, self._hasher.checksum())
 
 
 class GenericAudioDownloader(_GenericDownloader):
@@ -270,7 +460,8 @@ class DeferredQueue(Queue):
 class ThreadedYT(Thread):
     """Use youtube downloader in a different thread."""
 
-    def __init__(self, url, fname, output_queue, must_quit, log, video_format=None):
+    def __init__(self, url, fname, output_queue, must_quit, log, video_format=None,
+                 admit=None, written=None):
         self.url = url
         self.fname = fname
         self.output_queue = output_queue
@@ -278,6 +469,11 @@ class ThreadedYT(Thread):
         self._prev_progress = None
         self.log = log
         self.video_format = video_format
+        self.admit = admit
+        self.written = written
+        self._written_per_file = {}
+        self.result_fname = None
+        self.checksum = None
         super(ThreadedYT, self).__init__()
 
     def _really_download(self):
@@ -286,6 +482,13 @@ class ThreadedYT(Thread):
 
         def report(info):
             """Report download."""
+            if self.written is not None:
+                # the downloaded bytes are per file (as several may be joined later)
+                filename = info.get('filename')
+                downloaded = info.get('downloaded_bytes') or 0
+                self.written(downloaded - self._written_per_file.get(filename, 0))
+                self._written_per_file[filename] = downloaded
+
             total = info['total_bytes']
             dloaded = info['downloaded_bytes']
             size_mb = total // MB
@@ -309,9 +512,26 @@ class ThreadedYT(Thread):
         if self.video_format:
             conf['format'] = self.video_format
 
+        # imported here as it's really slow, and only needed for some downloads
+        import youtube_dl
         with youtube_dl.YoutubeDL(conf) as ydl:
-            self.log("Threaded YT, about to download")
-            ydl.download([self.url])
+            if self.admit is None:
+                self.log("Threaded YT, about to download")
+                ydl.download([self.url])
+            else:
+                # get the info first, to know the size before downloading
+                info = ydl.extract_info(self.url, download=False)
+                self.admit(diskspace.estimate_from_info(info))
+                self.log("Threaded YT, about to download")
+                ydl.process_ie_result(info, download=True)
+
+        # youtube-dl may add an extension (merging formats), find the real file; its checksum
+        # is calculated here, as we don't control the writing, but at least not in the GUI thread
+        for candidate in (self.fname + '.mkv', self.fname + '.mp4', self.fname):
+            if os.path.exists(candidate):
+                self.result_fname = candidate
+                self.checksum = integrity.file_checksum(candidate)
+                break
         self.output_queue.put(DONE_TOKEN)
         self.log("Threaded YT, done")
 
@@ -356,7 +576,8 @@ class YoutubeDownloader(BaseDownloader):
         self.log("Downloading to temporal file %r", tempf)
 
         self.log("Download episode %r: browser started", url)
-        thyt = ThreadedYT(url, tempf, qinput, self.thyts_quit, self.log)
+        thyt = ThreadedYT(url, tempf, qinput, self.thyts_quit, self.log, admit=self._admit,
+                          written=self._written)
         thyt.start()
 
         # loop reading until finished
@@ -382,15 +603,10 @@ class YoutubeDownloader(BaseDownloader):
             # normal
             cb_progress(data)
 
-        # rename to proper name and finish
-        self.log("Downloading done, renaming temp to %r", fname)
-        try:
-            os.rename(tempf + '.mkv', fname)
-        except FileNotFoundError:
-            os.rename(tempf + '.mp4', fname)
-        except FileNotFoundError:
-            os.rename(tempf, fname)
-        self.deferred.callback(fname)
+        # verify, rename to proper name and finish
+        if thyt.result_fname is None:
+            raise integrity.IntegrityError("Downloaded file not found for %r" % (tempf,))
+        self._finish(thyt.result_fname, fname, checksum=thyt.checksum)
 
 
 class M3u8YTDownloader(YoutubeDownloader):
@@ -419,11 +635,15 @@ class M3u8YTDownloader(YoutubeDownloader):
         options = {
             'quiet': True
         }
+        import youtube_dl  # see the note in ThreadedYT about this import
         with youtube_dl.YoutubeDL(options) as ydl:
             info = ydl.extract_info(url, download=False)
             formats = info.get('formats', [info])
 
         video_format, audio_format = self._parse_formats(formats)
+        chosen = [f for f in formats if f['format_id'] in (video_format, audio_format)]
+        self._admit(diskspace.estimate_from_info(
+            dict(requested_formats=chosen, duration=info.get('duration'))))
 
         # start the threaded downloaded
         qinput = DeferredQueue()
@@ -435,7 +655,7 @@ class M3u8YTDownloader(YoutubeDownloader):
         self.log("Download episode %r: browser started", url)
         thyt = ThreadedYT(
             url, tempf, qinput, self.thyts_quit,
-            self.log, video_format + ' + ' + audio_format
+            self.log, video_format + ' + ' + audio_format, written=self._written
         )
         thyt.start()
 
@@ -482,13 +702,10 @@ class M3u8YTDownloader(YoutubeDownloader):
             # normal
             cb_progress(data)
 
-        # rename to proper name and finish
-        self.log("Downloading done, renaming %s to %r", tempf, fname)
-        try:
-            os.rename(tempf + '.mp4', fname)
-        except FileNotFoundError:
-            os.rename(tempf, fname)
-        self.deferred.callback(fname)
+        # verify, rename to proper name and finish
+        if thyt.result_fname is None:
+            raise integrity.IntegrityError("Downloaded file not found for %r" % (tempf,))
+        self._finish(thyt.result_fname, fname, checksum=thyt.checksum)
 
 
 # this is the entry point to get the downloaders for each type
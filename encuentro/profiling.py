@@ -0,0 +1,204 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Measure how long the different phases of a process take."""
+
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger('encuentro.profiling')
+
+# the start up profiler, only when the start up is being profiled (see StartupProfiler)
+startup = None
+
+# Python reports what costs each import only from 3.7
+IMPORT_TIMES_AVAILABLE = sys.version_info >= (3, 7)
+
+
+class PhaseTimer:
+    """Time the phases of a process, also counting the bytes and items each one handled.
+
+    Each measure is kept as a record (a dict with the phase, its target, the seconds, the
+    bytes and the items), which is also logged as JSON so it can be processed later.
+    """
+
+    def __init__(self, name, started=None):
+        self.name = name
+        self.records = []
+        self._started = time.perf_counter() if started is None else started
+
+    def add(self, phase, seconds, target=None, nbytes=0, items=0):
+        """Record a phase that was measured outside the timer."""
+        record = {
+            'process': self.name,
+            'phase': phase,
+            'target': target,
+            'seconds': round(seconds, 6),
+            'bytes': nbytes,
+            'items': items,
+        }
+        self.records.append(record)
+        logger.info("Phase timing: %s", json.dumps(record, sort_keys=True))
+        return record
+
+    @contextlib.contextmanager
+    def phase(self, phase, target=None):
+        """Measure the code inside the context.
+
+        A dict is given to the context to set the 'bytes' and 'items' handled, if known.
+        """
+        counts = {'bytes': 0, 'items': 0}
+        tini = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(phase, time.perf_counter() - tini, target, counts['bytes'], counts['items'])
+
+    def elapsed(self):
+        """Return the seconds since the timer was created."""
+        return time.perf_counter() - self._started
+
+    def summary(self):
+        """Return the totals per phase (in order of first appearance): seconds, bytes, items.
+
+        Note that the total seconds of a phase may be bigger than the real elapsed time,
+        if some of its measures happened at the same time.
+        """
+        totals = collections.OrderedDict()
+        for record in self.records:
+            seconds, nbytes, items = totals.get(record['phase'], (0, 0, 0))
+            totals[record['phase']] = (
+                seconds + record['seconds'], nbytes + record['bytes'], items + record['items'])
+        return totals
+
+    def report(self):
+        """Return all the records and the totals, to be dumped as JSON."""
+        return {
+            'process': self.name,
+            'elapsed': round(self.elapsed(), 6),
+            'records': self.records,
+            'summary': {
+                phase: {'seconds': round(seconds, 6), 'bytes': nbytes, 'items': items}
+                for phase, (seconds, nbytes, items) in self.summary().items()},
+        }
+
+
+class StartupProfiler:
+    """Measure the phases of the program start up, optionally also all the calls.
+
+    The different parts of the start up are measured with 'startup_phase', which does
+    nothing if this profiler is not set as the module's 'startup'.
+    """
+
+    def __init__(self, started, destination=None, cprofile_file=None):
+        self.timer = PhaseTimer('startup', started)
+        self.destination = destination
+        self.cprofile_file = cprofile_file
+        self.timer.add('bin', self.timer.elapsed())
+
+        self._profile = None
+        if cprofile_file:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def finish(self):
+        """All started; show the summary and dump the report (and the calls stats)."""
+        self.timer.add('total', self.timer.elapsed())
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.cprofile_file)
+            logger.info("Start up calls stats dumped to %r", self.cprofile_file)
+
+        print(self.format_summary())
+        if self.destination:
+            with open(self.destination, 'wt', encoding='utf8') as fh:
+                json.dump(self.timer.report(), fh, indent=4, sort_keys=True)
+                fh.write("\n")
+
+    def format_summary(self):
+        """Return the seconds (and items, if any) of each phase, to be shown to the user."""
+        lines = ["Start up phases:"]
+        for phase, (seconds, _, items) in self.timer.summary().items():
+            line = "%9.4f  %s" % (seconds, phase)
+            if items:
+                line += " (%d items)" % (items,)
+            lines.append(line)
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def startup_phase(phase, target=None):
+    """Measure the code inside the context as a start up phase, if profiling the start up.
+
+    Same than PhaseTimer.phase, a dict is given to the context to set the bytes and items.
+    """
+    if startup is None:
+        yield {'bytes': 0, 'items': 0}
+        return
+    with startup.timer.phase(phase, target) as counts:
+        yield counts
+
+
+def parse_import_times(output):
+    """Parse what Python reports with '-X importtime'.
+
+    Return a list of (module, self seconds, cumulative seconds, nesting level), in the
+    order Python reported them (the modules imported by one come before it).
+    """
+    costs = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            # the header
+            continue
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        costs.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, level))
+    return costs
+
+
+def import_costs(module):
+    """Measure what costs to import the module, in a new Python process (so all is cold).
+
+    The new process finds the modules where this one does, wherever it's run from.
+    """
+    if not IMPORT_TIMES_AVAILABLE:
+        raise RuntimeError("Measuring the imports needs Python 3.7 or newer")
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import ' + module]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    proc = subprocess.run(
+        cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    return parse_import_times(proc.stderr)
+
+
+def format_import_costs(costs, limit=25):
+    """Return a report of the modules that took longer to import (by their own time)."""
+    total = sum(self_seconds for _, self_seconds, _, _ in costs)
+    lines = ["Import total: %.3f seg (%d modules)" % (total, len(costs))]
+    lines.append("%9s %9s  %s" % ("self", "cumul", "module"))
+    heaviest = sorted(costs, key=lambda item: item[1], reverse=True)[:limit]
+    for name, self_seconds, cumulative, _ in heaviest:
+        lines.append("%9.4f %9.4f  %s" % (self_seconds, cumulative, name))
+    return "\n".join(lines)
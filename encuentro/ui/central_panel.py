@@ -42,9 +42,18 @@ from PyQt5.QtGui import (
     QPixmap,
     QTextDocument,
 )
-from PyQt5.QtCore import Qt, QSize, QAbstractTableModel
+from PyQt5.QtCore import (
+    QAbstractTableModel,
+    QObject,
+    QRunnable,
+    QSize,
+    QThreadPool,
+    QTimer,
+    Qt,
+    pyqtSignal,
+)
 
-from encuentro import data, image
+from encuentro import data, diskspace, download_queue, image, profiling, utils
 from encuentro.config import config, signal
 from encuentro.data import Status
 from encuentro.ui import remembering
@@ -52,6 +61,20 @@ from encuentro.ui.throbber import Throbber
 
 logger = logging.getLogger("encuentro.centralpanel")
 
+# how often to check if the downloads held for lack of disk space can go on (in ms)
+HELD_CHECK_PERIOD = 60 * 1000
+
+# how many images (already decoded and scaled) are kept in memory for the episode info
+PIXMAPS_CACHE_SIZE = 40
+
+# how many threads decode and scale the images
+IMAGE_DECODER_THREADS = 2
+
+# how many rows before and after the selected one get their images prefetched, and how
+# much to wait (in ms) after the selection or scroll changed to decide what to prefetch
+PREFETCH_AROUND = 5
+PREFETCH_DELAY = 300
+
 
 class DownloadsWidget(remembering.RememberingTreeWidget):
     """The downloads queue."""
@@ -65,12 +88,19 @@ class DownloadsWidget(remembering.RememberingTreeWidget):
         self.setColumnCount(len(_headers))
         self.setHeaderLabels(_headers)
 
-        self.queue = []
-        self.current = -1
+        self.queue = download_queue.DownloadQueue()
+        self.current = None
         self.downloading = False
 
         # connect the signals
         self.clicked.connect(self.on_signal_clicked)
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self.on_right_button)
+
+        # periodically check if the held downloads now fit in disk
+        self._held_timer = QTimer(self)
+        self._held_timer.timeout.connect(self._check_held)
+        self._held_timer.start(HELD_CHECK_PERIOD)
 
     def on_signal_clicked(self, _):
         """The view was clicked."""
@@ -83,40 +113,144 @@ class DownloadsWidget(remembering.RememberingTreeWidget):
         self.episodes_widget.episode_info.update(episode)
         self.episodes_widget.main_window.check_download_play_buttons()
 
-    def append(self, episode):
+    def on_right_button(self, point):
+        """Right button was pressed, build a menu to manage the queued episode."""
+        item = self.itemAt(point)
+        if item is None or item.episode_id not in self.queue:
+            return
+        episode_id = item.episode_id
+        entry = self.queue[episode_id]
+        mw = self.episodes_widget.main_window
+
+        menu = QMenu()
+        menu.addAction("Descargar &primero", lambda: self.move_to_front(episode_id))
+        menu.addAction("&Subir prioridad", lambda: self.change_priority(episode_id, 1))
+        menu.addAction("&Bajar prioridad", lambda: self.change_priority(episode_id, -1))
+        if entry.paused:
+            menu.addAction("&Reanudar", lambda: self.resume(episode_id))
+        else:
+            menu.addAction("P&ausar", lambda: self.pause(episode_id))
+        menu.addAction("Sacar de la &cola", lambda: mw.unqueue_download(entry.episode))
+        menu.exec_(self.viewport().mapToGlobal(point))
+
+    def _queued_text(self, entry):
+        """Build the status text for a queued episode."""
+        if entry.held is not None:
+            return "En espera: falta espacio en disco (%d MB)" % (entry.held // diskspace.MB,)
+        if entry.paused:
+            return "Pausado"
+        if entry.priority == download_queue.PRIORITY_NORMAL:
+            return "Encolado"
+        return "Encolado (prioridad %+d)" % (entry.priority,)
+
+    def _reposition(self, entry):
+        """Put (or move) the item in the widget to reflect its position in the queue."""
+        ordered = self.queue.ordered()
+        pos = ordered.index(entry)
+        current_index = self.indexOfTopLevelItem(entry.item)
+        if current_index != -1:
+            self.takeTopLevelItem(current_index)
+        if pos + 1 < len(ordered):
+            index = self.indexOfTopLevelItem(ordered[pos + 1].item)
+            self.insertTopLevelItem(index, entry.item)
+        else:
+            self.addTopLevelItem(entry.item)
+        entry.item.setText(1, self._queued_text(entry))
+
+    def append(self, episode, priority=download_queue.PRIORITY_NORMAL, paused=False):
         """Append an episode to the downloads list."""
         # add to the list in the GUI
         item = QTreeWidgetItem((episode.composed_title, "Encolado"))
         item.episode_id = episode.episode_id
-        self.queue.append((episode, item))
-        self.addTopLevelItem(item)
+        entry = self.queue.add(episode, item, priority, paused)
+        self._reposition(entry)
         self.setCurrentItem(item)
 
         # fix episode state
         episode.state = Status.waiting
 
+    def move_to_front(self, episode_id):
+        """Make the episode the next one to be downloaded."""
+        entry = self.queue[episode_id]
+        was_paused = entry.paused
+        self.queue.move_to_front(episode_id)
+        self._reposition(entry)
+        if was_paused:
+            self.episodes_widget.main_window.start_downloads()
+
+    def change_priority(self, episode_id, delta):
+        """Increase or decrease the priority of the episode."""
+        entry = self.queue[episode_id]
+        self.queue.set_priority(episode_id, entry.priority + delta)
+        self._reposition(entry)
+
+    def pause(self, episode_id):
+        """Hold the episode in the queue."""
+        entry = self.queue[episode_id]
+        self.queue.pause(episode_id)
+        self._reposition(entry)
+
+    def resume(self, episode_id):
+        """Release the held episode."""
+        entry = self.queue[episode_id]
+        self.queue.resume(episode_id)
+        self._reposition(entry)
+        self.episodes_widget.main_window.start_downloads()
+
+    def hold(self, needed):
+        """The current download doesn't fit in disk, put it back in the queue until it does."""
+        episode, item = self.current.episode, self.current.item
+        entry = self.queue.add(episode, item, self.current.priority, paused=True)
+        entry.held = needed
+        self._reposition(entry)
+        episode.state = Status.waiting
+        self.episodes_widget.refresh(episode.episode_id)
+        self.downloading = False
+
+    def _check_held(self):
+        """Resume the held downloads that now fit in disk."""
+        held = [entry for entry in self.queue.ordered() if entry.held is not None]
+        if not held:
+            return
+        avail = diskspace.available(config.get('downloaddir', ''))
+        resumed = False
+        for entry in held:
+            if entry.held <= avail:
+                logger.info("Resuming held download %s, now fits in disk", entry.episode_id)
+                avail -= entry.held
+                self.queue.resume(entry.episode_id)
+                self._reposition(entry)
+                resumed = True
+        if resumed:
+            self.episodes_widget.main_window.start_downloads()
+
     def prepare(self):
-        """Set up everything for next download."""
+        """Set up everything for next download, return None if nothing to download."""
+        entry = self.queue.pop()
+        if entry is None:
+            return
         self.downloading = True
-        self.current += 1
-        episode, _ = self.queue[self.current]
-        episode.state = Status.downloading
-        return episode
+        self.current = entry
+        entry.episode.state = Status.downloading
+        return entry.episode
 
     def start(self):
         """Download started."""
-        episode, item = self.queue[self.current]
-        item.setText(1, "Comenzando")
-        episode.state = Status.downloading
+        self.current.item.setText(1, "Comenzando")
+        self.current.episode.state = Status.downloading
 
     def progress(self, progress):
         """Advance the progress indicator."""
-        _, item = self.queue[self.current]
-        item.setText(1, "Descargando: %s" % progress)
+        self.current.item.setText(1, "Descargando: %s" % progress)
+
+    def retrying(self, attempt, max_attempts, delay, error):
+        """The download failed but will be retried after a while."""
+        self.current.item.setText(1, "Reintento %d/%d en %ds (%s)" % (
+            attempt + 1, max_attempts, round(delay), error.__class__.__name__))
 
     def end(self, error=None):
         """Mark episode as downloaded."""
-        episode, item = self.queue[self.current]
+        episode, item = self.current.episode, self.current.item
         if error is None:
             # downloaded OK
             gui_msg = "Terminado ok"
@@ -133,23 +267,19 @@ class DownloadsWidget(remembering.RememberingTreeWidget):
 
     def cancel(self):
         """The download is being cancelled."""
-        episode, item = self.queue[self.current]
-        item.setText(1, "Cancelado")
-        episode.state = Status.none
+        self.current.item.setText(1, "Cancelado")
+        self.current.episode.state = Status.none
 
     def unqueue(self, episode):
         """Remove the indicated episode from the queue."""
         episode.state = Status.none
 
-        # search for the item, adjust the queue and remove it from the widget
-        for pos, (queued_episode, item) in enumerate(self.queue):
-            if queued_episode.episode_id == episode.episode_id:
-                break
-        else:
-            raise ValueError(
-                "Couldn't find episode to unqueue: " + str(episode))
-        del self.queue[pos]
-        self.takeTopLevelItem(pos)
+        # get the entry, and remove its item from the widget
+        try:
+            entry = self.queue.remove(episode.episode_id)
+        except KeyError:
+            raise ValueError("Couldn't find episode to unqueue: " + str(episode))
+        self.takeTopLevelItem(self.indexOfTopLevelItem(entry.item))
 
         # as we removed an item, the cursor goes to other (if any), fix the rest of the interface
         item = self.currentItem()
@@ -158,8 +288,7 @@ class DownloadsWidget(remembering.RememberingTreeWidget):
 
     def pending(self):
         """Return the pending downloads quantity (including current)."""
-        # remaining after current one
-        q = len(self.queue) - self.current - 1
+        q = len(self.queue)
         # if we're still downloading current one, add it to the count
         if self.downloading:
             q += 1
@@ -167,16 +296,18 @@ class DownloadsWidget(remembering.RememberingTreeWidget):
 
     def save_state(self):
         """Save state for pending downloads."""
-        p = self.pending()
-        if p > 0:
-            pending_ids = [e.episode_id for e, _ in self.queue[-p:]]
-        else:
-            pending_ids = []
-        config[config.SYSTEM]['pending_ids'] = pending_ids
+        entries = self.queue.ordered()
+        if self.downloading:
+            entries.insert(0, self.current)
+        config[config.SYSTEM]['pending_ids'] = [e.episode_id for e in entries]
+        # held ones are not saved as paused, so they are checked again on next start
+        config[config.SYSTEM]['pending_sched'] = {
+            e.episode_id: (e.priority, e.paused and e.held is None) for e in entries}
 
     def load_pending(self):
         """Queue the pending downloads."""
         loaded_pending_ids = config[config.SYSTEM].get('pending_ids', [])
+        loaded_sched = config[config.SYSTEM].get('pending_sched', {})
 
         main_window = self.episodes_widget.main_window
         for episode_id in loaded_pending_ids:
@@ -186,7 +317,9 @@ class DownloadsWidget(remembering.RememberingTreeWidget):
                 logger.debug("Tried to load pending %r, didn't find it", episode_id)
             else:
                 logger.info("Queuing pending episode %s", episode)
-                main_window.queue_download(episode)
+                priority, paused = loaded_sched.get(
+                    episode_id, (download_queue.PRIORITY_NORMAL, False))
+                main_window.queue_download(episode, priority=priority, paused=paused)
 
 
 class HTMLDelegate(QStyledItemDelegate):
@@ -263,7 +396,9 @@ class EpisodesWidgetModel(QAbstractTableModel):
         self._filter_text = ''
         self._filter_only_downloaded = False
         self._filter_channel = None
-        self.episodes, self.pos_map = self._load_episodes()
+        with profiling.startup_phase('load_episodes') as counts:
+            self.episodes, self.pos_map = self._load_episodes()
+            counts['items'] = len(self.episodes)
 
     def _load_episodes(self):
         """Fill episodes own data."""
@@ -396,6 +531,48 @@ class EpisodesWidgetView(remembering.RememberingTableView):
         sm = self.selectionModel()
         sm.selectionChanged.connect(self.on_change)
 
+        # prefetch the images near the selection and in the visible rows, once the user
+        # stopped moving around
+        self._prefetch_timer = QTimer()
+        self._prefetch_timer.setSingleShot(True)
+        self._prefetch_timer.setInterval(PREFETCH_DELAY)
+        self._prefetch_timer.timeout.connect(self._prefetch)
+        sm.selectionChanged.connect(self._prefetch_timer.start)
+        self.verticalScrollBar().valueChanged.connect(self._prefetch_timer.start)
+        self._model.layoutChanged.connect(self._prefetch_timer.start)
+
+    def _prefetch(self):
+        """Prefetch the images for the rows around the selected one and the visible ones.
+
+        The rows closer to the selection go first. The selected episode itself is not
+        included, as its image is already being retrieved to be shown.
+        """
+        episodes = self._model.episodes
+        rows = []
+        selected = self.selectionModel().selectedRows()
+        if len(selected) == 1:
+            base = selected[0].row()
+            for delta in range(1, PREFETCH_AROUND + 1):
+                rows.extend((base + delta, base - delta))
+        else:
+            base = None
+
+        first = self.rowAt(0)
+        if first != -1:
+            last = self.rowAt(self.viewport().height() - 1)
+            if last == -1:
+                last = len(episodes) - 1
+            rows.extend(range(first, last + 1))
+
+        urls = []
+        for row in rows:
+            if row == base or not 0 <= row < len(episodes):
+                continue
+            episode = episodes[row]
+            if episode.image_data is None and episode.has_image_url:
+                urls.append(episode.image_url)
+        self.episode_info.prefetcher.set_wanted(urls)
+
     def show_episode(self, episode_id):
         """Show the row for the requested episode, if possible (it may be filtered out)."""
         row = self._model.pos_map.get(episode_id)
@@ -462,12 +639,14 @@ class EpisodesWidgetView(remembering.RememberingTableView):
         episode = self.main_window.programs_data[episode_id]
         menu = QMenu()
         mw = self.main_window
+        state = episode.state
         act_play = menu.addAction("&Reproducir", lambda: mw.play_episode(episode))
         act_cancel = menu.addAction("&Cancelar descarga", lambda: mw.cancel_download(episode))
         act_download = menu.addAction("&Descargar", lambda: mw.queue_download(episode))
+        act_verify = menu.addAction("&Verificar archivo", lambda: mw.verify_episode(episode))
+        act_verify.setEnabled(state == Status.downloaded)
 
         # set menu options according status
-        state = episode.state
         if state == Status.downloaded:
             act_play.setEnabled(True)
             act_cancel.setEnabled(False)
@@ -495,6 +674,40 @@ class EpisodesWidgetView(remembering.RememberingTableView):
         self._model.reload_episodes()
 
 
+class _ImageDecodedSignal(QObject):
+    """Bring the decoded images from the worker threads to the main one."""
+
+    decoded = pyqtSignal(int, object, QImage)
+
+
+class _ImageDecoder(QRunnable):
+    """Decode an image (from a file or its data), and maybe scale it, in a worker thread.
+
+    If when the worker is ready to start the image is not needed anymore, nothing is done.
+    """
+
+    def __init__(self, token, key, source, scale, is_needed, signal):
+        super(_ImageDecoder, self).__init__()
+        self.token = token
+        self.key = key
+        self.source = source
+        self.scale = scale
+        self.is_needed = is_needed
+        self.signal = signal
+
+    def run(self):
+        """Do the work."""
+        if not self.is_needed(self.token):
+            return
+        if isinstance(self.source, bytes):
+            qimage = QImage.fromData(self.source)
+        else:
+            qimage = QImage(self.source)
+        if self.scale:
+            qimage = qimage.scaled(image.DISPLAY_WIDTH, image.DISPLAY_HEIGHT, Qt.KeepAspectRatio)
+        self.signal.decoded.emit(self.token, self.key, qimage)
+
+
 class EpisodeInfo(QWidget):
     """Show the episode at the right."""
     def __init__(self, main_window):
@@ -513,7 +726,18 @@ class EpisodeInfo(QWidget):
         self.image_episode = QLabel()
         self.image_episode.hide()
         layout.addWidget(self.image_episode, alignment=Qt.AlignCenter)
-        self.get_image = image.ImageGetter(self.image_episode_loaded).get_image
+        self.image_getter = image.ImageGetter(self.image_episode_loaded)
+        self.get_image = self.image_getter.get_image
+        self.prefetcher = image.Prefetcher(self.image_getter)
+        self._pixmaps = utils.LRUCache(PIXMAPS_CACHE_SIZE)
+
+        # the images are decoded in other threads; the token identifies the last image
+        # requested, so the ones requested before are not shown (or even decoded)
+        self._decode_token = 0
+        self._decoder_pool = QThreadPool()
+        self._decoder_pool.setMaxThreadCount(IMAGE_DECODER_THREADS)
+        self._decoded_signal = _ImageDecodedSignal()
+        self._decoded_signal.decoded.connect(self._image_decoded)
 
         # text area
         self.text_edit = QTextEdit("Seleccionar un programa para ver aquí la info.")
@@ -532,14 +756,35 @@ class EpisodeInfo(QWidget):
         if self.current_episode != episode_id:
             return
 
-        # load the image and show it
-        pixmap = QPixmap(image_path)
-        pixmap = pixmap.scaled(720, 540, Qt.KeepAspectRatio)
+        self._show_image(image_path, image_path, scale=True)
+
+    def _show_image(self, key, source, scale):
+        """Show the image if already decoded, else decode it (and maybe scale) in other thread."""
+        pixmap = self._pixmaps.get(key)
+        if pixmap is not None:
+            self._show_pixmap(pixmap)
+            return
 
+        self._decode_token += 1
+        decoder = _ImageDecoder(self._decode_token, key, source, scale,
+                                self._is_decode_needed, self._decoded_signal)
+        self._decoder_pool.start(decoder)
+
+    def _is_decode_needed(self, token):
+        """Tell if the image is still the last one requested (called from other threads)."""
+        return token == self._decode_token
+
+    def _image_decoded(self, token, key, qimage):
+        """An image was decoded; keep it, and show it if it's still the one needed."""
+        pixmap = QPixmap.fromImage(qimage)
+        self._pixmaps[key] = pixmap
+        if token == self._decode_token:
+            self._show_pixmap(pixmap)
+
+    def _show_pixmap(self, pixmap):
+        """Show the image, instead of the throbber."""
         self.image_episode.setPixmap(pixmap)
         self.image_episode.show()
-
-        # hide the throbber
         self.throbber.hide()
 
     def clear(self, msg):
@@ -557,16 +802,19 @@ class EpisodeInfo(QWidget):
             if self.current_episode != episode.episode_id:
                 return
 
+        if self.current_episode != episode.episode_id:
+            # any image being decoded for other episode is not needed anymore
+            self._decode_token += 1
         self.current_episode = episode.episode_id
 
         # image
         if episode.image_data is not None:
-            # have the image data already!!
-            qimg = QImage.fromData(episode.image_data)
-            pixmap = QPixmap.fromImage(qimg)
-            self.image_episode.setPixmap(pixmap)
-            self.image_episode.show()
-        elif episode.image_url is not None:
+            # have the image data already!! (and maybe even decoded)
+            self.image_episode.hide()
+            self.throbber.show()
+            key = ('data', hash(episode.image_data))
+            self._show_image(key, episode.image_data, scale=False)
+        elif episode.has_image_url:
             # this must be before the get_image call, as it may call
             # immediately to image_episode_loaded (showing the image and
             # hiding the throber)
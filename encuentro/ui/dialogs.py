@@ -21,6 +21,7 @@ from PyQt5.QtWidgets import (
     QDialogButtonBox,
     QLabel,
     QPlainTextEdit,
+    QProgressBar,
     QPushButton,
     QVBoxLayout,
 )
@@ -72,6 +73,9 @@ class UpdateDialog(QDialog):
         self.text = QPlainTextEdit()
         self.text.setReadOnly(True)
         vbox.addWidget(self.text)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.hide()
+        vbox.addWidget(self.progress_bar)
 
         bbox = QDialogButtonBox(QDialogButtonBox.Cancel)
         bbox.rejected.connect(self.reject)
@@ -81,6 +85,12 @@ class UpdateDialog(QDialog):
         """Append some text in the dialog."""
         self.text.appendPlainText(text.strip())
 
+    def progress(self, done, total):
+        """Show the progress of the current step."""
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.progress_bar.setVisible(done < total)
+
     def closeEvent(self, event):
         """It was closed."""
         self.closed = True
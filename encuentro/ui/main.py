@@ -16,12 +16,13 @@
 
 """The main window."""
 
+import json
 import logging
 import os
-import datetime as dt
 
 import defer
 
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import (
     QAction,
     QCheckBox,
@@ -42,10 +43,21 @@ from PyQt5.QtGui import (
     QKeySequence,
 )
 
-from encuentro import multiplatform, data, update
+from encuentro import (
+    data,
+    diskspace,
+    httpclient,
+    integrity,
+    multiplatform,
+    profiling,
+    update,
+    utils,
+    warmup,
+)
 from encuentro.config import config, signal
 from encuentro.data import Status
-from encuentro.network import CancelledError, all_downloaders
+from encuentro.download_queue import PRIORITY_NORMAL
+from encuentro.network import CancelledError, RetryPolicy, all_downloaders
 from encuentro.notify import notify
 from encuentro.ui import (
     central_panel,
@@ -89,7 +101,7 @@ class MainUI(remembering.RememberingMainWindow):
 
     _programs_file = os.path.join(multiplatform.data_dir, 'encuentro.data')
 
-    def __init__(self, version, app_quit, update_source):
+    def __init__(self, version, app_quit, update_source, profile_update=None):
         super(MainUI, self).__init__()
         self.app_quit = app_quit
         self.finished = False
@@ -102,36 +114,48 @@ class MainUI(remembering.RememberingMainWindow):
         self._touch_config()
 
         # finish all gui stuff
-        self.big_panel = central_panel.BigPanel(self)
+        with profiling.startup_phase('big_panel'):
+            self.big_panel = central_panel.BigPanel(self)
         self.episodes_list = self.big_panel.episodes
         self.episodes_download = self.big_panel.downloads_widget
         self.episode_channels = [CHANNELS_ALL] + sorted(
             set(e.channel for e in self.episodes_list._model.episodes if e.channel))
         self.setCentralWidget(self.big_panel)
 
+        # the background updates are done later, when the UI is idle; this needs to exist
+        # before the wizard, which may trigger an update
+        self.update_scheduler = update.UpdateScheduler(self, update_source)
+
         # the setting of menubar should be almost in the end, because it may
         # trigger the wizard, which needs big_panel and etc.
         self.action_play = self.action_download = None
         self.filter_line = self.filter_cbox = self.needsomething_alert = None
-        self._menubar()
-
-        systray.show(self)
-
-        if config.get('autorefresh'):
-            ue = update.UpdateEpisodes(self, update_source)
-            ue.background()
-        else:
-            # refresh data if never done before or if last
-            # update was 7 days ago
-            last_refresh = config.get('autorefresh_last_time')
-            if last_refresh is None or (
-                    dt.datetime.now() - last_refresh > dt.timedelta(7)):
-                ue = update.UpdateEpisodes(self, update_source)
-                ue.background()
-
-        self.show()
-
-        self.episodes_download.load_pending()
+        with profiling.startup_phase('menubar'):
+            self._menubar()
+
+        with profiling.startup_phase('systray'):
+            systray.show(self)
+
+        with profiling.startup_phase('show'):
+            self.show()
+
+        with profiling.startup_phase('load_pending'):
+            self.episodes_download.load_pending()
+
+        # nothing is done in background if profiling, as the program quits after that
+        background = profile_update is None and profiling.startup is None
+        if background:
+            self.update_scheduler.start()
+        elif profile_update is not None:
+            self.update_scheduler.profile(
+                lambda report: self._profile_finished(profile_update, report))
+
+        # get the images into the cache while the user is not doing anything, if wanted
+        self.images_warmup = None
+        if config.get('images-warmup') and background:
+            self.images_warmup = warmup.IdleWarmup(
+                self.episodes_list.episode_info.image_getter, self.programs_data,
+                self.update_scheduler)
         logger.debug("Main UI started ok")
 
     def _touch_config(self):
@@ -150,6 +174,8 @@ class MainUI(remembering.RememberingMainWindow):
             config.pop('cols_width', None)
             config.pop('cols_order', None)
             config.pop('selected_row', None)
+        if self.programs_data.forget_backends_state:
+            config[config.SYSTEM].pop(update.BACKENDS_STATE, None)
 
     def have_metadata(self):
         """Return if metadata is needed."""
@@ -288,6 +314,13 @@ class MainUI(remembering.RememberingMainWindow):
         config.save()
         self.finished = True
 
+        update_scheduler = getattr(self, 'update_scheduler', None)
+        if update_scheduler is not None:
+            update_scheduler.stop()
+        images_warmup = getattr(self, 'images_warmup', None)
+        if images_warmup is not None:
+            images_warmup.stop()
+
         programs_data = getattr(self, 'programs_data', None)
         if programs_data is not None:
             programs_data.save()
@@ -295,10 +328,24 @@ class MainUI(remembering.RememberingMainWindow):
         # shutdown all the downloaders
         for downloader in self.downloaders.values():
             downloader.shutdown()
+        logger.info("HTTP client stats: %s", httpclient.client.report())
 
         # bye bye
         self.app_quit()
 
+    def _profile_finished(self, destination, report):
+        """Dump the timings of the profiled update, and quit."""
+        dumped = json.dumps(report, indent=4, sort_keys=True)
+        if destination == '-':
+            print(dumped)
+        else:
+            with open(destination, 'wt', encoding='utf8') as fh:
+                fh.write(dumped + "\n")
+        logger.info("Update profiled, quitting")
+
+        # not right away, as this may happen even before the event loop is started
+        QTimer.singleShot(0, self.shutdown)
+
     def on_close(self, _):
         """Close signal."""
         if self._should_close():
@@ -362,8 +409,7 @@ class MainUI(remembering.RememberingMainWindow):
 
     def refresh_episodes(self, _=None):
         """Update and refresh episodes."""
-        ue = update.UpdateEpisodes(self, self.update_source)
-        ue.interactive()
+        self.update_scheduler.refresh_now()
 
     def download_episode(self, _=None):
         """Download the episode(s)."""
@@ -372,8 +418,7 @@ class MainUI(remembering.RememberingMainWindow):
             episode = self.programs_data[episode_id]
             self.queue_download(episode)
 
-    @defer.inline_callbacks
-    def queue_download(self, episode):
+    def queue_download(self, episode, priority=PRIORITY_NORMAL, paused=False):
         """User indicated to download something."""
         logger.debug("Download requested of %s", episode)
         if episode.state != Status.none:
@@ -382,20 +427,30 @@ class MainUI(remembering.RememberingMainWindow):
             return
 
         # queue
-        self.episodes_download.append(episode)
+        self.episodes_download.append(episode, priority, paused)
         self.episodes_list.episode_info.update(episode)
         self.check_download_play_buttons()
+        self.start_downloads()
+
+    @defer.inline_callbacks
+    def start_downloads(self):
+        """Download all that is available in the queue, if not already doing it."""
         if self.episodes_download.downloading:
             return
 
         logger.debug("Downloads: starting")
-        while self.episodes_download.pending():
+        while True:
             episode = self.episodes_download.prepare()
+            if episode is None:
+                break
             try:
                 filename, episode = yield self._episode_download(episode)
             except CancelledError:
                 logger.debug("Got a CancelledError!")
                 self.episodes_download.end(error="Cancelado")
+            except diskspace.NotEnoughSpace as e:
+                logger.warning("Holding download of %s: %s", episode.episode_id, e)
+                self.episodes_download.hold(e.needed)
             except Exception as e:
                 err_type = e.__class__.__name__
                 notify(err_type, str(e))
@@ -424,12 +479,28 @@ class MainUI(remembering.RememberingMainWindow):
         downloader_class = all_downloaders[episode.downtype]
         downloader = self.downloaders[episode.episode_id] = downloader_class()
         season = getattr(episode, 'season', None)  # wasn't always there
-        downloader.download(episode.channel, episode.section, season, episode.title,
-                            episode.url, self.episodes_download.progress)
+        policy = RetryPolicy.from_config()
+        attempt = 0
         try:
-            fname = yield downloader.deferred
+            while True:
+                attempt += 1
+                downloader.download(episode.channel, episode.section, season, episode.title,
+                                    episode.url, self.episodes_download.progress)
+                try:
+                    fname = yield downloader.deferred
+                except Exception as err:
+                    if downloader.cancelled or not policy.should_retry(err, attempt):
+                        raise
+                    delay = policy.next_delay(attempt)
+                    logger.warning("Download of %s failed (attempt %d), retrying in %.1fs: %r",
+                                   episode.episode_id, attempt, delay, err)
+                    self.episodes_download.retrying(attempt, policy.max_attempts, delay, err)
+                    yield downloader.wait(delay)
+                else:
+                    break
         finally:
             self.downloaders.pop(episode.episode_id, None)
+        episode.checksum = downloader.checksum
         episode_name = "%s - %s - %s" % (episode.channel, episode.section, episode.composed_title)
         notify("Descarga finalizada", episode_name)
         defer.return_value((fname, episode))
@@ -497,6 +568,27 @@ class MainUI(remembering.RememberingMainWindow):
             episode.state = Status.none
             self.episodes_list.set_color(episode)
 
+    @defer.inline_callbacks
+    def verify_episode(self, episode):
+        """Verify that the downloaded file is still the same that was downloaded."""
+        downloaddir = config.get('downloaddir', '')
+        filename = os.path.join(downloaddir, episode.filename)
+        logger.info("Verification requested of %s", episode)
+        if not os.path.exists(filename):
+            msg = "No se encontró el archivo descargado: " + repr(filename)
+        elif episode.checksum is None:
+            msg = ("No hay información para verificar este archivo "
+                   "(se descargó con una versión vieja).")
+        else:
+            ok = yield utils.run_in_thread(integrity.verify_checksum, filename, episode.checksum)
+            if ok:
+                msg = "El archivo está completo y sin modificaciones."
+            else:
+                msg = ("¡El archivo está dañado o fue modificado! "
+                       "Puede borrarlo y descargarlo de nuevo.")
+        logger.info("Verification result for %s: %s", episode.episode_id, msg)
+        self.show_message('Verificación', msg)
+
     def cancel_download(self, episode):
         """Cancel the downloading of an episode."""
         logger.info("Cancelling download of %s", episode)
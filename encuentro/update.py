@@ -16,24 +16,73 @@
 
 """Update the episodes metadata."""
 
-import bz2
+import hashlib
 import json
 import logging
 import os
+import random
+import time
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import defer
 
+from PyQt5.QtCore import QEvent, QObject, QTimer
 from PyQt5.QtWidgets import QApplication
 
-from encuentro import utils
+from encuentro import httpclient, metadata, profiling, utils
 from encuentro.config import config
 from encuentro.ui import dialogs
 
 # main entry point to download all backends data
 BACKENDS_BASE_URL = "http://www.taniquetil.com.ar/encuentro/"
-BACKENDS_LIST = "backends-v08.list"
+BACKENDS_LIST = "backends-v09.list"
+
+# how many backend files are downloaded at the same time
+BACKENDS_CONCURRENCY = 3
+
+# where the validators and hashes of the last merged backend files are kept, in the config
+BACKENDS_STATE = 'backends_state'
+
+# how frequently the episodes are refreshed in background (if autorefresh is set or not)
+REFRESH_PERIOD = timedelta(days=1)
+REFRESH_PERIOD_NO_AUTO = timedelta(days=7)
+
+# a random extra time for the next refresh, up to this fraction of the period, so all the
+# clients don't hit the server at the same time
+REFRESH_JITTER = 0.1
+
+# how long to wait before retrying an update that could not be completed (e.g. offline),
+# doubled on each consecutive failure up to the maximum
+RETRY_DELAY = timedelta(minutes=5)
+MAX_RETRY_DELAY = timedelta(hours=6)
+
+# seconds to wait after start, and without user input, before a background update
+STARTUP_DELAY = 10
+IDLE_TIME = 5
+
+# how frequently (in milliseconds) the scheduler checks if it's time to update
+SCHEDULER_CHECK_PERIOD = 5 * 1000
+
+# how much a background update can be postponed because of active downloads
+MAX_DOWNLOADS_POSTPONE = timedelta(hours=1)
+
+# the user events that mean the UI is not idle
+_INPUT_EVENTS = {
+    QEvent.KeyPress, QEvent.MouseButtonPress, QEvent.MouseButtonDblClick, QEvent.Wheel,
+}
+
+# how the timed phases of the update are shown to the user
+PHASES_LABELS = [
+    ('backends_list', "lista de backends"),
+    ('download', "descargas"),
+    ('decompress', "descompresión"),
+    ('parse', "interpretación"),
+    ('merge', "conciliación"),
+    ('reload', "recarga de la lista"),
+    ('save', "grabación"),
+    ('total', "total"),
+]
 
 logger = logging.getLogger('encuentro.update')
 
@@ -41,40 +90,127 @@ logger = logging.getLogger('encuentro.update')
 class UpdateEpisodes:
     """Update the episodes info."""
 
-    def __init__(self, main_window, update_source):
+    def __init__(self, main_window, update_source, concurrency=BACKENDS_CONCURRENCY):
         self.main_window = main_window
         self.update_source = update_source
+        self.concurrency = concurrency
+        self.timer = None
 
     def background(self):
-        """Trigger an update in background."""
-        self._update()
+        """Trigger an update in background; return a deferred fired when finished."""
+        return self._update()
 
     def interactive(self):
-        """Update episodes interactively."""
+        """Update episodes interactively; return a deferred fired when finished."""
         dialog = dialogs.UpdateDialog()
         dialog.show()
-        self._update(dialog)
+        return self._update(dialog)
 
     @defer.inline_callbacks
-    def _get(self, filename):
-        """Get the content from the server or a local source."""
+    def _get(self, filename, validators=None, phase='download'):
+        """Get the content from the server or a local source.
+
+        If the validators of a previous download are given (ETag and Last-Modified), the
+        server is asked to send the content only if it changed; the content is None if it
+        didn't. Return the content and the validators of what was received.
+        """
+        with self.timer.phase(phase, filename) as counts:
+            content, validators = yield self._get_content(filename, validators)
+            if content is not None:
+                counts['bytes'] = len(content)
+        defer.return_value((content, validators))
+
+    @defer.inline_callbacks
+    def _get_content(self, filename, validators):
+        """Really get the content, see '_get'."""
         if self.update_source is None:
             # from the server
             url = BACKENDS_BASE_URL + filename
             logger.debug("Getting content from url %r", url)
-            _, content = yield utils.download(url)
+            headers = {}
+            if validators:
+                if validators.get('etag'):
+                    headers['If-None-Match'] = validators['etag']
+                if validators.get('last_modified'):
+                    headers['If-Modified-Since'] = validators['last_modified']
+            response = yield httpclient.fetch(url, headers)
+            if response.status == 304:
+                logger.debug("Content not modified for url %r", url)
+                content = None
+            else:
+                content = response.data
+                validators = {
+                    'etag': response.headers.get('etag'),
+                    'last_modified': response.headers.get('last-modified'),
+                }
         else:
             # from a local source
             filepath = os.path.join(self.update_source, filename)
             logger.debug("Getting content from filepath %r", filepath)
             with open(filepath, 'rb') as fh:
                 content = fh.read()
+            validators = None
 
-        defer.return_value(content)
+        defer.return_value((content, validators))
+
+    @defer.inline_callbacks
+    def _get_backend(self, filename, options, previous):
+        """Get what's needed to update a backend: a delta if possible, else the full snapshot.
+
+        The delta is used if the backend has a manifest offering one from the version that
+        was merged before. The snapshot is downloaded in the compact binary catalog format
+        if offered, and in the faster to decompress of the codecs offered by the backend
+        (all this is indicated by the extension of the file).
+
+        Return the kind of content ('delta' or 'snapshot'), the extension of its file, the
+        content itself (None if nothing changed), and the state to remember if it's merged.
+        """
+        version = None
+        manifest_name = options.get('manifest')
+        if manifest_name is not None:
+            try:
+                raw_manifest, _ = yield self._get(manifest_name)
+                manifest = json.loads(raw_manifest.decode('utf-8'))
+                version = manifest['version']
+            except Exception as err:
+                logger.warning("Problem getting manifest %r, using the snapshot: %s",
+                               manifest_name, err)
+            else:
+                if version == previous.get('version'):
+                    defer.return_value(('delta', None, None, previous))
+                delta_name = manifest['deltas'].get(str(previous.get('version')))
+                if delta_name is not None:
+                    try:
+                        content, _ = yield self._get(delta_name)
+                    except Exception as err:
+                        logger.warning("Problem getting delta %r, using the snapshot: %s",
+                                       delta_name, err)
+                    else:
+                        extension = os.path.splitext(delta_name)[1][1:]
+                        defer.return_value(('delta', extension, content, {'version': version}))
+
+        basename, extension = os.path.splitext(filename)
+        extension = extension[1:]
+        if 'codecs' in options:
+            extension = metadata.choose_codec(options['codecs'].split(','))
+        if 'ecat' in options.get('formats', '').split(','):
+            extension = 'ecat.' + extension
+        logger.debug("Getting %r as %r", filename, extension)
+        content, validators = yield self._get(basename + '.' + extension, previous)
+        if content is None:
+            # not modified in the server
+            state = dict(previous, version=version)
+        else:
+            state = dict(validators or {}, version=version,
+                         hash=hashlib.sha256(content).hexdigest())
+            if state['hash'] == previous.get('hash'):
+                content = None
+        defer.return_value(('snapshot', extension, content, state))
 
     @defer.inline_callbacks
     def _update(self, dialog=None):
         """Update the content from source, being it server or something indicated at start."""
+        self.timer = timer = profiling.PhaseTimer('update')
         if dialog:
             # when loading from disk we won't free the CPU much, so let's
             # leave some time for Qt to work (here on start and on each message below)
@@ -98,7 +234,7 @@ class UpdateEpisodes:
         logger.info("Downloading backend list")
         tell_user("Descargando la lista de backends...")
         try:
-            backends_file = yield self._get(BACKENDS_LIST)
+            backends_file, _ = yield self._get(BACKENDS_LIST, phase='backends_list')
         except Exception as e:
             logger.error("Problem when downloading backends: %s", e)
             tell_user("Hubo un PROBLEMA al bajar la lista de backends: %s", e)
@@ -106,49 +242,328 @@ class UpdateEpisodes:
         if dialog and dialog.closed:
             return
 
-        # This is a text file, let's convert to unicode, and get useful lines.
+        # This is a text file, let's convert to unicode, and get useful lines; after the
+        # backend name, downloader and file, there may be some key=value options.
         backends_file = backends_file.decode('utf-8')
-        backends_list = [
-            line.strip().split() for line in backends_file.split("\n") if line and line[0] != '#']
+        backends_list = []
+        for line in backends_file.split("\n"):
+            if line and line[0] != '#':
+                b_name, b_dloader, b_filename, *b_options = line.strip().split()
+                b_options = dict(option.split('=', 1) for option in b_options)
+                backends_list.append((b_name, b_dloader, b_filename, b_options))
 
-        backends = {}
-        for b_name, b_dloader, b_filename in backends_list:
+        # what was merged last time for each backend file; not trusted if there is no data
+        # (e.g. it was removed, or it's the first run) as everything needs to be merged again
+        if len(self.main_window.programs_data):
+            backends_state = config[config.SYSTEM].get(BACKENDS_STATE, {})
+        else:
+            backends_state = {}
+
+        # download all the backends at the same time (but not too many)
+        limiter = utils.Limiter(self.concurrency)
+        downloads = []
+        for b_name, b_dloader, b_filename, b_options in backends_list:
             logger.info("Downloading backend metadata for %r", b_name)
-            tell_user("Descargando la lista de episodios para backend %r...", b_name)
-            try:
-                compressed = yield self._get(b_filename)
-            except Exception as e:
-                logger.error("Problem when downloading episodes: %s", e)
-                tell_user("Hubo un PROBLEMA al bajar los episodios: %s", e)
-                return
+            previous = backends_state.get(b_filename, {})
+            deferred = utils.settle(
+                limiter.run(self._get_backend, b_filename, b_options, previous))
+            downloads.append((b_name, b_dloader, b_filename, deferred))
+        tell_user("Descargando la lista de episodios de %d backends...", len(downloads))
+
+        # process them in order, a problem in one backend doesn't affect the others
+        backends = {}
+        changes = {}
+        present = {}  # the episodes in the full snapshots, per backend
+        removed = []  # the episodes removed according to the deltas
+        failed = []
+        new_state = {}
+        for b_name, b_dloader, b_filename, deferred in downloads:
+            ok, result = yield deferred
             if dialog and dialog.closed:
                 return
+            if not ok:
+                logger.error("Problem when downloading episodes for backend %r: %s",
+                             b_name, result)
+                tell_user("Hubo un PROBLEMA al bajar los episodios del backend %r: %s",
+                          b_name, result)
+                failed.append(b_name)
+                continue
 
-            tell_user("Descomprimiendo el archivo....")
-            new_content = bz2.decompress(compressed)
-            logger.debug("Downloaded data decompressed ok")
+            kind, extension, compressed, new_state[b_filename] = result
+            if compressed is None:
+                logger.info("Backend %r didn't change", b_name)
+                tell_user("Sin cambios en el backend %r", b_name)
+                continue
 
-            content = json.loads(new_content)
+            tell_user("Descomprimiendo el archivo del backend %r...", b_name)
+            stats = {}
+            try:
+                if kind == 'delta':
+                    content = yield utils.run_in_thread(
+                        metadata.decode, compressed, extension, stats)
+                    quantity = len(content['added']) + len(content['changed'])
+                else:
+                    content = []
+                    quantity = yield metadata.decode_in_thread(
+                        compressed, extension, content.extend, stats=stats)
+                logger.debug("Downloaded data decoded ok")
+                timer.add('decompress', stats['decompress'], b_name,
+                          nbytes=stats['decompressed_bytes'])
+                timer.add('parse', stats['parse'], b_name, items=quantity)
+            except Exception as e:
+                logger.error("Problem when decoding episodes for backend %r: %s", b_name, e)
+                tell_user("Hubo un PROBLEMA al procesar los episodios del backend %r: %s",
+                          b_name, e)
+                failed.append(b_name)
+                del new_state[b_filename]
+                continue
+            if dialog and dialog.closed:
+                return
+            if kind == 'delta':
+                logger.info("Got delta for backend %r: %d added, %d changed", b_name,
+                            len(content['added']), len(content['changed']))
+                changes.update(content['changed'])
+                removed.extend(content['removed'])
+                content = content['added']
+            else:
+                present[b_name] = {item['episode_id'] for item in content}
             for item in content:
                 item['downtype'] = b_dloader
+                item['backend'] = b_name
             backends[b_name] = content
 
+        if not new_state:
+            tell_user("No se pudo actualizar ningún backend.")
+            return
+
         if dialog and dialog.closed:
             return
-        tell_user("Conciliando datos de diferentes backends")
-        new_data = []
-        for data in backends.values():
-            new_data.extend(data)
+        if backends:
+            tell_user("Conciliando datos de diferentes backends")
+            new_data = []
+            for data in backends.values():
+                new_data.extend(data)
+
+            quantity = len(new_data) + len(changes)
+            tell_user("Actualizando los datos internos (%d)....", quantity)
+            logger.debug("Updating internal metadata (%d)", quantity)
+            programs_data = self.main_window.programs_data
+            previous_size = len(programs_data)
+            changed = 0
+            with timer.phase('merge') as counts:
+                counts['items'] = quantity
+                for done, changed in programs_data.merge_steps(new_data, changes):
+                    if dialog:
+                        dialog.progress(done, quantity)
+                    yield utils.next_iteration()
+                added = len(programs_data) - previous_size
 
-        tell_user("Actualizando los datos internos (%d)....", len(new_data))
-        logger.debug("Updating internal metadata (%d)", len(new_data))
-        self.main_window.programs_data.merge(
-            new_data, self.main_window.big_panel.episodes)
+                # remove what is not in the backends anymore (only after merging everything,
+                # as episodes may have moved from one backend to other)
+                for b_name, episode_ids in present.items():
+                    removed.extend(programs_data.missing(b_name, episode_ids))
+                if len(present) == len(backends_list):
+                    # all backends were fully merged, so episodes that still don't know their
+                    # backend were not in any of them
+                    removed.extend(programs_data.missing(None, ()))
+                n_removed, n_kept = programs_data.remove(
+                    removed, keep=self.main_window.episodes_download.queue)
 
+            if changed + n_removed:
+                with timer.phase('reload') as counts:
+                    self.main_window.big_panel.episodes.reload_episodes()
+                    counts['items'] = len(programs_data)
+                with timer.phase('save') as counts:
+                    programs_data.save()
+                    counts['bytes'] = os.path.getsize(programs_data.filename)
+
+            stats = (len(programs_data), len(programs_data) - previous_size,
+                     added, changed - added, n_removed, n_kept)
+            logger.info("Catalog updated: total %d (%+d); added %d, updated %d, "
+                        "removed %d, kept %d", *stats)
+            tell_user("Episodios: %d en total (%+d); %d nuevos, %d modificados, "
+                      "%d eliminados, %d conservados", *stats)
+        else:
+            logger.info("No backend changed, nothing to merge")
+
+        # only now that the content is merged it's safe to remember what was received
+        backends_state = config[config.SYSTEM].setdefault(BACKENDS_STATE, {})
+        backends_state.update(new_state)
         config.update({'autorefresh_last_time': datetime.now()})
         config.save()
 
+        timer.add('total', timer.elapsed())
+        tell_user("Tiempos: %s", self._timings_summary())
+
+        if failed:
+            # leave the dialog open so the user can see the problems
+            tell_user("Terminado, pero con problemas en: %s", ", ".join(failed))
+            return
         tell_user("¡Todo terminado bien!")
 
         if dialog:
             dialog.accept()
+
+    def _timings_summary(self):
+        """Build the summary of the timed phases, for the user."""
+        summary = self.timer.summary()
+        parts = []
+        for phase, label in PHASES_LABELS:
+            if phase not in summary:
+                continue
+            seconds, nbytes, _ = summary[phase]
+            if nbytes:
+                parts.append("%s %.2f seg (%d KB)" % (label, seconds, nbytes // 1024))
+            else:
+                parts.append("%s %.2f seg" % (label, seconds))
+        return ", ".join(parts)
+
+
+class UpdateScheduler(QObject):
+    """Decide when to update the episodes while the program runs.
+
+    Background updates wait for the UI to be idle (a while after start, and with no user
+    input in the last seconds), are repeated periodically with some jitter, and are
+    postponed (or done slower) while downloading. Two updates are never run at the same
+    time: if the user asks for one while other is running, it's done after that.
+    """
+
+    def __init__(self, main_window, update_source):
+        super(UpdateScheduler, self).__init__()
+        self.main_window = main_window
+        self.update_source = update_source
+        self.running = False
+        self._interactive_pending = False
+        self._on_profile = None
+        self._started = time.monotonic()
+        self._last_input = self._started
+        self._due = None
+        self._retry_delay = None
+        self._refreshed_before_run = None
+        self._input_trackers = set()
+        self._timer = QTimer()
+        self._timer.timeout.connect(self._check)
+
+    def start(self):
+        """Start to watch the UI and schedule the updates."""
+        last_refresh = config.get('autorefresh_last_time')
+        if config.get('autorefresh') or last_refresh is None or (
+                datetime.now() - last_refresh > REFRESH_PERIOD_NO_AUTO):
+            self._due = datetime.now()
+        else:
+            self._schedule_next(last_refresh)
+        self._timer.start(SCHEDULER_CHECK_PERIOD)
+
+    def _schedule_next(self, last_refresh):
+        """Set when the next background update should be done."""
+        period = REFRESH_PERIOD if config.get('autorefresh') else REFRESH_PERIOD_NO_AUTO
+        self._due = last_refresh + period * (1 + random.uniform(0, REFRESH_JITTER))
+        logger.debug("Next background update at %s", self._due)
+
+    def track_input(self, tracker, wanted=True):
+        """Start or stop watching the user input for the tracker (any hashable).
+
+        The input is watched only while somebody needs to know if the user is idle, as it's
+        done with a filter that sees all the events of the application. When it starts to be
+        watched, the user is considered not idle (nothing is known about what was done before).
+        """
+        was_tracked = bool(self._input_trackers)
+        if wanted:
+            self._input_trackers.add(tracker)
+        else:
+            self._input_trackers.discard(tracker)
+        if was_tracked == bool(self._input_trackers):
+            return
+
+        app = QApplication.instance()
+        if self._input_trackers:
+            self._last_input = time.monotonic()
+            if app is not None:
+                app.installEventFilter(self)
+        elif app is not None:
+            app.removeEventFilter(self)
+
+    def is_idle(self):
+        """Tell if the user didn't do anything lately (and the program is not just started).
+
+        It's only known while the input is being tracked, see 'track_input'.
+        """
+        now = time.monotonic()
+        return now - self._started >= STARTUP_DELAY and now - self._last_input >= IDLE_TIME
+
+    def eventFilter(self, obj, event):
+        """Remember when the user did something."""
+        if event.type() in _INPUT_EVENTS:
+            self._last_input = time.monotonic()
+        return False
+
+    def _check(self):
+        """Start a background update if it's time and the UI is idle."""
+        if self.running or self._due is None or datetime.now() < self._due:
+            return
+        self.track_input(self)
+        if not self.is_idle():
+            return
+
+        downloading = self.main_window.episodes_download.downloading
+        if downloading:
+            if datetime.now() < self._due + MAX_DOWNLOADS_POSTPONE:
+                return
+            # waited enough, but don't compete too much with the download
+            logger.info("Background update while downloading, one backend at a time")
+            concurrency = 1
+        else:
+            concurrency = BACKENDS_CONCURRENCY
+        self._run(UpdateEpisodes(self.main_window, self.update_source, concurrency))
+
+    def refresh_now(self):
+        """Update interactively, as soon as possible."""
+        if self.running:
+            logger.info("Update requested while other in progress, will be done after it")
+            self._interactive_pending = True
+            return
+        self._run(UpdateEpisodes(self.main_window, self.update_source), interactive=True)
+
+    def profile(self, on_report):
+        """Update right away (not scheduling others), passing its timings to the callback."""
+        self._on_profile = on_report
+        self._run(UpdateEpisodes(self.main_window, self.update_source))
+
+    def _run(self, updater, interactive=False):
+        """Run an update."""
+        self.running = True
+        self._refreshed_before_run = config.get('autorefresh_last_time')
+        self.track_input(self, False)
+        deferred = updater.interactive() if interactive else updater.background()
+        deferred.add_callbacks(self._finished, self._finished, callback_args=(updater,),
+                               errback_args=(updater,))
+
+    def _finished(self, result, updater):
+        """An update finished (ok or not), schedule the next one."""
+        if isinstance(result, defer.DeferredException):
+            logger.error("Problem when updating: %s", result.value)
+        self.running = False
+        if self._on_profile is not None:
+            self._on_profile(updater.timer.report())
+            return
+        last_refresh = config.get('autorefresh_last_time')
+        if last_refresh is None or last_refresh == self._refreshed_before_run:
+            # not completed, so the last refresh is still old; retry later, but not too soon
+            if self._retry_delay is None:
+                self._retry_delay = RETRY_DELAY
+            else:
+                self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_DELAY)
+            self._due = datetime.now() + self._retry_delay
+            logger.info("Update not completed, will retry at %s", self._due)
+        else:
+            self._retry_delay = None
+            self._schedule_next(last_refresh)
+        if self._interactive_pending:
+            self._interactive_pending = False
+            self.refresh_now()
+
+    def stop(self):
+        """Don't schedule more updates."""
+        self._timer.stop()
+        for tracker in list(self._input_trackers):
+            self.track_input(tracker, False)
@@ -16,84 +16,136 @@
 
 """Some useful functions."""
 
-import defer
+import collections
 import os
 
-from PyQt5 import QtNetwork, QtCore
+from threading import Thread
 
-_qt_network_manager = QtNetwork.QNetworkAccessManager()
+import defer
 
+from PyQt5 import QtCore
 
-class _Downloader:
-    """An asynch downloader that fires a deferred with data when done."""
-    def __init__(self, url):
-        self.deferred = defer.Deferred()
-        self.deferred._store_it_because_qt_needs_or_wont_work = self
-        self.progress = 0
-        request = QtNetwork.QNetworkRequest(QtCore.QUrl(url))
+from encuentro import httpclient
 
-        self.req = _qt_network_manager.get(request)
-        self.req.error.connect(self.error)
-        self.req.finished.connect(self.end)
-        self.req.downloadProgress.connect(self._advance_progress)
 
-    def error(self, error_code):
-        """Request finished (*maybe*) on error."""
-        if error_code != 5:
-            # different to OperationCanceledError, so we didn't provoke it
-            exc = RuntimeError("Network Error: " + self.req.errorString())
-            self.deferred.errback(exc)
+def download(url):
+    """Deferredly download an URL, non blocking.
 
-    def _advance_progress(self, dloaded, total):
-        """Increment progress."""
-        self.progress = dloaded
+    Return a deferred with the content type and the data. The transfer is supervised by
+    the shared HTTP client, that resumes it if stalled.
+    """
+    deferred = httpclient.fetch(url)
+    deferred.add_callback(lambda response: (response.content_type, response.data))
+    return deferred
+
+
+def settle(deferred):
+    """Make the deferred always succeed, with (True, result) or (False, exception)."""
+    deferred.add_callbacks(lambda result: (True, result), lambda failure: (False, failure.value))
+    return deferred
+
+
+class Limiter:
+    """Run functions that return deferreds, but no more than 'size' at the same time."""
+
+    def __init__(self, size):
+        self.size = size
+        self.running = 0
+        self._waiting = collections.deque()
+
+    def run(self, func, *args, **kwargs):
+        """Run the function when possible; return a deferred with its result."""
+        deferred = defer.Deferred()
+        self._waiting.append((deferred, func, args, kwargs))
+        self._next()
+        return deferred
+
+    def _next(self):
+        """Start what is waiting, if there is room."""
+        while self._waiting and self.running < self.size:
+            deferred, func, args, kwargs = self._waiting.popleft()
+            self.running += 1
+            func_deferred = defer.defer(func, *args, **kwargs)
+            func_deferred.add_callbacks(self._done, self._done,
+                                        callback_args=(deferred, True),
+                                        errback_args=(deferred, False))
+
+    def _done(self, result, deferred, ok):
+        """A function finished, pass its result and start other."""
+        self.running -= 1
+        if ok:
+            deferred.callback(result)
+        else:
+            deferred.errback(result)
+        self._next()
 
-    def abort(self):
-        """Abort the download."""
-        self.req.abort()
 
-    def end(self):
-        """Send data through the deferred, if wasn't fired before."""
-        img_data = self.req.read(self.req.bytesAvailable())
-        content_type = self.req.header(
-            QtNetwork.QNetworkRequest.ContentTypeHeader)
-        data = (content_type, img_data)
-        if not self.deferred.called:
-            self.deferred.callback(data)
+def next_iteration():
+    """Return a deferred that fires in the next iteration of the Qt event loop.
 
+    Useful to let the GUI work in the middle of a long process.
+    """
+    deferred = defer.Deferred()
+    QtCore.QTimer.singleShot(0, lambda: deferred.callback(None))
+    return deferred
 
-def download(url):
-    """Deferredly download an URL, non blocking.
 
-    It starts a _Downloader, and supervises if it stalled. If didn't transfer
-    anything for a whole second, abort it and create a new one. This is to overcome
-    some QtNetwork weirdness that will probably go away in future Qt versions, but
-    that froze the downloading somewhen somehow.
-    """
-    general_deferred = defer.Deferred()
-    state = [_Downloader(url), 0]
+def run_in_thread(func, *args, **kwargs):
+    """Run a function in other thread, return a deferred that fires with its result."""
+    deferred = defer.Deferred()
+    result = []
 
-    def check():
-        dloader, prev_prog = state
+    def run():
+        """Call the function, keeping the result or the exception."""
+        try:
+            result.append((True, func(*args, **kwargs)))
+        except Exception as err:
+            result.append((False, err))
 
-        if dloader.deferred.called:
-            # finished, passthrough the results
-            dloader.deferred.add_callbacks(general_deferred.callback, general_deferred.errback)
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+
+    def check():
+        """Check if the thread finished, to fire the deferred in the main thread."""
+        if not result:
+            QtCore.QTimer.singleShot(100, check)
+            return
+        ok, value = result[0]
+        if ok:
+            deferred.callback(value)
         else:
-            if dloader.progress == prev_prog:
-                # stalled! need to restart it
-                dloader.abort()
-                state[0] = _Downloader(url)
-                state[1] = 0
-            else:
-                # keep going, update progress
-                state[1] = dloader.progress
-
-            # for both cases, new downloader or old still running, check later
-            QtCore.QTimer.singleShot(1000, check)
-
-    QtCore.QTimer.singleShot(1000, check)
-    return general_deferred
+            deferred.errback(value)
+
+    QtCore.QTimer.singleShot(100, check)
+    return deferred
+
+
+class LRUCache:
+    """A dict-like cache with a maximum size, forgetting the least recently used items."""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Return the item (marking it as just used), or the default if not present."""
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return default
+        return self._items[key]
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
 
 
 class SafeSaver:
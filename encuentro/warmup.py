@@ -0,0 +1,260 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Get into the cache the images of many episodes, before they are needed."""
+
+import logging
+import os
+import signal
+import sys
+import time
+
+import defer
+
+from PyQt5.QtCore import QCoreApplication, QTimer
+
+from encuentro import data, image, multiplatform
+from encuentro.config import config
+
+# how many images are downloaded at the same time, and how many can be started per second
+CONCURRENCY = 2
+RATE = 5
+
+# how many times an image is tried (across runs) before giving up on it
+MAX_TRIES = 3
+
+# where the failed tries are remembered, in the config
+FAILED_TRIES = 'images_warmup_failed'
+
+# how frequently (in seconds) the progress is reported and the cache index saved
+REPORT_PERIOD = 5
+
+# how frequently (in seconds) the background warm up checks if the program is idle
+IDLE_CHECK_PERIOD = 10
+
+logger = logging.getLogger('encuentro.warmup')
+
+
+def select_urls(episodes, getter, channel=None, section=None):
+    """Return the urls of the images that are missing for the episodes.
+
+    Only the episodes of the channel and section are considered, if given; images that
+    failed too many times are not retried.
+    """
+    failed = config[config.SYSTEM].get(FAILED_TRIES, {})
+    urls = []
+    seen = set()
+    for episode in episodes:
+        if channel is not None and episode.channel != channel:
+            continue
+        if section is not None and episode.section != section:
+            continue
+        url = episode.image_url
+        if episode.image_data is not None or not episode.has_image_url or url in seen:
+            continue
+        seen.add(url)
+        if failed.get(url, 0) >= MAX_TRIES or getter.is_cached(url):
+            continue
+        urls.append(url)
+    return urls
+
+
+class Warmer:
+    """Download the images, only a few at the same time and not too fast.
+
+    It can be paused and resumed; what was downloaded is in the cache, so another warmer
+    for the same episodes continues from there.
+    """
+
+    def __init__(self, getter, urls, concurrency=CONCURRENCY, rate=RATE):
+        self.getter = getter
+        self.concurrency = concurrency
+        self.rate = rate
+        self.total = len(urls)
+        self.downloaded = 0
+        self.failed = 0
+        self.paused = False
+        self.deferred = defer.Deferred()
+        self._pending = list(reversed(urls))
+        self._running = set()
+        self._last_start = None
+        self._delayed = False
+        self._started = time.monotonic()
+
+    def start(self):
+        """Start; return a deferred that fires with the summary when all is done."""
+        logger.info("Warming up the cache with %d images", self.total)
+        self._next()
+        return self.deferred
+
+    def pause(self):
+        """Don't start more downloads."""
+        self.paused = True
+
+    def resume(self):
+        """Start downloads again."""
+        self.paused = False
+        self._next()
+
+    def _next(self):
+        """Start the next downloads, if there is room and it's not too soon."""
+        while self._pending and not self.paused and len(self._running) < self.concurrency:
+            if self.rate is not None and self._last_start is not None:
+                wait = self._last_start + 1 / self.rate - time.monotonic()
+                if wait > 0:
+                    if not self._delayed:
+                        self._delayed = True
+                        QTimer.singleShot(int(wait * 1000) + 1, self._delay_ended)
+                    return
+            self._last_start = time.monotonic()
+            url = self._pending.pop()
+            self._running.add(url)
+            deferred = self.getter.download(url)
+            deferred.add_callbacks(self._finished, self._finished, callback_args=(url,),
+                                   errback_args=(url,))
+
+        if not self._pending and not self._running and not self.deferred.called:
+            summary = self.summary()
+            logger.info("Cache warm up finished: %s", summary)
+            self.deferred.callback(summary)
+
+    def _delay_ended(self):
+        """It's time to start another download."""
+        self._delayed = False
+        self._next()
+
+    def _finished(self, result, url):
+        """An image download finished, ok or not."""
+        self._running.discard(url)
+        failed = config[config.SYSTEM].setdefault(FAILED_TRIES, {})
+        if isinstance(result, defer.DeferredException):
+            logger.debug("Problem warming up image %r: %s", url, result.value)
+            self.failed += 1
+            failed[url] = failed.get(url, 0) + 1
+        else:
+            self.downloaded += 1
+            failed.pop(url, None)
+        self._next()
+
+    def summary(self):
+        """Return how the warm up is going."""
+        elapsed = time.monotonic() - self._started
+        done = self.downloaded + self.failed
+        return {
+            'total': self.total,
+            'downloaded': self.downloaded,
+            'failed': self.failed,
+            'remaining': self.total - done,
+            'elapsed': round(elapsed, 1),
+            'rate': round(done / elapsed, 2) if elapsed else 0,
+        }
+
+
+class IdleWarmup:
+    """Warm up the images cache in background, only while the program is idle.
+
+    The images of the configured channel and section are searched again after each
+    update of the episodes.
+    """
+
+    def __init__(self, getter, programs_data, scheduler):
+        self.getter = getter
+        self.programs_data = programs_data
+        self.scheduler = scheduler
+        self.warmer = None
+        self._last_update = None
+        self._timer = QTimer()
+        self._timer.timeout.connect(self._check)
+        self._timer.start(IDLE_CHECK_PERIOD * 1000)
+
+    def _check(self):
+        """Run the warmer only if idle; build a new one if the episodes were updated."""
+        last_update = config.get('autorefresh_last_time')
+        updated = last_update != self._last_update
+        finished = self.warmer is not None and self.warmer.deferred.called
+        if finished and not updated:
+            # nothing to do, no need to know if the user is idle
+            self.scheduler.track_input(self, False)
+            return
+
+        self.scheduler.track_input(self)
+        if self.scheduler.running or not self.scheduler.is_idle():
+            if self.warmer is not None:
+                self.warmer.pause()
+            return
+
+        if self.warmer is None or finished:
+            self._last_update = last_update
+            urls = select_urls(self.programs_data.values(), self.getter,
+                               config.get('images-warmup-channel'),
+                               config.get('images-warmup-section'))
+            self.warmer = Warmer(self.getter, urls, concurrency=1)
+            self.warmer.start()
+        else:
+            self.warmer.resume()
+
+    def stop(self):
+        """Don't download anything else."""
+        self._timer.stop()
+        self.scheduler.track_input(self, False)
+        if self.warmer is not None:
+            self.warmer.pause()
+
+
+def format_summary(summary):
+    """Return the summary to be shown to the user."""
+    return ("Imágenes: %(downloaded)d descargadas, %(failed)d con problemas, "
+            "%(remaining)d pendientes (de %(total)d); %(elapsed).1f seg, "
+            "%(rate).2f imágenes/seg" % summary)
+
+
+def start(channel=None, section=None):
+    """Warm up the images cache from the command line, without the graphical interface."""
+    fname = os.path.join(multiplatform.config_dir, 'encuentro.conf')
+    config.init(fname)
+    app = QCoreApplication(sys.argv)
+
+    # the progress is saved periodically, so it's fine to just die on Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    programs_file = os.path.join(multiplatform.data_dir, 'encuentro.data')
+    programs_data = data.ProgramsData(None, programs_file)
+    getter = image.ImageGetter(None)
+    urls = select_urls(programs_data.values(), getter, channel, section)
+    print("Imágenes que faltan en el cache: %d" % (len(urls),), flush=True)
+    warmer = Warmer(getter, urls)
+
+    def report():
+        """Show the progress, and save what was done so far."""
+        print(format_summary(warmer.summary()), flush=True)
+        getter.save_state()
+        config.save()
+
+    report_timer = QTimer()
+    report_timer.timeout.connect(report)
+    report_timer.start(REPORT_PERIOD * 1000)
+
+    def finished(_):
+        """All done."""
+        report_timer.stop()
+        report()
+        app.quit()
+
+    warmer.start().add_callback(finished)
+    if warmer.deferred.called:
+        # nothing to do at all
+        return
+    app.exec_()
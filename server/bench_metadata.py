@@ -0,0 +1,157 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Compare sizes and times of full metadata snapshots and deltas, and of the codecs."""
+
+import argparse
+import bz2
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# we execute this script from inside the directory; pylint: disable=W0403
+import helpers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from encuentro import data, metadata  # NOQA
+
+
+class _FakeEpisodesWidget:
+    """Nothing to show."""
+
+    def reload_episodes(self):
+        """Nothing to reload."""
+
+
+def build_episodes(quantity):
+    """Build a list of synthetic episodes, similar to what the backends produce."""
+    episodes = []
+    for i in range(quantity):
+        episodes.append({
+            'channel': "Canal %d" % (i % 7,),
+            'section': "Sección %d" % (i % 23,),
+            'season': "Temporada %d" % (i % 5,),
+            'title': "Episodio número %d" % (i,),
+            'duration': 20 + i % 40,
+            'description': "Descripción bastante larga del episodio %d. " % (i,) * 5,
+            'episode_id': "ep-%07d" % (i,),
+            'url': "https://example.com/videos/%d/index.m3u8" % (i,),
+            'image_url': "https://example.com/images/%d.jpg" % (i,),
+            'subtitle': None,
+        })
+    return episodes
+
+
+def mutate(episodes, changed_ratio, added_ratio):
+    """Return a new version of the episodes, some changed and some added."""
+    new = [dict(item) for item in episodes]
+    for item in random.sample(new, int(len(new) * changed_ratio)):
+        item['description'] += " Actualizado."
+    base = len(new)
+    for item in build_episodes(base + int(base * added_ratio))[base:]:
+        new.append(item)
+    return new
+
+
+def _timed_merge(filename, new_data, changes=None):
+    """Merge in a ProgramsData loaded from the file, return the elapsed time."""
+    programs = data.ProgramsData(None, filename)
+    tini = time.time()
+    programs.merge(new_data, _FakeEpisodesWidget(), changes)
+    return time.time() - tini
+
+
+def compare_codecs(episodes):
+    """Show the size and times to compress and to decode (as the client does) per format."""
+    print("Codecs (%d episodes, %d bytes of JSON, %d bytes of ECAT):" % (
+        len(episodes), len(json.dumps(episodes)), len(helpers.encode_ecat(episodes))))
+    decompressors = dict(metadata.DECOMPRESSORS)
+    encoded = {
+        'json': json.dumps(episodes).encode('ascii'),
+        'ecat': helpers.encode_ecat(episodes),
+    }
+    for fmt in ('json', 'ecat'):
+        for codec in sorted(helpers.COMPRESSORS):
+            extension = codec if fmt == 'json' else fmt + '.' + codec
+            tini = time.time()
+            compressed = helpers.COMPRESSORS[codec](encoded[fmt])
+            compress_time = time.time() - tini
+            if codec in decompressors:
+                tini = time.time()
+                decoded = list(metadata.iter_decoded(compressed, extension))
+                decode_time = "%8.3f secs" % (time.time() - tini,)
+                assert decoded == episodes
+            else:
+                decode_time = "(not supported by the client)"
+            print("  %-8s %8d bytes   compress %7.3f secs   decode %s" % (
+                extension, len(compressed), compress_time, decode_time))
+
+
+def main(quantity, changed_ratio, added_ratio, dump=None):
+    """Entry point."""
+    random.seed(42)
+    if dump is None:
+        compare_codecs(build_episodes(quantity))
+    else:
+        with open(dump, "rb") as fh:
+            compare_codecs(json.loads(bz2.decompress(fh.read()).decode('ascii')))
+
+    old = build_episodes(quantity)
+    new = mutate(old, changed_ratio, added_ratio)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        basename = os.path.join(tmpdir, "bench")
+        helpers.save_file(basename, old, codecs=['bz2'])
+        helpers.save_file(basename, new, codecs=['bz2'])
+        snapshot_size = os.path.getsize(basename + ".bz2")
+        delta_name = os.path.join(tmpdir, "bench-delta-1-2.bz2")
+        delta_size = os.path.getsize(delta_name)
+        with open(delta_name, "rb") as fh:
+            delta = json.loads(bz2.decompress(fh.read()).decode('ascii'))
+
+        # the data as the client had it before the update, to merge over it
+        datafile = os.path.join(tmpdir, "programs.data")
+        _timed_merge(datafile, old)
+        with open(datafile, "rb") as fh:
+            pristine = fh.read()
+
+        full_time = _timed_merge(datafile, new)
+        with open(datafile, "wb") as fh:
+            fh.write(pristine)
+        delta_time = _timed_merge(datafile, delta['added'], delta['changed'])
+
+    print("Episodes: %d (%d changed, %d added)" % (
+        len(new), len(delta['changed']), len(delta['added'])))
+    print("Size:  snapshot %8d bytes   delta %8d bytes  (%.1f%%)" % (
+        snapshot_size, delta_size, 100 * delta_size / snapshot_size))
+    print("Merge: snapshot %8.3f secs    delta %8.3f secs  (%.1f%%)" % (
+        full_time, delta_time, 100 * delta_time / full_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--episodes', type=int, default=20000,
+                        help="How many episodes in the catalog.")
+    parser.add_argument('--changed', type=float, default=0.02,
+                        help="Ratio of episodes that change between versions.")
+    parser.add_argument('--added', type=float, default=0.01,
+                        help="Ratio of episodes that are added between versions.")
+    parser.add_argument('--dump', help="A real metadata file (.bz2) to compare the codecs.")
+    args = parser.parse_args()
+    main(args.episodes, args.changed, args.added, args.dump)
@@ -0,0 +1,9 @@
+"""Cont.ar credentials.
+
+Fill me with real credentials and rename me as config.py
+"""
+
+config = {
+    'email': 'mail@server.com',
+    'password': 'passw'
+}
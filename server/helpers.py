@@ -16,33 +16,212 @@
 
 """A couple of helpers for server stuff."""
 
+import array
 import bz2
+import gzip
+import io
+import lzma
 import pickle
 import cgi
 import json
 import os
 import re
+import struct
+import sys
 import time
 
 from urllib import parse
 from urllib.error import HTTPError
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 UNIQUE_ID_SEPARATOR = '--'
 
+# how many previous versions of each backend are kept to build deltas from them
+DELTAS_TO_KEEP = 10
 
-def save_file(basename, data):
-    """Save file to disk, dumping the data."""
-    # encode and compress
-    info = json.dumps(data)
-    info = bz2.compress(info.encode('ascii'))
 
-    # dump it
-    tmpname = basename + ".tmp"
-    bz2name = basename + ".bz2"
+def _gzip_compress(content):
+    """Compress with gzip, without the time in the header so the result is always the same.
+
+    It's done with a file object as gzip.compress can't leave out the time before Python 3.8.
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as fh:
+        fh.write(content)
+    return buffer.getvalue()
+
+
+# the codecs in which the metadata can be saved (the file extension) and how
+COMPRESSORS = {
+    'bz2': bz2.compress,
+    'gz': _gzip_compress,
+    'xz': lzma.compress,
+}
+if zstandard is not None:
+    COMPRESSORS['zst'] = zstandard.ZstdCompressor(level=19).compress
+
+# the start of the compact binary catalog format, including its version
+ECAT_MAGIC = b'ECAT\x01'
+
+
+def _write(fname, content):
+    """Write the content to the file, atomically."""
+    tmpname = fname + ".tmp"
     with open(tmpname, "wb") as fh:
-        fh.write(info)
-    os.rename(tmpname, bz2name)
+        fh.write(content)
+    os.rename(tmpname, fname)
+
+
+def _compress(data, codec='bz2'):
+    """Encode and compress the data."""
+    info = json.dumps(data)
+    return COMPRESSORS[codec](info.encode('ascii'))
+
+
+def encode_ecat(episodes):
+    """Encode the episodes in the compact binary catalog format.
+
+    After the magic there are several blocks, each one prefixed with its size (unsigned
+    32 bits, little endian): a JSON header with the quantity of episodes, the fields
+    (name and kind of column) and the rows where each field is missing; a JSON list with
+    all the different strings; and then a column per field. Columns of kind 'str' have
+    the index of each value in the strings table (unsigned 32 bits, little endian, zero
+    for None and the strings from one); columns of kind 'json' are a JSON list of values
+    (with null where missing).
+    """
+    fields = {}
+    for item in episodes:
+        for name in item:
+            fields.setdefault(name, None)
+
+    strings = {}
+    header = {'count': len(episodes), 'fields': [], 'missing': {}}
+    columns = []
+    for name in fields:
+        values = [item.get(name) for item in episodes]
+        missing = [row for row, item in enumerate(episodes) if name not in item]
+        if missing:
+            header['missing'][name] = missing
+        if all(value is None or isinstance(value, str) for value in values):
+            indices = array.array('I', (
+                0 if value is None else strings.setdefault(value, len(strings) + 1)
+                for value in values))
+            if sys.byteorder == 'big':
+                indices.byteswap()
+            header['fields'].append((name, 'str'))
+            columns.append(indices.tobytes())
+        else:
+            header['fields'].append((name, 'json'))
+            columns.append(json.dumps(values).encode('ascii'))
+
+    blocks = [json.dumps(header).encode('ascii'), json.dumps(list(strings)).encode('ascii')]
+    blocks.extend(columns)
+    return ECAT_MAGIC + b"".join(struct.pack('<I', len(block)) + block for block in blocks)
+
+
+def diff_episodes(old, new):
+    """Return what changed between two lists of episodes.
+
+    The delta has the new episodes complete, only the fields that changed for the
+    modified ones (None for fields not there anymore), and the ids of the removed ones.
+    """
+    old_by_id = {item['episode_id']: item for item in old}
+    added = []
+    changed = {}
+    new_ids = set()
+    for item in new:
+        episode_id = item['episode_id']
+        new_ids.add(episode_id)
+        previous = old_by_id.get(episode_id)
+        if previous is None:
+            added.append(item)
+        elif previous != item:
+            fields = {k: v for k, v in item.items() if k not in previous or previous[k] != v}
+            fields.update((k, None) for k in previous if k not in item)
+            changed[episode_id] = fields
+    removed = [episode_id for episode_id in old_by_id if episode_id not in new_ids]
+    return {'added': added, 'changed': changed, 'removed': removed}
+
+
+def _save_deltas(basename, data):
+    """Save the deltas from previous versions to this data, and the manifest.
+
+    Previous snapshots are kept in a history directory. The manifest tells the current
+    version, and for each previous version which file has the delta from it to the
+    current one (so clients always apply just one delta).
+    """
+    manifest_name = basename + ".manifest"
+    history_dir = basename + "-history"
+    if os.path.exists(manifest_name):
+        with open(manifest_name, "rb") as fh:
+            manifest = json.loads(fh.read().decode('ascii'))
+    else:
+        manifest = {'version': 0, 'deltas': {}, 'history': []}
+
+    def _load_version(version):
+        """Load the episodes of a previous version, from the history."""
+        with open(os.path.join(history_dir, "%d.bz2" % (version,)), "rb") as fh:
+            return json.loads(bz2.decompress(fh.read()).decode('ascii'))
+
+    history = manifest['history']
+    if history and _load_version(history[-1]) == data:
+        # nothing changed
+        return manifest['version']
+
+    version = manifest['version'] + 1
+    os.makedirs(history_dir, exist_ok=True)
+    _write(os.path.join(history_dir, "%d.bz2" % (version,)), _compress(data))
+
+    kept = history[-DELTAS_TO_KEEP:]
+    deltas = {}
+    for old_version in kept:
+        delta = diff_episodes(_load_version(old_version), data)
+        delta.update({'from': old_version, 'to': version})
+        delta_name = "%s-delta-%d-%d.bz2" % (basename, old_version, version)
+        _write(delta_name, _compress(delta))
+        deltas[str(old_version)] = os.path.basename(delta_name)
+
+    new_manifest = {
+        'version': version,
+        'snapshot': os.path.basename(basename) + ".bz2",
+        'deltas': deltas,
+        'history': kept + [version],
+    }
+    _write(manifest_name, json.dumps(new_manifest).encode('ascii'))
+
+    # clean what is not used anymore
+    dirname = os.path.dirname(basename)
+    for delta_name in manifest['deltas'].values():
+        if delta_name not in deltas.values():
+            os.remove(os.path.join(dirname, delta_name))
+    for old_version in history:
+        if old_version not in kept:
+            os.remove(os.path.join(history_dir, "%d.bz2" % (old_version,)))
+    return version
+
+
+def save_file(basename, data, codecs=None, ecat=True):
+    """Save file to disk, dumping the data, and the deltas from previous versions.
+
+    The data is saved compressed with each of the codecs (all the available by default);
+    bz2 is always used, as that is what old clients understand. Unless indicated, it's
+    also saved in the compact binary catalog format, with the same codecs.
+    """
+    if codecs is None:
+        codecs = list(COMPRESSORS)
+    codecs = set(codecs) | {'bz2'}
+    for codec in codecs:
+        _write(basename + "." + codec, _compress(data, codec))
+    if ecat:
+        encoded = encode_ecat(data)
+        for codec in codecs:
+            _write(basename + ".ecat." + codec, COMPRESSORS[codec](encoded))
+    return _save_deltas(basename, data)
 
 
 def _weird_utf8_fixing(byteseq):
@@ -0,0 +1,186 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the central panel."""
+
+import unittest
+
+from unittest import mock
+
+from encuentro import data, download_queue
+from encuentro.config import signal
+from encuentro.ui import central_panel
+
+from tests.test_httpclient import get_app
+from tests.test_image import build_image
+
+
+class FakePool:
+    """A thread pool that runs the workers only when told, in any order."""
+
+    def __init__(self):
+        self.started = []
+
+    def start(self, runnable):
+        self.started.append(runnable)
+
+
+def _episode(episode_id):
+    """Build an episode."""
+    return data.EpisodeData(
+        channel="channel", section="section", title="title " + episode_id, duration=10,
+        description="description", episode_id=episode_id, url="http://example.com/video",
+        image_url=None)
+
+
+class DownloadsWidgetTestCase(unittest.TestCase):
+    """Tests for the downloads widget, that must show the queue as it is."""
+
+    def setUp(self):
+        get_app()
+        with mock.patch.object(signal, 'register'):
+            self.widget = central_panel.DownloadsWidget(mock.MagicMock())
+        self.addCleanup(self.widget.deleteLater)
+        self.main_window = self.widget.episodes_widget.main_window
+
+    def _shown(self):
+        """Return the ids of the episodes in the widget, in order."""
+        return [self.widget.topLevelItem(i).episode_id
+                for i in range(self.widget.topLevelItemCount())]
+
+    def _assert_in_sync(self, expected):
+        """The widget shows the queue in the order it will be downloaded."""
+        queued = [entry.episode_id for entry in self.widget.queue.ordered()]
+        self.assertEqual(queued, expected)
+        self.assertEqual(self._shown(), expected)
+
+    def test_append(self):
+        self.widget.append(_episode('a'))
+        self.widget.append(_episode('b'), priority=download_queue.PRIORITY_NORMAL - 1)
+        self.widget.append(_episode('c'), paused=True)
+        self.widget.append(_episode('d'))
+        self._assert_in_sync(['a', 'd', 'b', 'c'])
+
+    def test_pause(self):
+        for episode_id in 'abc':
+            self.widget.append(_episode(episode_id))
+        self.widget.pause('a')
+        self._assert_in_sync(['b', 'c', 'a'])
+        self.assertEqual(self.widget.topLevelItem(2).text(1), "Pausado")
+
+        self.widget.append(_episode('d'))
+        self._assert_in_sync(['b', 'c', 'd', 'a'])
+
+        self.widget.resume('a')
+        self._assert_in_sync(['b', 'c', 'd', 'a'])
+        self.main_window.start_downloads.assert_called_once_with()
+
+    def test_hold(self):
+        for episode_id in 'abc':
+            self.widget.append(_episode(episode_id))
+        self.widget.prepare()
+        self.widget.hold(100 * 1024 ** 2)
+        self._assert_in_sync(['b', 'c', 'a'])
+        self.assertEqual(
+            self.widget.topLevelItem(2).text(1), "En espera: falta espacio en disco (100 MB)")
+
+        self.widget.append(_episode('d'))
+        self._assert_in_sync(['b', 'c', 'd', 'a'])
+
+    def test_move_to_front(self):
+        for episode_id in 'abc':
+            self.widget.append(_episode(episode_id))
+        self.widget.pause('b')
+        self.widget.move_to_front('c')
+        self._assert_in_sync(['c', 'a', 'b'])
+        self.widget.move_to_front('b')
+        self._assert_in_sync(['b', 'c', 'a'])
+        self.main_window.start_downloads.assert_called_once_with()
+
+    def test_finished_stay_first(self):
+        self.widget.append(_episode('a'))
+        self.widget.prepare()
+        self.widget.end()
+        self.widget.append(_episode('b'), paused=True)
+        self.widget.append(_episode('c'))
+        self.assertEqual(self._shown(), ['a', 'c', 'b'])
+
+
+class EpisodeInfoImagesTestCase(unittest.TestCase):
+    """Tests for the decoding and showing of the images."""
+
+    def setUp(self):
+        get_app()
+        for patcher in (mock.patch.object(central_panel.image, 'ImageGetter'),
+                        mock.patch.object(central_panel, 'PIXMAPS_CACHE_SIZE', 2)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.info = central_panel.EpisodeInfo(main_window=None)
+        self.addCleanup(self.info.deleteLater)
+        self.pool = self.info._decoder_pool = FakePool()
+
+        # images of different sizes, to know which is shown
+        self.images = {width: build_image(width, 10, 'PNG') for width in (10, 20, 30)}
+
+    def _shown_width(self):
+        """Return the width of the image being shown."""
+        return self.info.image_episode.pixmap().width()
+
+    def test_stale_decode_not_shown(self):
+        self.info._show_image(10, self.images[10], scale=False)
+        self.info._show_image(20, self.images[20], scale=False)
+        old, new = self.pool.started
+
+        # the newer is decoded first, the older one must not replace it
+        new.run()
+        self.assertEqual(self._shown_width(), 20)
+        with mock.patch.object(central_panel.QImage, 'fromData') as decode:
+            old.run()
+        decode.assert_not_called()
+        self.assertEqual(self._shown_width(), 20)
+
+        # even if it was already decoded when superseded
+        self.info._image_decoded(old.token, old.key, central_panel.QImage.fromData(old.source))
+        self.assertEqual(self._shown_width(), 20)
+        self.assertIn(10, self.info._pixmaps)
+
+    def test_other_episode_supersedes(self):
+        self.info.main_window = mock.MagicMock()
+        self.info._show_image(10, self.images[10], scale=False)
+        episode = data.EpisodeData(
+            channel="channel", section="section", title="title", duration=10,
+            description="description", episode_id="ep2", url="http://example.com/video",
+            image_url=None)
+        self.info.update(episode)
+
+        # the image of the previous episode is not decoded anymore
+        with mock.patch.object(central_panel.QImage, 'fromData') as decode:
+            self.pool.started[0].run()
+        decode.assert_not_called()
+
+    def test_pixmaps_bounded(self):
+        for width in (10, 20, 30):
+            self.info._show_image(width, self.images[width], scale=False)
+            self.pool.started[-1].run()
+        self.assertEqual(len(self.info._pixmaps), 2)
+        self.assertNotIn(10, self.info._pixmaps)
+
+        # the kept ones are shown without decoding, the forgotten ones decoded again
+        self.info._show_image(20, self.images[20], scale=False)
+        self.assertEqual(len(self.pool.started), 3)
+        self.assertEqual(self._shown_width(), 20)
+        self.info._show_image(10, self.images[10], scale=False)
+        self.assertEqual(len(self.pool.started), 4)
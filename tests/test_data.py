@@ -0,0 +1,183 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the episodes data."""
+
+import os
+import pickle
+import tempfile
+import unittest
+
+from datetime import datetime
+
+from encuentro import data
+
+
+def _values(**fields):
+    """Build the episode values as they come from the backends."""
+    values = dict(
+        channel="channel", section="section", title="title", duration=10,
+        description="description", episode_id="epid", url="http://example.com/video",
+        image_url="http://example.com/image", downtype="generic", season=None,
+        image_data=None, subtitle=None)
+    values.update(fields)
+    return values
+
+
+class _FakeEpisodesWidget:
+    """Something to reload."""
+
+    reloaded = 0
+
+    def reload_episodes(self):
+        self.reloaded += 1
+
+
+class EpisodeDataTestCase(unittest.TestCase):
+    """Tests for the episode data."""
+
+    def test_update_fields_as_constructed(self):
+        ed = data.EpisodeData(**_values())
+        ed.update_fields(title="<new>", season="S1", image_data="aGVsbG8=")
+        expected = data.EpisodeData(**_values(title="<new>", season="S1", image_data="aGVsbG8="))
+        self.assertEqual(vars(ed), vars(expected))
+
+    def test_has_image_url(self):
+        self.assertTrue(data.EpisodeData(**_values()).has_image_url)
+        self.assertFalse(data.EpisodeData(**_values(image_url=None)).has_image_url)
+        ed = data.EpisodeData(**_values())
+        ed.update_fields(image_url=None)
+        self.assertFalse(ed.has_image_url)
+
+    def test_update_fields_keeps_the_rest(self):
+        ed = data.EpisodeData(**_values())
+        ed.state = data.Status.downloaded
+        ed.update_fields(duration=20)
+        self.assertEqual(ed.duration, 20)
+        self.assertEqual(ed.title, "title")
+        self.assertEqual(ed.state, data.Status.downloaded)
+
+
+class ProgramsDataTestCase(unittest.TestCase):
+    """Tests for the programs data."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.filename = os.path.join(tmpdir.name, "programs")
+        self.programs = data.ProgramsData(None, self.filename)
+
+    def test_merge_new_and_changes(self):
+        widget = _FakeEpisodesWidget()
+        self.programs.merge([_values(episode_id='a'), _values(episode_id='b')], widget)
+        self.programs.merge([_values(episode_id='c')], widget,
+                            {'a': {'title': "changed", 'unknown': 3}, 'z': {'title': "x"}})
+        self.assertEqual(sorted(self.programs.data), ['a', 'b', 'c'])
+        self.assertEqual(self.programs['a'].title, "changed")
+        self.assertEqual(self.programs['b'].title, "title")
+        self.assertEqual(widget.reloaded, 2)
+
+    def test_merge_unchanged_skipped(self):
+        widget = _FakeEpisodesWidget()
+        self.programs.merge([_values(episode_id='a')], widget)
+        self.programs['a'].state = data.Status.downloaded
+        self.programs.merge([_values(episode_id='a')], widget)
+        self.assertEqual(widget.reloaded, 1)
+        self.assertEqual(self.programs['a'].state, data.Status.downloaded)
+
+    def test_merge_steps(self):
+        new_data = [_values(episode_id=str(i)) for i in range(5)]
+        steps = list(self.programs.merge_steps(new_data, batch_size=2))
+        self.assertEqual(steps, [(2, 2), (4, 4), (5, 5)])
+
+        new_data[3] = _values(episode_id='3', title="other")
+        steps = list(self.programs.merge_steps(new_data, {'0': {'duration': 3}}, batch_size=2))
+        self.assertEqual(steps, [(2, 0), (4, 1), (5, 1), (6, 2)])
+        self.assertEqual(self.programs['3'].title, "other")
+        self.assertEqual(self.programs['0'].duration, 3)
+
+    def test_merge_keeps_download_state(self):
+        widget = _FakeEpisodesWidget()
+        self.programs.merge([_values(episode_id='a')], widget)
+        self.programs['a'].state = data.Status.downloaded
+        self.programs['a'].filename = "/tmp/a.mp4"
+        self.programs.merge([_values(episode_id='a', title="other")], widget)
+        self.assertEqual(self.programs['a'].title, "other")
+        self.assertEqual(self.programs['a'].state, data.Status.downloaded)
+        self.assertEqual(self.programs['a'].filename, "/tmp/a.mp4")
+
+    def test_merge_sets_backend(self):
+        widget = _FakeEpisodesWidget()
+        self.programs.merge([_values(episode_id='a', backend='b1')], widget)
+        self.assertEqual(self.programs['a'].backend, 'b1')
+
+        # even if nothing else changed
+        self.programs.merge([_values(episode_id='a', backend='b2')], widget)
+        self.assertEqual(self.programs['a'].backend, 'b2')
+
+    def test_missing(self):
+        new_data = [_values(episode_id=i, backend=b) for i, b in ['a1', 'b1', 'c2']]
+        self.programs.merge(new_data, _FakeEpisodesWidget())
+        self.assertEqual(self.programs.missing('1', {'a', 'z'}), ['b'])
+        self.assertEqual(self.programs.missing('2', ()), ['c'])
+
+    def test_remove(self):
+        new_data = [_values(episode_id=i) for i in 'abcd']
+        self.programs.merge(new_data, _FakeEpisodesWidget())
+        self.programs['b'].state = data.Status.downloaded
+        removed, kept = self.programs.remove(['a', 'b', 'c', 'x'], keep={'c'})
+        self.assertEqual((removed, kept), (1, 2))
+        self.assertEqual(sorted(self.programs.data), ['b', 'c', 'd'])
+        self.assertEqual(list(self.programs.tombstones), ['a'])
+
+    def test_tombstones(self):
+        widget = _FakeEpisodesWidget()
+        self.programs.merge([_values(episode_id='a')], widget)
+        self.programs.remove(['a'])
+
+        # changes for removed episodes are ignored, but they can come back
+        self.programs.merge([], widget, {'a': {'title': "x"}})
+        self.assertNotIn('a', self.programs.data)
+        self.programs.merge([_values(episode_id='a')], widget)
+        self.assertIn('a', self.programs.data)
+        self.assertEqual(self.programs.tombstones, {})
+
+    def test_old_tombstones_forgotten(self):
+        self.programs.tombstones['old'] = (None, datetime.now() - 2 * data.TOMBSTONES_TTL)
+        self.programs.tombstones['new'] = (None, datetime.now())
+        self.programs.remove([])
+        self.assertEqual(list(self.programs.tombstones), ['new'])
+
+    def test_save_and_load(self):
+        widget = _FakeEpisodesWidget()
+        self.programs.merge([_values(episode_id='a'), _values(episode_id='b')], widget)
+        self.programs.remove(['a'])
+        self.programs.save()
+        loaded = data.ProgramsData(None, self.filename)
+        self.assertEqual(list(loaded.data), ['b'])
+        self.assertEqual(list(loaded.tombstones), ['a'])
+        self.assertFalse(loaded.forget_backends_state)
+
+    def test_migrate_from_version_2(self):
+        episodes = {'a': data.EpisodeData(**_values(episode_id='a'))}
+        with open(self.filename, 'wb') as fh:
+            pickle.dump((2, episodes), fh)
+        loaded = data.ProgramsData(None, self.filename)
+        self.assertEqual(loaded.version, data.ProgramsData.last_programs_version)
+        self.assertEqual(list(loaded.data), ['a'])
+        self.assertEqual(loaded.tombstones, {})
+        self.assertIsNone(loaded['a'].backend)
+        self.assertTrue(loaded.forget_backends_state)
@@ -0,0 +1,58 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the checking of the dependencies."""
+
+import sys
+import unittest
+
+from unittest import mock
+
+import encuentro
+
+
+class CheckDependencyTestCase(unittest.TestCase):
+    """Tests for the dependencies check."""
+
+    def _check(self, *args):
+        """Check the dependency, return what was printed."""
+        with mock.patch('builtins.print') as fake_print:
+            encuentro.check_dependency(*args)
+        (printed,), _ = fake_print.call_args
+        return printed
+
+    def test_found(self):
+        printed = self._check('defer', 'python-defer', 'defer', '1.0.6')
+        self.assertRegex(printed, r"^Módulo 'defer' encontrado ok, versión '\d")
+
+    def test_missing(self):
+        printed = self._check('not_a_module', 'python-nope', 'nope', '1.0')
+        self.assertIn("Problema al importar 'not_a_module'", printed)
+
+    def test_version_unknown(self):
+        printed = self._check('encuentro', 'encuentro', 'not-a-distribution', '1.0')
+        self.assertEqual(printed, "Módulo 'encuentro' encontrado ok, versión '<desconocida>'")
+
+    def test_old_python(self):
+        with mock.patch.object(encuentro, 'importlib_metadata', None):
+            printed = self._check('defer', 'python-defer', 'defer', '1.0.6')
+        self.assertRegex(printed, r"^Módulo 'defer' encontrado ok, versión '\d")
+
+    def test_old_python_without_setuptools(self):
+        with mock.patch.object(encuentro, 'importlib_metadata', None):
+            with mock.patch.dict(sys.modules, {'pkg_resources': None}):
+                printed = self._check('defer', 'python-defer', 'defer', '1.0.6')
+        self.assertEqual(printed, "Módulo 'defer' encontrado ok, versión '<desconocida>'")
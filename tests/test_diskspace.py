@@ -0,0 +1,113 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the disk space admission."""
+
+import errno
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+from encuentro import diskspace
+
+from tests.test_network import through_deferred
+
+
+class EstimateTestCase(unittest.TestCase):
+    """Tests for the size estimation."""
+
+    def test_filesize(self):
+        info = dict(filesize=1000, duration=10)
+        self.assertEqual(diskspace.estimate_from_info(info), 1000)
+
+    def test_bitrate_and_duration(self):
+        # 700 kbps during 60 seconds, plus audio of known size
+        info = dict(requested_formats=[dict(tbr=700), dict(filesize_approx=500)], duration=60)
+        self.assertEqual(diskspace.estimate_from_info(info), 700 * 1000 // 8 * 60 + 500)
+
+    def test_unknown(self):
+        info = dict(requested_formats=[dict(tbr=700)], duration=None)
+        self.assertIsNone(diskspace.estimate_from_info(info))
+
+
+class AdmitTestCase(unittest.TestCase):
+    """Tests for the admission and reservations."""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.gettempdir(), 'not', 'there', 'yet')
+        self.addCleanup(diskspace.reservations.release, self)
+
+    def test_admit_reserves(self):
+        diskspace.admit(self.path, self, 1000)
+        self.assertEqual(diskspace.reservations.total(), 1000)
+        diskspace.reservations.release(self)
+        self.assertEqual(diskspace.reservations.total(), 0)
+
+    def test_admit_unknown_size(self):
+        diskspace.admit(self.path, self, None)
+        self.assertEqual(diskspace.reservations.total(), 0)
+
+    def test_too_big(self):
+        needed = diskspace.free_space(self.path) * 2
+        with self.assertRaises(diskspace.NotEnoughSpace) as cm:
+            diskspace.admit(self.path, self, needed)
+        self.assertEqual(cm.exception.needed, needed)
+        self.assertEqual(diskspace.reservations.total(), 0)
+
+    def test_through_deferred(self):
+        err = through_deferred(self, diskspace.NotEnoughSpace(100 * diskspace.MB, 10))
+        self.assertEqual(err.needed, 100 * diskspace.MB)
+        self.assertEqual(err.available, 10)
+        self.assertEqual(str(err), "Not enough space in disk: need 100 MB, have 0 MB")
+
+    def test_without_available(self):
+        err = diskspace.NotEnoughSpace(100 * diskspace.MB)
+        self.assertIsNone(err.available)
+        self.assertEqual(str(err), "Not enough space in disk: need 100 MB")
+
+    def test_written_consumes(self):
+        diskspace.admit(self.path, self, 1000)
+        diskspace.reservations.consume(self, 400)
+        self.assertEqual(diskspace.reservations.total(), 600)
+        diskspace.reservations.consume(self, 1000)
+        self.assertEqual(diskspace.reservations.total(), 0)
+
+        # nothing if nothing reserved
+        diskspace.reservations.release(self)
+        diskspace.reservations.consume(self, 1000)
+        self.assertEqual(diskspace.reservations.total(), 0)
+
+    def test_preallocate(self):
+        with tempfile.TemporaryFile() as fh:
+            fh.write(b"abc")
+            with mock.patch.object(diskspace.os, 'posix_fallocate', create=True) as fallocate:
+                self.assertTrue(diskspace.preallocate(fh, 1000))
+            fallocate.assert_called_once_with(fh.fileno(), 3, 1000)
+
+            with mock.patch.object(diskspace.os, 'posix_fallocate', create=True,
+                                   side_effect=OSError(errno.EOPNOTSUPP, "not supported")):
+                self.assertFalse(diskspace.preallocate(fh, 1000))
+            self.assertFalse(diskspace.preallocate(fh, None))
+
+    def test_reservations_count(self):
+        other = object()
+        avail = diskspace.available(self.path)
+        diskspace.admit(self.path, other, avail - diskspace.MB)
+        self.addCleanup(diskspace.reservations.release, other)
+        with self.assertRaises(diskspace.NotEnoughSpace):
+            diskspace.admit(self.path, self, 100 * diskspace.MB)
@@ -0,0 +1,88 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the download queue."""
+
+import unittest
+
+from encuentro.download_queue import DownloadQueue
+
+
+class FakeEpisode:
+    """Just what the queue needs from an episode."""
+
+    def __init__(self, episode_id):
+        self.episode_id = episode_id
+
+
+class DownloadQueueTestCase(unittest.TestCase):
+    """Tests for the download queue."""
+
+    def setUp(self):
+        self.queue = DownloadQueue()
+        for episode_id in 'abcde':
+            self.queue.add(FakeEpisode(episode_id))
+
+    def _drain(self):
+        """Pop everything, returning the ids."""
+        result = []
+        while True:
+            entry = self.queue.pop()
+            if entry is None:
+                return result
+            result.append(entry.episode_id)
+
+    def test_fifo(self):
+        self.assertEqual(self._drain(), list('abcde'))
+        self.assertEqual(len(self.queue), 0)
+
+    def test_priority(self):
+        self.queue.set_priority('d', 1)
+        self.queue.set_priority('b', -1)
+        self.assertEqual(self._drain(), list('daceb'))
+
+    def test_move_to_front(self):
+        self.queue.set_priority('c', 2)
+        self.queue.move_to_front('e')
+        self.assertEqual(self._drain(), list('ecabd'))
+
+    def test_pause_and_resume(self):
+        self.queue.pause('a')
+        self.queue.pause('c')
+        self.assertEqual(self.queue.available(), 3)
+        self.assertEqual(self.queue.pop().episode_id, 'b')
+        self.queue.resume('a')
+        self.assertEqual(self._drain(), list('dea'))
+        self.assertEqual(len(self.queue), 1)
+        self.assertIn('c', self.queue)
+
+    def test_remove(self):
+        self.queue.remove('b')
+        self.assertNotIn('b', self.queue)
+        self.assertEqual(self._drain(), list('acde'))
+
+    def test_ordered(self):
+        self.queue.pause('a')
+        self.queue.move_to_front('d')
+        ordered = [e.episode_id for e in self.queue.ordered()]
+        self.assertEqual(ordered, list('dbcea'))
+
+    def test_heap_does_not_grow_forever(self):
+        for i in range(1000):
+            self.queue.set_priority('c', i % 3)
+        self.queue.set_priority('c', 1)
+        self.assertLess(len(self.queue._heap), 50)
+        self.assertEqual(self._drain()[0], 'c')
@@ -0,0 +1,153 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the server helpers."""
+
+import bz2
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+# Adds server directory for imports
+sys.path.insert(0, 'server')
+from server import helpers
+
+
+def _episode(episode_id, **fields):
+    """Build a simple episode."""
+    episode = {'episode_id': episode_id, 'title': "Title " + episode_id, 'duration': 10}
+    episode.update(fields)
+    return episode
+
+
+class DiffEpisodesTestCase(unittest.TestCase):
+    """Tests for the deltas between episodes lists."""
+
+    def test_nothing_changed(self):
+        episodes = [_episode('a'), _episode('b')]
+        delta = helpers.diff_episodes(episodes, episodes)
+        self.assertEqual(delta, {'added': [], 'changed': {}, 'removed': []})
+
+    def test_added_and_removed(self):
+        delta = helpers.diff_episodes([_episode('a'), _episode('b')],
+                                      [_episode('b'), _episode('c')])
+        self.assertEqual(delta['added'], [_episode('c')])
+        self.assertEqual(delta['removed'], ['a'])
+        self.assertEqual(delta['changed'], {})
+
+    def test_changed_only_fields(self):
+        old = [_episode('a', description="old", season="1")]
+        new = [_episode('a', description="new", subtitle="sub")]
+        delta = helpers.diff_episodes(old, new)
+        self.assertEqual(delta['changed'], {
+            'a': {'description': "new", 'subtitle': "sub", 'season': None}})
+
+
+class SaveFileTestCase(unittest.TestCase):
+    """Tests for the saving of snapshots, deltas and manifest."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dirpath = tmpdir.name
+        self.basename = os.path.join(self.dirpath, "backend-v01")
+
+    def _load(self, name, compressed=True):
+        with open(os.path.join(self.dirpath, name), "rb") as fh:
+            content = fh.read()
+        if compressed:
+            content = bz2.decompress(content)
+        return json.loads(content.decode('ascii'))
+
+    def test_first_version(self):
+        helpers.save_file(self.basename, [_episode('a')])
+        self.assertEqual(self._load("backend-v01.bz2"), [_episode('a')])
+        manifest = self._load("backend-v01.manifest", compressed=False)
+        self.assertEqual(manifest['version'], 1)
+        self.assertEqual(manifest['snapshot'], "backend-v01.bz2")
+        self.assertEqual(manifest['deltas'], {})
+
+    def test_codecs(self):
+        helpers.save_file(self.basename, [_episode('a')], codecs=['gz', 'xz'])
+        names = sorted(name for name in os.listdir(self.dirpath) if 'history' not in name)
+        self.assertEqual(names, [
+            "backend-v01.bz2", "backend-v01.ecat.bz2", "backend-v01.ecat.gz",
+            "backend-v01.ecat.xz", "backend-v01.gz", "backend-v01.manifest",
+            "backend-v01.xz"])
+
+    def test_gzip_always_the_same(self):
+        content = b"some content" * 100
+        compressed = helpers.COMPRESSORS['gz'](content)
+        with mock.patch.object(time, 'time', return_value=time.time() + 3600):
+            self.assertEqual(helpers.COMPRESSORS['gz'](content), compressed)
+        self.assertEqual(gzip.decompress(compressed), content)
+
+    def test_without_ecat(self):
+        helpers.save_file(self.basename, [_episode('a')], codecs=['gz'], ecat=False)
+        names = sorted(name for name in os.listdir(self.dirpath) if 'history' not in name)
+        self.assertEqual(names, ["backend-v01.bz2", "backend-v01.gz", "backend-v01.manifest"])
+
+    def test_ecat_content(self):
+        episodes = [_episode('a'), _episode('b', season="1")]
+        helpers.save_file(self.basename, episodes, codecs=['bz2'])
+        with open(self.basename + ".ecat.bz2", "rb") as fh:
+            encoded = bz2.decompress(fh.read())
+        self.assertEqual(encoded, helpers.encode_ecat(episodes))
+
+    def test_all_codecs_by_default(self):
+        helpers.save_file(self.basename, [_episode('a')])
+        for codec in helpers.COMPRESSORS:
+            self.assertTrue(os.path.exists(self.basename + "." + codec))
+
+    def test_deltas_from_previous_versions(self):
+        helpers.save_file(self.basename, [_episode('a')])
+        helpers.save_file(self.basename, [_episode('a'), _episode('b')])
+        version = helpers.save_file(self.basename, [_episode('a', duration=20), _episode('b')])
+        self.assertEqual(version, 3)
+
+        manifest = self._load("backend-v01.manifest", compressed=False)
+        self.assertEqual(manifest['deltas'], {
+            '1': "backend-v01-delta-1-3.bz2", '2': "backend-v01-delta-2-3.bz2"})
+        delta = self._load("backend-v01-delta-1-3.bz2")
+        self.assertEqual(delta['from'], 1)
+        self.assertEqual(delta['to'], 3)
+        self.assertEqual(delta['added'], [_episode('b')])
+        self.assertEqual(delta['changed'], {'a': {'duration': 20}})
+
+        # the delta from 1 to 2 is not needed anymore
+        self.assertFalse(os.path.exists(self.basename + "-delta-1-2.bz2"))
+
+    def test_same_data_no_new_version(self):
+        helpers.save_file(self.basename, [_episode('a')])
+        version = helpers.save_file(self.basename, [_episode('a')])
+        self.assertEqual(version, 1)
+
+    def test_old_versions_forgotten(self):
+        for i in range(helpers.DELTAS_TO_KEEP + 3):
+            helpers.save_file(self.basename, [_episode('a', duration=i)])
+        manifest = self._load("backend-v01.manifest", compressed=False)
+        self.assertEqual(len(manifest['deltas']), helpers.DELTAS_TO_KEEP)
+        self.assertNotIn('1', manifest['deltas'])
+        history = os.listdir(self.basename + "-history")
+        self.assertEqual(len(history), helpers.DELTAS_TO_KEEP + 1)
+        deltas = [name for name in os.listdir(self.dirpath) if '-delta-' in name]
+        self.assertEqual(len(deltas), helpers.DELTAS_TO_KEEP)
@@ -0,0 +1,241 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the HTTP client, against a local server."""
+
+import os
+import re
+import threading
+import time
+import unittest
+
+from unittest import mock
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PyQt5.QtCore import QCoreApplication, QEventLoop
+from PyQt5.QtWidgets import QApplication
+
+from encuentro import httpclient
+
+CONTENT = bytes(range(256)) * 40
+
+
+# the application, that must live while the tests run
+_app = None
+
+
+def get_app():
+    """Return the Qt application (without display), creating it if needed."""
+    global _app
+    if QCoreApplication.instance() is None:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        _app = QApplication([])
+    return QCoreApplication.instance()
+
+
+def wait_for(deferred, timeout=10):
+    """Run the Qt event loop until the deferred is fired, return its result."""
+    app = get_app()
+    limit = time.monotonic() + timeout
+    while not deferred.called:
+        if time.monotonic() > limit:
+            raise AssertionError("Deferred not fired after %d seconds" % (timeout,))
+        app.processEvents(QEventLoop.AllEvents, 50)
+    return deferred.result
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answer as the server's next response indicates."""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.server.responses:
+            response = self.server.responses.pop(0)
+        else:
+            response = self.server.default
+        response(self)
+
+    def log_message(self, *args):
+        """Be quiet."""
+
+
+def content(data=CONTENT, ranges=True, stall_at=None):
+    """Build a response with the data, from the requested range if supported.
+
+    If 'stall_at' is given, after sending those bytes nothing else is sent (until the
+    server is stopped).
+    """
+    def respond(handler):
+        start = 0
+        match = re.match(r"bytes=(\d+)-", handler.headers.get('Range', ''))
+        if ranges and match:
+            start = int(match.group(1))
+            handler.send_response(206)
+            handler.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            handler.send_response(200)
+        handler.send_header('Content-Length', str(len(data) - start))
+        handler.send_header('Content-Type', 'application/octet-stream')
+        handler.end_headers()
+        if stall_at is None:
+            handler.wfile.write(data[start:])
+        else:
+            handler.wfile.write(data[start:stall_at])
+            handler.wfile.flush()
+            handler.server.stopped.wait(10)
+    return respond
+
+
+def error(status, body=b""):
+    """Build an error response, with the body."""
+    def respond(handler):
+        handler.send_response(status)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+    return respond
+
+
+class LocalServer:
+    """An HTTP server in a thread, answering with the responses given (in order)."""
+
+    def __init__(self, test):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.responses = []
+        self.server.default = content()
+        self.server.stopped = threading.Event()
+        self.url = "http://127.0.0.1:%d/file" % (self.server.server_address[1],)
+        thread = threading.Thread(target=self.server.serve_forever, args=(.05,))
+        thread.daemon = True
+        thread.start()
+        test.addCleanup(self.stop)
+
+    @property
+    def requests(self):
+        """The headers of the requests received."""
+        return self.server.requests
+
+    def respond(self, *responses):
+        """Answer the following requests with these responses."""
+        self.server.responses.extend(responses)
+
+    def stop(self):
+        """Stop the server."""
+        self.server.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TransferTestCase(unittest.TestCase):
+    """Tests for the transfers."""
+
+    def setUp(self):
+        get_app()
+        self.server = LocalServer(self)
+
+    def test_error_body_is_not_content(self):
+        self.server.respond(error(503, b"busy"))
+        received = []
+        transfer = httpclient.Transfer(
+            self.server.url, offset=100, on_data=received.append, stall_timeout=5)
+        result = wait_for(transfer.deferred)
+        self.assertEqual(result.value.http_status, 503)
+        self.assertEqual(received, [])
+        self.assertEqual(transfer.received, 100)
+        self.assertEqual(self.server.requests[0]['Range'], "bytes=100-")
+
+    def test_callback_problem_ends_transfer(self):
+        def on_progress(received, total):
+            raise ValueError("boom")
+
+        transfer = httpclient.Transfer(
+            self.server.url, on_data=lambda data: None, on_progress=on_progress,
+            stall_timeout=5)
+        result = wait_for(transfer.deferred)
+        self.assertIsInstance(result.value, ValueError)
+
+    def test_complete(self):
+        transfer = httpclient.Transfer(self.server.url, stall_timeout=5)
+        response = wait_for(transfer.deferred)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.data, CONTENT)
+        self.assertEqual(response.content_type, 'application/octet-stream')
+        self.assertNotIn('Range', self.server.requests[0])
+
+    def test_resume_with_range(self):
+        transfer = httpclient.Transfer(self.server.url, offset=100, stall_timeout=5)
+        response = wait_for(transfer.deferred)
+        self.assertEqual(self.server.requests[0]['Range'], "bytes=100-")
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.data, CONTENT[100:])
+        self.assertEqual(transfer.offset, 100)
+        self.assertEqual(transfer.total, len(CONTENT))
+
+    def test_range_ignored(self):
+        self.server.respond(content(ranges=False))
+        offsets = []
+        transfer = httpclient.Transfer(
+            self.server.url, offset=100, on_headers=lambda t: offsets.append(t.offset),
+            stall_timeout=5)
+        response = wait_for(transfer.deferred)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.data, CONTENT)
+        self.assertEqual(offsets, [0])
+        self.assertEqual(transfer.received, len(CONTENT))
+
+    def test_headers_twice(self):
+        self.server.respond(content(ranges=False))
+        transfer = httpclient.Transfer(self.server.url, offset=100, stall_timeout=5)
+        wait_for(transfer.deferred)
+
+        # told again, nothing is reset
+        transfer._headers(transfer.reply)
+        self.assertEqual(transfer.offset, 0)
+        self.assertEqual(transfer.received, len(CONTENT))
+
+    def test_stalled_resumed(self):
+        self.server.respond(content(stall_at=1000))
+        stats = httpclient.client.stats['127.0.0.1']
+        stalls = stats['stalls']
+        received = []
+        transfer = httpclient.Transfer(
+            self.server.url, on_data=received.append, stall_timeout=.2)
+        wait_for(transfer.deferred)
+        self.assertEqual(b"".join(received), CONTENT)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1]['Range'], "bytes=1000-")
+        self.assertEqual(stats['stalls'], stalls + 1)
+
+
+class HTTPClientTestCase(unittest.TestCase):
+    """Tests for the shared client."""
+
+    def setUp(self):
+        get_app()
+        self.server = LocalServer(self)
+
+    def test_report(self):
+        client = httpclient.HTTPClient()
+        self.addCleanup(client.manager.deleteLater)
+        with mock.patch.object(httpclient, 'client', client):
+            wait_for(httpclient.fetch(self.server.url))
+            wait_for(httpclient.fetch(self.server.url))
+        self.assertEqual(client.report(), {
+            '127.0.0.1': {'requests': 2, 'bytes': 2 * len(CONTENT), 'reused': None}})
@@ -0,0 +1,517 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the images getter and cache."""
+
+import os
+import tempfile
+import time
+import unittest
+
+from hashlib import md5
+from unittest import mock
+
+import defer
+
+from PyQt5.QtCore import QBuffer, QIODevice
+from PyQt5.QtGui import QColor, QImage
+
+from encuentro import httpclient, image
+from encuentro.config import config
+
+URL = "http://example.com/image.jpg"
+URL_HASH = md5(URL.encode('utf8')).hexdigest()
+
+
+class FakeDeferred:
+    """Just enough of a deferred, firing the callbacks as soon as possible."""
+
+    def __init__(self):
+        self.called = False
+        self.result = None
+        self._chain = []
+
+    def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+        """Add the functions to the chain."""
+        self._chain.append((callback, callback_args, errback, errback_args))
+        self._run()
+
+    def add_callback(self, callback, *args):
+        """Add a callback to the chain."""
+        self.add_callbacks(callback, None, callback_args=args)
+
+    def add_errback(self, errback, *args):
+        """Add an errback to the chain."""
+        self.add_callbacks(None, errback, errback_args=args)
+
+    def callback(self, result):
+        """Succeed."""
+        self.called = True
+        self.result = result
+        self._run()
+
+    def errback(self, exc):
+        """Fail."""
+        self.called = True
+        self.result = defer.DeferredException(type(exc), exc)
+        self._run()
+
+    def _run(self):
+        """Call what corresponds, if already fired."""
+        while self.called and self._chain:
+            callback, callback_args, errback, errback_args = self._chain.pop(0)
+            if isinstance(self.result, defer.DeferredException):
+                func, args = errback, errback_args
+            else:
+                func, args = callback, callback_args
+            if func is not None:
+                self.result = func(self.result, *args)
+
+
+class FakeTransfer:
+    """A transfer that finishes only when told."""
+
+    def __init__(self, url):
+        self.url = url
+        self.deferred = FakeDeferred()
+        self.failed = None
+
+    def finish(self, content_type='image/png', data=b"data"):
+        """Finish the transfer ok."""
+        self.deferred.callback(httpclient.Response(200, {'content-type': content_type}, data))
+
+    def fail(self, exc):
+        """Abort the transfer."""
+        self.failed = exc
+        self.deferred.errback(exc)
+
+
+def sync_in_thread(func, *args):
+    """Run the function right away, returning a deferred with its result."""
+    deferred = FakeDeferred()
+    try:
+        result = func(*args)
+    except Exception as err:
+        deferred.errback(err)
+    else:
+        deferred.callback(result)
+    return deferred
+
+
+def fake_download(content_type, data):
+    """Build a fake transfer that finishes right away with the given info."""
+    def build(url):
+        transfer = FakeTransfer(url)
+        transfer.finish(content_type, data)
+        return transfer
+    return build
+
+
+class ImageGetterTestCase(unittest.TestCase):
+    """Tests for the images getter."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.cache_dir = tmpdir.name
+        self.loaded = []
+        for patcher in (mock.patch.object(image.defer, 'Deferred', FakeDeferred),
+                        mock.patch.object(image.utils, 'run_in_thread', sync_in_thread)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _getter(self):
+        """Build a getter on the temporary cache."""
+        getter = image.ImageGetter(lambda *a: self.loaded.append(a), self.cache_dir)
+        self.addCleanup(image.signal.store.get('save_state', []).remove, getter.save_state)
+        return getter
+
+    def _put(self, file_name, data=b"img", mtime=None):
+        """Put a file in the cache directory."""
+        path = os.path.join(self.cache_dir, file_name)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def _files(self, getter):
+        """Return the files in the index, per hash."""
+        return {url_hash: file_name for url_hash, (file_name, _, _) in getter.index.items()}
+
+    def _limits(self, max_bytes=image.MAX_CACHE_BYTES, max_images=image.MAX_CACHE_IMAGES):
+        """Set the limits of the cache, for this test."""
+        for key in ('images-cache-max-bytes', 'images-cache-max-images'):
+            if key in config:
+                self.addCleanup(config.__setitem__, key, config[key])
+            else:
+                self.addCleanup(config.pop, key)
+        config['images-cache-max-bytes'] = max_bytes
+        config['images-cache-max-images'] = max_images
+
+    def test_index_built_from_directory(self):
+        self._put(URL_HASH + '.jpeg')
+        self._put('other.png')
+        self._put('half.png.tmp')
+        getter = self._getter()
+        self.assertEqual(self._files(getter), {URL_HASH: URL_HASH + '.jpeg', 'other': 'other.png'})
+
+    def test_hit_gives_the_real_file(self):
+        self._put(URL_HASH + '.jpeg')
+        getter = self._getter()
+        with mock.patch.object(image.httpclient, 'Transfer') as download:
+            getter.get_image('ep1', URL)
+        download.assert_not_called()
+        self.assertEqual(self.loaded, [('ep1', os.path.join(self.cache_dir, URL_HASH + '.jpeg'))])
+
+    def test_download_updates_index(self):
+        getter = self._getter()
+        with mock.patch.object(image.httpclient, 'Transfer', fake_download('image/png', b"data")):
+            getter.get_image('ep1', URL)
+        path = os.path.join(self.cache_dir, URL_HASH + '.png')
+        self.assertEqual(self.loaded, [('ep1', path)])
+        self.assertEqual(getter.index[URL_HASH][:2], (URL_HASH + '.png', 4))
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), b"data")
+
+    def test_index_persisted(self):
+        getter = self._getter()
+        with mock.patch.object(image.httpclient, 'Transfer', fake_download('image/png', b"data")):
+            getter.get_image('ep1', URL)
+        getter.save_state()
+
+        # the saved index is used, with the order of use, not of the files
+        self._put('other.png', mtime=1000)
+        getter = self._getter()
+        self.assertEqual(list(getter.index), [URL_HASH, 'other'])
+
+    def test_index_reconciled(self):
+        self._put('old.png')
+        self._put('gone.png')
+        getter = self._getter()
+        self.assertEqual(len(getter.index), 2)
+        getter.save_state()
+
+        # the program crashed after this changed, without saving the index
+        os.remove(os.path.join(self.cache_dir, 'gone.png'))
+        self._put('new.png')
+        getter = self._getter()
+        self.assertEqual(self._files(getter), {'old': 'old.png', 'new': 'new.png'})
+        self.assertEqual(getter.total_bytes, 6)
+        self.assertTrue(getter._index_changed)
+
+    def test_missing_file_is_a_miss(self):
+        self._put(URL_HASH + '.jpeg')
+        getter = self._getter()
+        self.assertTrue(getter.is_cached(URL))
+        os.remove(os.path.join(self.cache_dir, URL_HASH + '.jpeg'))
+        self.assertFalse(getter.is_cached(URL))
+        self.assertNotIn(URL_HASH, getter.index)
+        self.assertEqual(getter.total_bytes, 0)
+
+    def test_missing_file_downloaded_again(self):
+        self._put(URL_HASH + '.jpeg')
+        getter = self._getter()
+        self.assertIn(URL_HASH, getter.index)
+        os.remove(os.path.join(self.cache_dir, URL_HASH + '.jpeg'))
+        with mock.patch.object(image.httpclient, 'Transfer', fake_download('image/png', b"data")):
+            getter.get_image('ep1', URL)
+        self.assertEqual(self.loaded, [('ep1', os.path.join(self.cache_dir, URL_HASH + '.png'))])
+
+    def test_index_broken(self):
+        self._put(image.INDEX_FILENAME, b"broken")
+        self._put(URL_HASH + '.jpeg')
+        getter = self._getter()
+        self.assertEqual(self._files(getter), {URL_HASH: URL_HASH + '.jpeg'})
+
+    def test_index_ordered_by_use(self):
+        self._put('new.png', mtime=3000)
+        self._put('old.png', mtime=1000)
+        self._put(URL_HASH + '.jpeg', mtime=2000)
+        getter = self._getter()
+        self.assertEqual(list(getter.index), ['old', URL_HASH, 'new'])
+
+        getter.get_image('ep1', URL)
+        self.assertEqual(list(getter.index), ['old', 'new', URL_HASH])
+
+    def test_evict_by_bytes(self):
+        self._limits(max_bytes=25)
+        self._put('a.png', b"x" * 10, mtime=1000)
+        self._put('b.png', b"x" * 10, mtime=2000)
+        self._put('c.png', b"x" * 10, mtime=3000)
+        getter = self._getter()
+        getter._index = getter._load_index()
+        getter.total_bytes = 30
+        getter.evict().join()
+        self.assertEqual(list(getter.index), ['b', 'c'])
+        self.assertEqual(getter.total_bytes, 20)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['b.png', 'c.png'])
+
+    def test_evict_on_download(self):
+        self._limits(max_images=2)
+        self._put('a.png', mtime=1000)
+        self._put('b.png', mtime=2000)
+        getter = self._getter()
+        self.assertEqual(len(getter.index), 2)
+        with mock.patch.object(image.httpclient, 'Transfer', fake_download('image/png', b"data")):
+            with mock.patch.object(image.threading, 'Thread') as fake_thread:
+                getter.get_image('ep1', URL)
+        self.assertEqual(list(getter.index), ['b', URL_HASH])
+        self.assertEqual(fake_thread.call_args[1]['args'], (['a.png'],))
+
+    def test_evicted_but_added_again(self):
+        getter = self._getter()
+        getter._doomed.add(URL_HASH + '.png')
+        with mock.patch.object(image.httpclient, 'Transfer', fake_download('image/png', b"data")):
+            getter.get_image('ep1', URL)
+
+        # the file is not removed, as it was downloaded again
+        getter._remove_files([URL_HASH + '.png'])
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, URL_HASH + '.png')))
+
+    def test_synthetic_big_cache(self):
+        quantity = 100000
+        for i in range(quantity):
+            self._put("%032x.jpeg" % (i,), b"x" * (i % 100), mtime=1000 + i)
+        self._limits(max_images=quantity // 2)
+        getter = self._getter()
+
+        tini = time.time()
+        getter._index = getter._load_index()
+        self.assertEqual(len(getter.index), quantity)
+        getter.total_bytes = sum(size for _, size, _ in getter._index.values())
+        thread = getter.evict()
+        self.assertLess(time.time() - tini, 10)
+        thread.join()
+
+        # the oldest half was removed, both from the index and the disk
+        self.assertEqual(len(getter.index), quantity // 2)
+        self.assertEqual(next(iter(getter.index)), "%032x" % (quantity // 2,))
+        self.assertEqual(len(os.listdir(self.cache_dir)), quantity // 2)
+        self.assertEqual(getter.total_bytes, sum(i % 100 for i in range(quantity // 2, quantity)))
+
+        # a hit is a dict lookup
+        tini = time.time()
+        for i in range(quantity // 2, quantity):
+            getter._touch("%032x" % (i,))
+        self.assertLess(time.time() - tini, 5)
+
+
+class PrefetcherTestCase(unittest.TestCase):
+    """Tests for the images prefetcher."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.getter = image.ImageGetter(lambda *a: None, tmpdir.name)
+        self.addCleanup(image.signal.store['save_state'].remove, self.getter.save_state)
+        self.transfers = {}
+        for patcher in (mock.patch.object(image.httpclient, 'Transfer', self._transfer),
+                        mock.patch.object(image.defer, 'Deferred', FakeDeferred),
+                        mock.patch.object(image.utils, 'run_in_thread', sync_in_thread)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.prefetcher = image.Prefetcher(self.getter, concurrency=2)
+
+    def _transfer(self, url):
+        """Build a fake transfer, keeping it."""
+        transfer = self.transfers[url] = FakeTransfer(url)
+        return transfer
+
+    def test_bounded(self):
+        self.prefetcher.set_wanted(['u1', 'u2', 'u3'])
+        self.assertEqual(list(self.transfers), ['u1', 'u2'])
+
+        # when one finishes, the next one starts
+        self.transfers['u2'].finish()
+        self.assertEqual(list(self.transfers), ['u1', 'u2', 'u3'])
+        self.assertTrue(self.getter.is_cached('u2'))
+
+    def test_problem_continues(self):
+        self.prefetcher.set_wanted(['u1', 'u2', 'u3'])
+        self.transfers['u1'].fail(ValueError())
+        self.assertEqual(list(self.transfers), ['u1', 'u2', 'u3'])
+
+    def test_cached_skipped(self):
+        self.prefetcher.set_wanted(['u1'])
+        self.transfers.pop('u1').finish()
+        self.prefetcher.set_wanted(['u1', 'u2'])
+        self.assertEqual(list(self.transfers), ['u2'])
+
+    def test_cancel_not_wanted(self):
+        self.prefetcher.set_wanted(['u1', 'u2', 'u3'])
+        u1 = self.transfers['u1']
+        u2 = self.transfers['u2']
+        self.prefetcher.set_wanted(['u2', 'u4', 'u3'])
+        self.assertIsInstance(u1.failed, image.DownloadCancelled)
+        self.assertIsNone(u2.failed)
+        self.assertEqual(list(self.transfers), ['u1', 'u2', 'u4'])
+
+        # the remaining wanted one starts when there's room
+        u2.finish()
+        self.assertEqual(list(self.transfers), ['u1', 'u2', 'u4', 'u3'])
+
+    def test_shares_the_download(self):
+        self.prefetcher.set_wanted(['u1'])
+        self.getter.get_image('ep1', 'u1')
+        self.assertEqual(list(self.transfers), ['u1'])
+
+        # not wanted by the prefetcher anymore, but still by the other
+        self.prefetcher.set_wanted([])
+        self.assertIsNone(self.transfers['u1'].failed)
+
+
+class DownloadsTestCase(unittest.TestCase):
+    """Tests for the images downloads."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.loaded = []
+        self.getter = image.ImageGetter(lambda *a: self.loaded.append(a), tmpdir.name)
+        self.addCleanup(image.signal.store['save_state'].remove, self.getter.save_state)
+        self.transfers = []
+        for patcher in (mock.patch.object(image.httpclient, 'Transfer', self._transfer),
+                        mock.patch.object(image.defer, 'Deferred', FakeDeferred),
+                        mock.patch.object(image.utils, 'run_in_thread', sync_in_thread)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _transfer(self, url):
+        """Build a fake transfer, keeping it."""
+        transfer = FakeTransfer(url)
+        self.transfers.append(transfer)
+        return transfer
+
+    def test_coalesced(self):
+        self.getter.get_image('ep1', URL)
+        self.getter.get_image('ep2', URL)
+        self.assertEqual(len(self.transfers), 1)
+
+        self.transfers[0].finish()
+        path = os.path.join(self.getter.cache_dir, URL_HASH + '.png')
+        self.assertEqual(self.loaded, [('ep1', path), ('ep2', path)])
+
+        # now it's in the cache
+        self.getter.get_image('ep3', URL)
+        self.assertEqual(len(self.transfers), 1)
+
+    def test_problem_told_to_all(self):
+        results = []
+        for _ in range(2):
+            deferred = self.getter.download(URL)
+            deferred.add_errback(lambda failure: results.append(failure.value))
+        error = ValueError()
+        self.transfers[0].fail(error)
+        self.assertEqual(results, [error, error])
+        self.assertFalse(self.getter.is_cached(URL))
+
+    def test_bounded(self):
+        for i in range(image.MAX_DOWNLOADS + 2):
+            self.getter.download('u%d' % (i,))
+        self.assertEqual(len(self.transfers), image.MAX_DOWNLOADS)
+
+        self.transfers[0].finish()
+        self.assertEqual(len(self.transfers), image.MAX_DOWNLOADS + 1)
+
+    def test_urgent_first(self):
+        for i in range(image.MAX_DOWNLOADS + 1):
+            self.getter.download('u%d' % (i,))
+        self.getter.get_image('ep1', URL)
+        self.getter.download('last')
+
+        self.transfers[0].finish()
+        self.transfers[1].finish()
+        self.assertEqual([t.url for t in self.transfers[image.MAX_DOWNLOADS:]],
+                         [URL, 'u%d' % (image.MAX_DOWNLOADS,)])
+
+    def test_cancel_waiting(self):
+        for i in range(image.MAX_DOWNLOADS):
+            self.getter.download('u%d' % (i,))
+        deferred = self.getter.download('other')
+        self.getter.cancel('other', deferred)
+        self.transfers[0].finish()
+        self.assertEqual(len(self.transfers), image.MAX_DOWNLOADS)
+
+    def test_cancel_running(self):
+        deferred = self.getter.download(URL)
+        self.getter.cancel(URL, deferred)
+        self.assertIsInstance(self.transfers[0].failed, image.DownloadCancelled)
+
+        # there's room again
+        for i in range(image.MAX_DOWNLOADS):
+            self.getter.download('u%d' % (i,))
+        self.assertEqual(len(self.transfers), image.MAX_DOWNLOADS + 1)
+
+    def test_reduced_in_the_cache(self):
+        self.getter.get_image('ep1', URL)
+        self.transfers[0].finish('image/png', build_image(2000, 1000, 'PNG'))
+        path = os.path.join(self.getter.cache_dir, URL_HASH + '.jpeg')
+        self.assertEqual(self.loaded, [('ep1', path)])
+        self.assertEqual(QImage(path).size().width(), image.DISPLAY_WIDTH)
+
+    def test_prepare_problem(self):
+        results = []
+        self.getter.download(URL).add_errback(lambda failure: results.append(failure.value))
+        with mock.patch.object(image, 'prepare_image', side_effect=ValueError("broken")):
+            self.transfers[0].finish('image/png', b"data")
+        self.assertEqual(len(results), 1)
+        self.assertFalse(self.getter.is_cached(URL))
+
+
+def build_image(width, height, fmt, alpha=False):
+    """Build an image, return its encoded data."""
+    qimage = QImage(width, height, QImage.Format_ARGB32 if alpha else QImage.Format_RGB32)
+    qimage.fill(QColor(255, 0, 0, 128 if alpha else 255))
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    qimage.save(buffer, fmt)
+    return bytes(buffer.data())
+
+
+class PrepareImageTestCase(unittest.TestCase):
+    """Tests for the preparation of the images to be cached."""
+
+    def test_small_as_it_came(self):
+        data = build_image(image.DISPLAY_WIDTH, image.DISPLAY_HEIGHT, 'PNG')
+        self.assertEqual(image.prepare_image('image/png', data), (data, 'png'))
+
+    def test_not_an_image(self):
+        self.assertEqual(image.prepare_image('image/png', b"data"), (b"data", 'png'))
+
+    def test_without_content_type(self):
+        data = build_image(10, 10, 'PNG')
+        self.assertEqual(image.prepare_image(None, data), (data, 'png'))
+        self.assertEqual(image.prepare_image(None, b"data"), (b"data", 'unknown'))
+
+    def test_content_type_parameters(self):
+        data = build_image(10, 10, 'JPEG')
+        self.assertEqual(image.prepare_image('image/jpeg; q=1', data), (data, 'jpeg'))
+
+    def test_big_reduced(self):
+        data = build_image(2000, 3000, 'PNG')
+        prepared, extension = image.prepare_image('image/png', data)
+        self.assertEqual(extension, 'jpeg')
+        self.assertLess(len(prepared), len(data))
+        qimage = QImage.fromData(prepared)
+        self.assertEqual((qimage.width(), qimage.height()), (360, image.DISPLAY_HEIGHT))
+
+    def test_transparency_kept(self):
+        data = build_image(2000, 1000, 'PNG', alpha=True)
+        prepared, extension = image.prepare_image('image/png', data)
+        self.assertEqual(extension, 'png')
+        qimage = QImage.fromData(prepared)
+        self.assertTrue(qimage.hasAlphaChannel())
+        self.assertEqual((qimage.width(), qimage.height()), (image.DISPLAY_WIDTH, 360))
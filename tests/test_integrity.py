@@ -0,0 +1,103 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the integrity checks of downloaded files."""
+
+import hashlib
+import os
+import struct
+import tempfile
+import unittest
+
+from encuentro import integrity
+
+
+def _box(box_type, payload):
+    """Build a MP4 box."""
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+# a MPEG-1 layer 3 frame header, 128 kbps, 44100 Hz, no padding: 417 bytes per frame
+MP3_FRAME = b'\xff\xfb\x90\x00' + b'\x00' * 413
+
+
+class CheckContainerTestCase(unittest.TestCase):
+    """Tests for the container sanity checks."""
+
+    def _write(self, content):
+        """Write a temp file with the content, return its path."""
+        fd, path = tempfile.mkstemp()
+        os.write(fd, content)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_mp4_ok(self):
+        content = _box(b'ftyp', b'isom\x00\x00\x02\x00') + _box(b'moov', b'x' * 20)
+        content += _box(b'mdat', b'y' * 100)
+        integrity.check_container(self._write(content))
+
+    def test_mp4_truncated(self):
+        content = _box(b'ftyp', b'isom\x00\x00\x02\x00') + _box(b'moov', b'x' * 20)
+        content += _box(b'mdat', b'y' * 100)
+        path = self._write(content[:-10])
+        self.assertRaises(integrity.IntegrityError, integrity.check_container, path)
+
+    def test_mp4_without_moov(self):
+        content = _box(b'ftyp', b'isom\x00\x00\x02\x00') + _box(b'mdat', b'y' * 100)
+        path = self._write(content)
+        self.assertRaises(integrity.IntegrityError, integrity.check_container, path)
+
+    def test_mp4_box_to_the_end(self):
+        content = _box(b'ftyp', b'isom\x00\x00\x02\x00') + _box(b'moov', b'x' * 20)
+        content += struct.pack(">I4s", 0, b'mdat') + b'y' * 100
+        integrity.check_container(self._write(content))
+
+    def test_mp3_ok(self):
+        integrity.check_container(self._write(MP3_FRAME * 10))
+
+    def test_mp3_with_id3(self):
+        tag = b'ID3\x03\x00\x00' + bytes([0, 0, 1, 0]) + b'\x00' * 128
+        integrity.check_container(self._write(tag + MP3_FRAME * 10))
+
+    def test_mp3_broken_sync(self):
+        path = self._write(MP3_FRAME * 2 + b'\x00' * 417 + MP3_FRAME * 3)
+        self.assertRaises(integrity.IntegrityError, integrity.check_container, path)
+
+    def test_empty(self):
+        self.assertRaises(integrity.IntegrityError, integrity.check_container, self._write(b''))
+
+    def test_unknown_container(self):
+        integrity.check_container(self._write(b'\x1aE\xdf\xa3 whatever mkv'))
+
+    def test_size(self):
+        path = self._write(b'12345')
+        integrity.check_size(path, 5)
+        integrity.check_size(path, None)
+        self.assertRaises(integrity.IntegrityError, integrity.check_size, path, 6)
+
+    def test_checksum(self):
+        hasher = integrity.StreamHasher()
+        hasher.update(b'foo')
+        hasher.update(b'bar')
+        expected = 'sha256:' + hashlib.sha256(b'foobar').hexdigest()
+        self.assertEqual(hasher.checksum(), expected)
+        self.assertEqual(hasher.size, 6)
+
+        path = self._write(b'foobar')
+        self.assertEqual(integrity.file_checksum(path), expected)
+        self.assertTrue(integrity.verify_checksum(path, expected))
+        self.assertFalse(integrity.verify_checksum(path, 'sha256:' + '0' * 64))
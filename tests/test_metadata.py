@@ -0,0 +1,213 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the metadata decoding."""
+
+import bz2
+import gzip
+import json
+import lzma
+import os
+import sys
+import unittest
+
+from encuentro import metadata
+
+# Adds server directory for imports
+sys.path.insert(0, 'server')
+from server import get_ted1_episodes, helpers
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+EPISODES = [
+    {'episode_id': 'a', 'title': "Año \"uno\", [1]", 'duration': 10},
+    {'episode_id': 'b', 'title': "dos", 'duration': None, 'tags': [1, 2, {'x': '}'}]},
+    12345,
+    "text, with ] inside",
+]
+
+
+def _split(text, size):
+    """Split the text in pieces of the given size."""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class IterArrayTestCase(unittest.TestCase):
+    """Tests for the incremental JSON array parser."""
+
+    def test_whole(self):
+        text = json.dumps(EPISODES)
+        self.assertEqual(list(metadata.iter_array([text])), EPISODES)
+
+    def test_any_split(self):
+        text = json.dumps(EPISODES, indent=2)
+        for size in range(1, 40):
+            self.assertEqual(list(metadata.iter_array(_split(text, size))), EPISODES, size)
+
+    def test_empty(self):
+        self.assertEqual(list(metadata.iter_array([" [ ", " ] "])), [])
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(metadata.iter_array(['{"a": 1}']))
+
+    def test_truncated(self):
+        text = json.dumps(EPISODES)
+        with self.assertRaises(ValueError):
+            list(metadata.iter_array(_split(text[:-1], 7)))
+
+    def test_truncated_inside_item(self):
+        text = json.dumps(EPISODES)
+        with self.assertRaises(ValueError):
+            list(metadata.iter_array(_split(text[:20], 7)))
+
+    def test_bad_separator(self):
+        with self.assertRaises(ValueError):
+            list(metadata.iter_array(['[1; 2]']))
+
+    def test_extra_content(self):
+        with self.assertRaises(ValueError):
+            list(metadata.iter_array(['[1, 2]', ' 3']))
+
+    def test_items_before_the_end(self):
+        # the first item is given while the rest is still missing
+        items = metadata.iter_array(iter(['[{"a": 1}, {"b"']))
+        self.assertEqual(next(items), {'a': 1})
+
+
+class IterDecompressedTestCase(unittest.TestCase):
+    """Tests for the incremental decompression."""
+
+    def test_roundtrip(self):
+        text = json.dumps(EPISODES * 100, ensure_ascii=False)
+        compressed = bz2.compress(text.encode('utf-8'))
+        pieces = metadata.iter_decompressed(compressed, chunk_size=50)
+        self.assertEqual("".join(pieces), text)
+
+    def test_truncated(self):
+        compressed = bz2.compress(json.dumps(EPISODES).encode('utf-8'))
+        with self.assertRaises(ValueError):
+            list(metadata.iter_decompressed(compressed[:-10]))
+
+    def test_parse_compressed(self):
+        compressed = bz2.compress(json.dumps(EPISODES).encode('utf-8'))
+        items = metadata.iter_array(metadata.iter_decompressed(compressed, chunk_size=10))
+        self.assertEqual(list(items), EPISODES)
+        self.assertEqual(metadata.decode(compressed), EPISODES)
+
+    def test_stats(self):
+        raw = json.dumps(EPISODES).encode('utf-8')
+        compressed = bz2.compress(raw)
+        stats = {}
+        self.assertEqual(metadata.decode(compressed, stats=stats), EPISODES)
+        self.assertEqual(stats['decompressed_bytes'], len(raw))
+        self.assertGreater(stats['decompress'], 0)
+        self.assertGreaterEqual(stats['parse'], 0)
+
+
+class CodecsTestCase(unittest.TestCase):
+    """Tests for the different compressions."""
+
+    def _check(self, codec, compressed):
+        items = metadata.iter_array(metadata.iter_decompressed(compressed, codec, chunk_size=10))
+        self.assertEqual(list(items), EPISODES)
+        self.assertEqual(metadata.decode(compressed, codec), EPISODES)
+
+    def test_gzip(self):
+        self._check('gz', gzip.compress(json.dumps(EPISODES).encode('utf-8')))
+
+    def test_xz(self):
+        self._check('xz', lzma.compress(json.dumps(EPISODES).encode('utf-8')))
+
+    @unittest.skipIf(metadata.zstandard is None, "zstandard not installed")
+    def test_zstd(self):
+        compressor = metadata.zstandard.ZstdCompressor()
+        self._check('zst', compressor.compress(json.dumps(EPISODES).encode('utf-8')))
+
+    def test_truncated_gzip(self):
+        compressed = gzip.compress(json.dumps(EPISODES).encode('utf-8'))
+        with self.assertRaises(ValueError):
+            list(metadata.iter_decompressed(compressed[:-10], 'gz'))
+
+    def test_choose_faster(self):
+        self.assertEqual(metadata.choose_codec(['bz2', 'xz']), 'xz')
+        self.assertEqual(metadata.choose_codec(['bz2', 'xz', 'gz']), 'gz')
+
+    def test_choose_unknown(self):
+        self.assertEqual(metadata.choose_codec(['foo']), 'bz2')
+
+    def test_choose_zstd_if_available(self):
+        expected = 'gz' if metadata.zstandard is None else 'zst'
+        self.assertEqual(metadata.choose_codec(['bz2', 'gz', 'zst']), expected)
+
+
+class ECATTestCase(unittest.TestCase):
+    """Tests for the compact binary catalog format."""
+
+    def _roundtrip(self, items):
+        encoded = helpers.encode_ecat(items)
+        self.assertEqual(list(metadata.iter_ecat(encoded)), items)
+
+    def _fixture(self, *path):
+        with open(os.path.join(TESTS_DIR, *path), encoding='utf-8') as fh:
+            content = json.load(fh)
+        return content if isinstance(content, list) else [content]
+
+    def test_contar_fixtures(self):
+        for fname in sorted(os.listdir(os.path.join(TESTS_DIR, 'contar'))):
+            with self.subTest(fname=fname):
+                self._roundtrip(self._fixture('contar', fname))
+
+    def test_ted1_fixture(self):
+        self._roundtrip(self._fixture('ted1', 'episode.json'))
+
+    def test_ted1_scraped_episode(self):
+        raw = self._fixture('ted1', 'episode.json')[0]
+        self._roundtrip([get_ted1_episodes.parse_episode(raw)])
+
+    def test_all_fixtures_together(self):
+        items = self._fixture('ted1', 'episode.json')
+        for fname in sorted(os.listdir(os.path.join(TESTS_DIR, 'contar'))):
+            items.extend(self._fixture('contar', fname))
+        self._roundtrip(items)
+
+    def test_missing_and_none(self):
+        self._roundtrip(EPISODES[:2] + [{'episode_id': 'c', 'title': None}, {}])
+
+    def test_empty(self):
+        self._roundtrip([])
+
+    def test_strings_shared(self):
+        items = [{'channel': "Canal con nombre largo", 'n': i} for i in range(100)]
+        encoded = helpers.encode_ecat(items)
+        self.assertEqual(encoded.count("Canal con nombre largo".encode('ascii')), 1)
+        self._roundtrip(items)
+
+    def test_not_ecat(self):
+        with self.assertRaises(ValueError):
+            list(metadata.iter_ecat(b'[{"a": 1}]'))
+
+    def test_truncated(self):
+        encoded = helpers.encode_ecat(EPISODES[:2])
+        with self.assertRaises(ValueError):
+            list(metadata.iter_ecat(encoded[:-3]))
+
+    def test_decoded_by_extension(self):
+        encoded = helpers.encode_ecat(EPISODES[:2])
+        self.assertEqual(list(metadata.iter_decoded(gzip.compress(encoded), 'ecat.gz')),
+                         EPISODES[:2])
+        compressed = gzip.compress(json.dumps(EPISODES).encode('ascii'))
+        self.assertEqual(list(metadata.iter_decoded(compressed, 'gz')), EPISODES)
@@ -0,0 +1,328 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the network helpers."""
+
+import collections
+import collections.abc
+import os
+import queue
+import sys
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+import defer
+
+from encuentro import diskspace, integrity, network
+from encuentro.config import config
+
+from tests.test_httpclient import (
+    CONTENT, LocalServer, content, error, get_app, wait_for)
+
+
+def use_real_deferreds(test):
+    """Let the real deferreds chain callbacks, which needs something gone from modern Pythons."""
+    patcher = mock.patch.object(
+        collections, 'Callable', collections.abc.Callable, create=True)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+def through_deferred(test, err):
+    """Raise the error in a deferred function, returning what its caller gets.
+
+    It's what happens with the download errors, which 'defer' rebuilds when raising them
+    again (that's why the real deferreds are used here).
+    """
+    use_real_deferreds(test)
+
+    @defer.inline_callbacks
+    def inner():
+        """Fail after waiting something."""
+        deferred = defer.Deferred()
+        deferred.callback(None)
+        yield deferred
+        raise err
+
+    caught = []
+
+    @defer.inline_callbacks
+    def outer():
+        """Get the error from the inner one."""
+        try:
+            yield inner()
+        except Exception as exc:
+            caught.append(exc)
+
+    outer()
+    (exc,) = caught
+    test.assertIsInstance(exc, type(err))
+    test.assertIsNot(exc, err)  # really rebuilt
+    return exc
+
+
+class DownloadError(Exception):
+    """Mimic the youtube-dl error, that wraps the original one."""
+
+    def __init__(self, msg, exc_info=None):
+        super(DownloadError, self).__init__(msg)
+        self.exc_info = exc_info
+
+
+class ExtractorError(Exception):
+    """Mimic the youtube-dl error of the extractors, wrapped by its DownloadError."""
+
+    def __init__(self, msg, cause=None):
+        super(ExtractorError, self).__init__(msg)
+        self.cause = cause
+
+
+class HTTPError(Exception):
+    """Mimic the urllib error that has the HTTP status."""
+
+    def __init__(self, code):
+        super(HTTPError, self).__init__("HTTP Error %d" % (code,))
+        self.code = code
+
+
+class FakeYoutubeDL:
+    """Mimic the youtube-dl downloader, reporting the progress of two files joined later."""
+
+    def __init__(self, conf):
+        self.conf = conf
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def extract_info(self, url, download):
+        return dict(requested_formats=[dict(filesize=200), dict(filesize=100)])
+
+    def process_ie_result(self, info, download):
+        for filename, downloaded, total in (('video', 100, 200), ('video', 200, 200),
+                                            ('audio', 60, 100), ('audio', 100, 100)):
+            for hook in self.conf['progress_hooks']:
+                hook(dict(filename=filename, downloaded_bytes=downloaded, total_bytes=total))
+
+
+def _youtubedl_error(msg, wrapped=None):
+    """Build the error as youtube-dl raises it."""
+    exc_info = None if wrapped is None else (type(wrapped), wrapped, None)
+    return DownloadError("ERROR: " + msg, exc_info=exc_info)
+
+
+class ClassifyErrorTestCase(unittest.TestCase):
+    """Tests for the download errors classification."""
+
+    def test_cancelled(self):
+        err = network.CancelledError()
+        self.assertEqual(network.classify_error(err), network.ERROR_CANCELLED)
+
+    def test_server_error_is_transient(self):
+        err = network.NetworkError(403, 503, "Service Unavailable")
+        self.assertEqual(network.classify_error(err), network.ERROR_TRANSIENT)
+
+    def test_client_error_is_permanent(self):
+        err = network.NetworkError(203, 404, "Not Found")
+        self.assertEqual(network.classify_error(err), network.ERROR_PERMANENT)
+
+    def test_throttling_is_transient(self):
+        err = network.NetworkError(299, 429, "Too Many Requests")
+        self.assertEqual(network.classify_error(err), network.ERROR_TRANSIENT)
+
+    def test_network_layer_is_transient(self):
+        err = network.NetworkError(2, None, "Connection closed")
+        self.assertEqual(network.classify_error(err), network.ERROR_TRANSIENT)
+
+    def test_youtubedl_status_in_message(self):
+        err = DownloadError("ERROR: unable to download video data: HTTP Error 403: Forbidden")
+        self.assertEqual(network.classify_error(err), network.ERROR_PERMANENT)
+
+    def test_youtubedl_without_status(self):
+        err = DownloadError("ERROR: timed out")
+        self.assertEqual(network.classify_error(err), network.ERROR_TRANSIENT)
+
+    def test_youtubedl_unavailable_is_permanent(self):
+        for msg in ("This video is unavailable.", "Private video", "Unsupported URL: foo",
+                    "This video has been removed by the user"):
+            with self.subTest(msg=msg):
+                err = _youtubedl_error(msg)
+                self.assertEqual(network.classify_error(err), network.ERROR_PERMANENT)
+
+    def test_youtubedl_wrapped_status(self):
+        err = _youtubedl_error("Unable to download webpage", ExtractorError(
+            "Unable to download webpage", cause=HTTPError(404)))
+        self.assertEqual(network.classify_error(err), network.ERROR_PERMANENT)
+
+        err = _youtubedl_error("Unable to download webpage", ExtractorError(
+            "Unable to download webpage", cause=HTTPError(503)))
+        self.assertEqual(network.classify_error(err), network.ERROR_TRANSIENT)
+
+    def test_youtubedl_other_is_transient(self):
+        err = _youtubedl_error("Unable to extract", ExtractorError("Unable to extract"))
+        self.assertEqual(network.classify_error(err), network.ERROR_TRANSIENT)
+
+    def test_unknown_is_permanent(self):
+        err = KeyError('format_id')
+        self.assertEqual(network.classify_error(err), network.ERROR_PERMANENT)
+
+    def test_network_error_through_deferred(self):
+        err = through_deferred(self, network.NetworkError(203, 404, "Not Found"))
+        self.assertEqual(err.http_status, 404)
+        self.assertEqual(str(err), "Network error 203 (HTTP status 404): Not Found")
+        self.assertEqual(network.classify_error(err), network.ERROR_PERMANENT)
+
+        err = through_deferred(self, network.NetworkError(403, 503, "Service Unavailable"))
+        self.assertEqual(network.classify_error(err), network.ERROR_TRANSIENT)
+
+    def test_foreign_error_through_deferred(self):
+        orig = DownloadError("ERROR: unable to download video data: HTTP Error 404: Not Found")
+        err = through_deferred(self, orig)
+        self.assertEqual(network.classify_error(err), network.ERROR_PERMANENT)
+
+    def test_status_from_own_message(self):
+        err = Exception("Network error 403 (HTTP status 503): Service Unavailable")
+        self.assertEqual(network.classify_error(err), network.ERROR_TRANSIENT)
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+    """Tests for the retry policy."""
+
+    def test_retry_transient_until_cap(self):
+        policy = network.RetryPolicy(max_attempts=3)
+        err = network.NetworkError(2, None, "Connection closed")
+        self.assertTrue(policy.should_retry(err, 1))
+        self.assertTrue(policy.should_retry(err, 2))
+        self.assertFalse(policy.should_retry(err, 3))
+
+    def test_no_retry_permanent(self):
+        policy = network.RetryPolicy(max_attempts=3)
+        err = network.NetworkError(203, 404, "Not Found")
+        self.assertFalse(policy.should_retry(err, 1))
+
+    def test_delay_grows_with_jitter(self):
+        policy = network.RetryPolicy(base_delay=4, max_delay=20)
+        for attempt, top in [(1, 4), (2, 8), (3, 16), (4, 20), (9, 20)]:
+            delay = policy.next_delay(attempt)
+            self.assertGreaterEqual(delay, top / 2)
+            self.assertLessEqual(delay, top)
+
+
+class GenericDownloaderTestCase(unittest.TestCase):
+    """Tests for the generic downloader, against a local server."""
+
+    def setUp(self):
+        get_app()
+        use_real_deferreds(self)
+        self.server = LocalServer(self)
+
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.downloaddir = tempdir.name
+        previous = config.get('downloaddir')
+        config['downloaddir'] = self.downloaddir
+        if previous is None:
+            self.addCleanup(config.pop, 'downloaddir', None)
+        else:
+            self.addCleanup(config.__setitem__, 'downloaddir', previous)
+
+    def _download(self, downloader):
+        """Download the server's file, return the deferred result."""
+        downloader.download("channel", "section", None, "title", self.server.url, lambda m: None)
+        return wait_for(downloader.deferred)
+
+    def test_error_body_not_saved(self):
+        self.server.respond(error(503, b"busy"))
+        downloader = network.GenericAudioDownloader()
+        result = self._download(downloader)
+        self.assertEqual(result.value.http_status, 503)
+
+        # the retry gets all the content, and only that is in the file
+        fname = self._download(downloader)
+        self.assertNotIn('Range', self.server.requests[1])
+        with open(fname, 'rb') as fh:
+            self.assertEqual(fh.read(), CONTENT)
+        self.assertEqual(fname, os.path.join(self.downloaddir, "channel", "section", "title.mp3"))
+
+    def test_empty_error(self):
+        self.server.respond(error(404))
+        result = self._download(network.GenericAudioDownloader())
+        self.assertEqual(result.value.http_status, 404)
+
+    def test_empty_content(self):
+        self.server.respond(content(b""))
+        result = self._download(network.GenericAudioDownloader())
+        self.assertIsInstance(result.value, integrity.IntegrityError)
+
+    def test_not_enough_space(self):
+        with mock.patch.object(diskspace, 'free_space', return_value=10 * diskspace.MB):
+            result = self._download(network.GenericAudioDownloader())
+        self.assertIsInstance(result.value, diskspace.NotEnoughSpace)
+        self.assertEqual(result.value.needed, len(CONTENT))
+
+    def _reserved_while_downloading(self, preallocated):
+        """Download, return the space reserved each time the progress is reported."""
+        reserved = []
+        downloader = network.GenericAudioDownloader()
+        with mock.patch.object(diskspace, 'preallocate', return_value=preallocated):
+            downloader.download("channel", "section", None, "title", self.server.url,
+                                lambda m: reserved.append(diskspace.reservations.total()))
+            wait_for(downloader.deferred)
+        return reserved
+
+    def test_preallocated_not_reserved(self):
+        self.assertEqual(set(self._reserved_while_downloading(preallocated=True)), {0})
+
+    def test_reserved_only_what_is_not_written(self):
+        reserved = self._reserved_while_downloading(preallocated=False)
+        self.assertEqual(reserved, sorted(reserved, reverse=True))
+        self.assertLess(reserved[0], len(CONTENT))
+        self.assertEqual(reserved[-1], 0)
+
+
+class ThreadedYTTestCase(unittest.TestCase):
+    """Tests for the youtube-dl downloads."""
+
+    def setUp(self):
+        patcher = mock.patch.dict(sys.modules, {'youtube_dl': mock.Mock(YoutubeDL=FakeYoutubeDL)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(diskspace.reservations.release, self)
+
+    def test_written_shrinks_reservation(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        written = []
+
+        def admit(size):
+            diskspace.admit(tempdir.name, self, size)
+
+        def write(size):
+            written.append(size)
+            diskspace.reservations.consume(self, size)
+
+        thyt = network.ThreadedYT(
+            "http://example.com/video", os.path.join(tempdir.name, "video"), queue.Queue(),
+            threading.Event(), lambda *args: None, admit=admit, written=write)
+        thyt._really_download()
+        self.assertEqual(written, [100, 100, 60, 40])
+        self.assertEqual(diskspace.reservations.total(), 0)
+        self.assertEqual(thyt.output_queue.get_nowait(), "50.0% (de 0 MB)")
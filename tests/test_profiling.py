@@ -0,0 +1,145 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the profiling helpers."""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+from unittest import mock
+
+from encuentro import profiling
+from encuentro.profiling import PhaseTimer
+
+# what the main module can take to import (in seconds), quite generous to not fail in slow
+# machines, but not so much that something heavy gets in unnoticed
+IMPORT_BUDGET = 1.5
+
+# modules that are too slow to import and must be imported only when used
+HEAVY_MODULES = ['youtube_dl', 'requests']
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class PhaseTimerTestCase(unittest.TestCase):
+    """Tests for the phases timer."""
+
+    def test_phase(self):
+        timer = PhaseTimer('test')
+        with timer.phase('download', 'foo.bz2') as counts:
+            counts['bytes'] = 123
+        (record,) = timer.records
+        self.assertEqual(record['process'], 'test')
+        self.assertEqual(record['phase'], 'download')
+        self.assertEqual(record['target'], 'foo.bz2')
+        self.assertEqual(record['bytes'], 123)
+        self.assertEqual(record['items'], 0)
+        self.assertGreaterEqual(record['seconds'], 0)
+
+    def test_phase_with_error(self):
+        timer = PhaseTimer('test')
+        with self.assertRaises(ValueError):
+            with timer.phase('parse'):
+                raise ValueError()
+        self.assertEqual([r['phase'] for r in timer.records], ['parse'])
+
+    def test_summary(self):
+        timer = PhaseTimer('test')
+        timer.add('download', 1, 'a', nbytes=10)
+        timer.add('parse', 3, 'a', items=5)
+        timer.add('download', 2, 'b', nbytes=20)
+        self.assertEqual(list(timer.summary().items()), [
+            ('download', (3, 30, 0)),
+            ('parse', (3, 0, 5)),
+        ])
+
+    def test_report_is_json(self):
+        timer = PhaseTimer('test')
+        timer.add('download', 1.5, 'a', nbytes=10)
+        report = json.loads(json.dumps(timer.report()))
+        self.assertEqual(report['process'], 'test')
+        self.assertEqual(
+            report['summary'], {'download': {'seconds': 1.5, 'bytes': 10, 'items': 0}})
+        self.assertEqual(len(report['records']), 1)
+
+
+class ImportCostsTestCase(unittest.TestCase):
+    """Tests for the measuring of what costs to import stuff."""
+
+    def test_not_available(self):
+        with mock.patch.object(profiling, 'IMPORT_TIMES_AVAILABLE', False):
+            with self.assertRaises(RuntimeError):
+                profiling.import_costs('encuentro.main')
+
+    def test_parse(self):
+        output = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       100 |        100 |   _bar",
+            "import time:       250 |        350 | foo",
+            "some other stuff",
+        ])
+        self.assertEqual(profiling.parse_import_times(output), [
+            ('_bar', 0.0001, 0.0001, 1),
+            ('foo', 0.00025, 0.00035, 0),
+        ])
+
+    def test_format(self):
+        costs = [('_bar', 0.1, 0.1, 1), ('foo', 0.25, 0.35, 0)]
+        lines = profiling.format_import_costs(costs, limit=1).split("\n")
+        self.assertEqual(lines[0], "Import total: 0.350 seg (2 modules)")
+        self.assertEqual(lines[2].split(), ["0.2500", "0.3500", "foo"])
+        self.assertEqual(len(lines), 3)
+
+    def test_heavy_modules_not_imported(self):
+        code = "import sys, encuentro.main; print(' '.join(sorted(sys.modules)))"
+        proc = subprocess.run(
+            [sys.executable, '-c', code], cwd=PROJECT_DIR, stdout=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        imported = proc.stdout.splitlines()[-1].split()
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, imported)
+
+    @unittest.skipUnless(profiling.IMPORT_TIMES_AVAILABLE, "Needs Python 3.7 or newer")
+    def test_import_budget(self):
+        costs = profiling.import_costs('encuentro.main')
+        total = sum(self_seconds for _, self_seconds, _, _ in costs)
+        self.assertLess(total, IMPORT_BUDGET, profiling.format_import_costs(costs))
+
+
+class StartupProfilerTestCase(unittest.TestCase):
+    """Tests for the start up profiling."""
+
+    def test_not_profiling(self):
+        self.assertIsNone(profiling.startup)
+        with profiling.startup_phase('config') as counts:
+            counts['items'] = 3
+
+    def test_phases(self):
+        profiler = profiling.StartupProfiler(time.perf_counter())
+        with mock.patch.object(profiling, 'startup', profiler):
+            with profiling.startup_phase('data_load') as counts:
+                counts['items'] = 3
+        self.assertEqual([r['phase'] for r in profiler.timer.records], ['bin', 'data_load'])
+
+        with mock.patch('builtins.print') as fake_print:
+            profiler.finish()
+        (summary,), _ = fake_print.call_args
+        self.assertIn("data_load (3 items)", summary)
+        self.assertEqual(summary.split("\n")[-1].split()[1], 'total')
@@ -0,0 +1,86 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the program start up."""
+
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from encuentro import data
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# how many episodes has the catalog to start with
+CATALOG_SIZE = 50000
+
+# how long the whole start up can take (in seconds), overridable for slow machines
+STARTUP_BUDGET = float(os.environ.get('ENCUENTRO_STARTUP_BUDGET', 6))
+
+
+def _build_catalog(filename, size):
+    """Save a synthetic catalog of episodes, as the program does."""
+    episodes = {}
+    for i in range(size):
+        episode = data.EpisodeData(
+            channel="Canal %d" % (i % 20,), section="Sección %d" % (i % 50,),
+            title="Episodio %d" % (i,), duration=30, description="Este es el episodio %d" % (i,),
+            episode_id="ep%d" % (i,), url="http://example.com/video/%d" % (i,),
+            image_url="http://example.com/image/%d.jpg" % (i,))
+        episodes[episode.episode_id] = episode
+    with open(filename, 'wb') as fh:
+        pickle.dump((data.ProgramsData.last_programs_version, episodes, {}), fh)
+
+
+class StartupTestCase(unittest.TestCase):
+    """Start the real program, with a big catalog."""
+
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.env = dict(
+            os.environ, QT_QPA_PLATFORM='offscreen', HOME=tempdir.name,
+            XDG_CONFIG_HOME=os.path.join(tempdir.name, 'config'),
+            XDG_DATA_HOME=os.path.join(tempdir.name, 'data'),
+            XDG_CACHE_HOME=os.path.join(tempdir.name, 'cache'))
+        for name in ('XDG_CONFIG_HOME', 'XDG_DATA_HOME', 'XDG_CACHE_HOME'):
+            os.makedirs(self.env[name])
+
+        # not the first run, so no wizard
+        with open(os.path.join(self.env['XDG_CONFIG_HOME'], 'encuentro.conf'), 'wb') as fh:
+            pickle.dump({'system': {}, 'nowizard': True}, fh)
+
+        _build_catalog(os.path.join(self.env['XDG_DATA_HOME'], 'encuentro.data'), CATALOG_SIZE)
+        self.report_file = os.path.join(tempdir.name, 'startup.json')
+
+    def test_cold_start_budget(self):
+        cmd = [sys.executable, os.path.join(PROJECT_DIR, 'bin', 'encuentro'),
+               '--profile-startup', self.report_file]
+        proc = subprocess.run(
+            cmd, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, timeout=STARTUP_BUDGET * 5)
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+
+        with open(self.report_file, 'rt', encoding='utf8') as fh:
+            report = json.load(fh)
+        summary = report['summary']
+        self.assertEqual(summary['data_load']['items'], CATALOG_SIZE)
+        self.assertEqual(summary['load_episodes']['items'], CATALOG_SIZE)
+        self.assertLess(summary['total']['seconds'], STARTUP_BUDGET, proc.stdout)
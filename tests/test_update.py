@@ -0,0 +1,331 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the episodes updater."""
+
+import hashlib
+import time
+import unittest
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+import defer
+
+from encuentro import httpclient, profiling, update
+from encuentro.config import config
+
+from tests.test_network import use_real_deferreds
+
+
+class FakeDownloads:
+    """Just what the scheduler needs from the downloads widget."""
+
+    downloading = False
+
+
+class FakeMainWindow:
+    """Just what the scheduler and the updater need from the main window."""
+
+    def __init__(self):
+        self.episodes_download = FakeDownloads()
+        self.episodes_download.queue = []
+        self.programs_data = ["some episode"]
+
+
+def fired(result):
+    """Return a deferred already fired with the result."""
+    deferred = defer.Deferred()
+    deferred.callback(result)
+    return deferred
+
+
+class GetBackendTestCase(unittest.TestCase):
+    """Tests for getting the content of a backend."""
+
+    def setUp(self):
+        use_real_deferreds(self)
+        self.updater = update.UpdateEpisodes(FakeMainWindow(), None)
+        self.updater.timer = profiling.PhaseTimer('test')
+        self.requested = []
+
+    def _get_backend(self, server_content, previous, options=None):
+        """Get the backend, the server answering with the content (None if not modified)."""
+        def fake_get(filename, validators=None, phase='download'):
+            self.requested.append((filename, validators))
+            return fired((server_content, {'etag': 'new-etag', 'last_modified': None}))
+
+        self.updater._get = fake_get
+        results = []
+        self.updater._get_backend('back.bz2', options or {}, previous).add_callback(
+            results.append)
+        (result,) = results
+        return result
+
+    def test_not_modified_request(self):
+        responses = []
+
+        def fake_fetch(url, headers):
+            responses.append((url, headers))
+            return fired(httpclient.Response(304, {}, b""))
+
+        results = []
+        validators = {'etag': 'the-etag', 'last_modified': 'some-date'}
+        with mock.patch.object(update.httpclient, 'fetch', fake_fetch):
+            self.updater._get_content('back.bz2', validators).add_callback(results.append)
+        self.assertEqual(results, [(None, validators)])
+        ((url, headers),) = responses
+        self.assertEqual(url, update.BACKENDS_BASE_URL + 'back.bz2')
+        self.assertEqual(headers, {'If-None-Match': 'the-etag', 'If-Modified-Since': 'some-date'})
+
+    def test_not_modified(self):
+        previous = {'etag': 'old-etag', 'hash': 'old-hash'}
+        kind, extension, content, state = self._get_backend(None, previous)
+        self.assertEqual(self.requested, [('back.bz2', previous)])
+        self.assertEqual((kind, extension, content), ('snapshot', 'bz2', None))
+        self.assertEqual(state, dict(previous, version=None))
+
+    def test_same_hash_skipped(self):
+        previous = {'etag': 'old-etag', 'hash': hashlib.sha256(b"episodes").hexdigest()}
+        kind, extension, content, state = self._get_backend(b"episodes", previous)
+        self.assertIsNone(content)
+        self.assertEqual(state['hash'], previous['hash'])
+        self.assertEqual(state['etag'], 'new-etag')
+
+    def test_changed(self):
+        previous = {'etag': 'old-etag', 'hash': 'old-hash'}
+        kind, extension, content, state = self._get_backend(b"episodes", previous)
+        self.assertEqual(content, b"episodes")
+        self.assertEqual(state['hash'], hashlib.sha256(b"episodes").hexdigest())
+
+
+class UpdateTestCase(unittest.TestCase):
+    """Tests for the whole update of the backends."""
+
+    def setUp(self):
+        use_real_deferreds(self)
+        system = config.setdefault(config.SYSTEM, {})
+        saved_state = system.pop(update.BACKENDS_STATE, None)
+        saved_last_time = config.get('autorefresh_last_time')
+
+        def restore():
+            system.pop(update.BACKENDS_STATE, None)
+            if saved_state is not None:
+                system[update.BACKENDS_STATE] = saved_state
+            config['autorefresh_last_time'] = saved_last_time
+        self.addCleanup(restore)
+        patcher = mock.patch.object(config, 'save')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.updater = update.UpdateEpisodes(FakeMainWindow(), None, concurrency=2)
+        backends = "".join("b%d generic b%d.bz2\n" % (i, i) for i in range(4))
+        self.updater._get = lambda filename, phase: fired((backends.encode('utf8'), None))
+        self.started = []
+
+        def fake_get_backend(filename, options, previous):
+            deferred = defer.Deferred()
+            self.started.append((filename, previous, deferred))
+            return deferred
+        self.updater._get_backend = fake_get_backend
+
+    def _unchanged(self, position):
+        """Finish the backend download without changes."""
+        filename, _, deferred = self.started[position]
+        deferred.callback(('snapshot', 'bz2', None, {'hash': filename}))
+
+    def test_concurrency_bound(self):
+        config[config.SYSTEM][update.BACKENDS_STATE] = {'b1.bz2': {'hash': 'old'}}
+        self.updater.background()
+        self.assertEqual([filename for filename, _, _ in self.started], ['b0.bz2', 'b1.bz2'])
+        self.assertEqual(self.started[1][1], {'hash': 'old'})
+
+        self._unchanged(1)
+        self.assertEqual(len(self.started), 3)
+        self._unchanged(0)
+        self.assertEqual(len(self.started), 4)
+
+    def test_failure_isolated(self):
+        self.updater.background()
+        self._unchanged(0)
+        self.started[1][2].errback(ValueError("boom"))
+        self._unchanged(2)
+        self._unchanged(3)
+
+        # the others were updated, the failed one will be tried again
+        self.assertEqual(config[config.SYSTEM][update.BACKENDS_STATE], {
+            'b0.bz2': {'hash': 'b0.bz2'},
+            'b2.bz2': {'hash': 'b2.bz2'},
+            'b3.bz2': {'hash': 'b3.bz2'},
+        })
+
+
+class UpdateSchedulerTestCase(unittest.TestCase):
+    """Tests for the background updates scheduler."""
+
+    def setUp(self):
+        saved = {k: config.get(k) for k in ('autorefresh', 'autorefresh_last_time')}
+        self.addCleanup(config.update, saved)
+        config['autorefresh'] = False
+        config['autorefresh_last_time'] = datetime.now()
+
+        self.main_window = FakeMainWindow()
+        self.scheduler = update.UpdateScheduler(self.main_window, None)
+        self.runs = []
+        self.scheduler._run = lambda updater, interactive=False: self.runs.append(
+            (updater, interactive))
+
+        # started long ago, and no user input lately
+        self.scheduler.track_input(self.scheduler)
+        self.scheduler._started = self.scheduler._last_input = time.monotonic() - 3600
+
+    def _check(self):
+        """Check, returning the concurrency of the update done (None if not done)."""
+        with mock.patch.object(update, 'UpdateEpisodes') as fake_updater:
+            self.scheduler._check()
+        if not self.runs:
+            return
+        return fake_updater.call_args[0][2]
+
+    def test_next_with_jitter(self):
+        last = datetime(2020, 5, 1)
+        for autorefresh, period in ((True, update.REFRESH_PERIOD),
+                                    (False, update.REFRESH_PERIOD_NO_AUTO)):
+            config['autorefresh'] = autorefresh
+            self.scheduler._schedule_next(last)
+            self.assertGreaterEqual(self.scheduler._due, last + period)
+            self.assertLessEqual(self.scheduler._due, last + period * (1 + update.REFRESH_JITTER))
+
+    def test_due(self):
+        self.scheduler._due = datetime.now() - timedelta(seconds=1)
+        self.assertEqual(self._check(), update.BACKENDS_CONCURRENCY)
+
+    def test_not_due(self):
+        self.scheduler._due = datetime.now() + timedelta(minutes=1)
+        self.assertIsNone(self._check())
+
+    def test_never_overlaps(self):
+        self.scheduler._due = datetime.now() - timedelta(seconds=1)
+        self.scheduler.running = True
+        self.assertIsNone(self._check())
+
+    def test_not_idle(self):
+        self.scheduler._due = datetime.now() - timedelta(seconds=1)
+        self.scheduler._last_input = time.monotonic()
+        self.assertIsNone(self._check())
+
+    def test_just_started(self):
+        self.scheduler._due = datetime.now() - timedelta(seconds=1)
+        self.scheduler._started = time.monotonic()
+        self.assertIsNone(self._check())
+
+    def test_downloading_postponed(self):
+        self.main_window.episodes_download.downloading = True
+        self.scheduler._due = datetime.now() - timedelta(seconds=1)
+        self.assertIsNone(self._check())
+
+    def test_downloading_postponed_too_much(self):
+        self.main_window.episodes_download.downloading = True
+        self.scheduler._due = datetime.now() - update.MAX_DOWNLOADS_POSTPONE * 2
+        self.assertEqual(self._check(), 1)
+
+    def test_input_tracked_when_due(self):
+        scheduler = update.UpdateScheduler(self.main_window, None)
+        scheduler._run = self.scheduler._run
+        scheduler._started = time.monotonic() - 3600
+        scheduler._due = datetime.now() + timedelta(minutes=1)
+        scheduler._check()
+        self.assertFalse(scheduler._input_trackers)
+
+        # when due, the input starts to be tracked and it must be idle from now
+        scheduler._due = datetime.now() - timedelta(seconds=1)
+        scheduler._check()
+        self.assertEqual(scheduler._input_trackers, {scheduler})
+        self.assertEqual(self.runs, [])
+
+        scheduler._last_input -= update.IDLE_TIME
+        with mock.patch.object(update, 'UpdateEpisodes'):
+            scheduler._check()
+        self.assertEqual(len(self.runs), 1)
+
+    def test_input_not_tracked_while_running(self):
+        with mock.patch.object(update, 'UpdateEpisodes'):
+            update.UpdateScheduler._run(self.scheduler, mock.Mock())
+        self.assertFalse(self.scheduler._input_trackers)
+
+    def test_track_input_several(self):
+        self.scheduler.track_input('other')
+        last_input = self.scheduler._last_input
+        self.scheduler.track_input(self.scheduler, False)
+        self.assertEqual(self.scheduler._input_trackers, {'other'})
+
+        # tracked all the time, what was known of the input is still valid
+        self.scheduler.track_input('another')
+        self.assertEqual(self.scheduler._last_input, last_input)
+
+    def test_interactive_after_running(self):
+        self.scheduler.running = True
+        self.scheduler.refresh_now()
+        self.assertEqual(self.runs, [])
+
+        # when the running one finishes, the interactive is done
+        with mock.patch.object(update, 'UpdateEpisodes') as fake_updater:
+            self.scheduler._finished(None, None)
+        self.assertEqual(self.runs, [(fake_updater.return_value, True)])
+
+    def test_next_after_completed(self):
+        self.scheduler._refreshed_before_run = datetime.now() - timedelta(days=30)
+        self.scheduler._finished(None, None)
+        last_refresh = config['autorefresh_last_time']
+        self.assertGreaterEqual(self.scheduler._due, last_refresh + update.REFRESH_PERIOD_NO_AUTO)
+
+    def test_retry_after_failure(self):
+        config['autorefresh_last_time'] = datetime.now() - timedelta(days=30)
+        self.scheduler._refreshed_before_run = config['autorefresh_last_time']
+        delays = []
+        for _ in range(10):
+            before = datetime.now()
+            self.scheduler._finished(defer.DeferredException(ValueError("boom")), None)
+            delays.append(self.scheduler._due - before)
+
+        # not right away, and each time later (but not too much)
+        self.assertAlmostEqual(delays[0].total_seconds(),
+                               update.RETRY_DELAY.total_seconds(), delta=1)
+        self.assertAlmostEqual(delays[1].total_seconds(),
+                               2 * update.RETRY_DELAY.total_seconds(), delta=1)
+        self.assertAlmostEqual(delays[-1].total_seconds(),
+                               update.MAX_RETRY_DELAY.total_seconds(), delta=1)
+        self.assertIsNone(self._check())
+
+        # once completed, the normal period again
+        config['autorefresh_last_time'] = datetime.now()
+        self.scheduler._finished(None, None)
+        self.assertIsNone(self.scheduler._retry_delay)
+        self.assertGreater(self.scheduler._due, datetime.now() + update.MAX_RETRY_DELAY)
+
+    def test_retry_after_not_completed(self):
+        # e.g. the backends list could not be downloaded: no error, but nothing done
+        config['autorefresh_last_time'] = datetime.now() - timedelta(days=30)
+        self.scheduler._refreshed_before_run = config['autorefresh_last_time']
+        self.scheduler._finished(None, None)
+        self.assertGreater(self.scheduler._due, datetime.now())
+        self.assertLessEqual(self.scheduler._due, datetime.now() + update.RETRY_DELAY)
+
+    def test_retry_never_refreshed(self):
+        config['autorefresh_last_time'] = None
+        self.scheduler._finished(None, None)
+        self.assertGreater(self.scheduler._due, datetime.now())
+        self.assertLessEqual(self.scheduler._due, datetime.now() + update.RETRY_DELAY)
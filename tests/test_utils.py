@@ -0,0 +1,114 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the utilities."""
+
+import unittest
+
+import defer
+
+from encuentro.utils import LRUCache, Limiter, settle
+
+from tests.test_network import use_real_deferreds
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """Tests for the LRU cache."""
+
+    def test_get(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_forget_least_recently_used(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        cache.get('a')
+        cache['d'] = 4
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn('b', cache)
+        for key in 'acd':
+            self.assertIn(key, cache)
+
+    def test_replace(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a'] = 3
+        cache['c'] = 4
+        self.assertEqual(cache.get('a'), 3)
+        self.assertNotIn('b', cache)
+
+
+class LimiterTestCase(unittest.TestCase):
+    """Tests for the limiter of concurrent functions."""
+
+    def setUp(self):
+        use_real_deferreds(self)
+        self.started = []
+
+    def _func(self, name):
+        """Something that finishes when told."""
+        deferred = defer.Deferred()
+        self.started.append((name, deferred))
+        return deferred
+
+    def test_bounded(self):
+        limiter = Limiter(2)
+        results = []
+        for name in "abcd":
+            limiter.run(self._func, name).add_callback(results.append)
+        self.assertEqual([name for name, _ in self.started], ["a", "b"])
+
+        self.started[1][1].callback("B")
+        self.assertEqual([name for name, _ in self.started], ["a", "b", "c"])
+        self.assertEqual(limiter.running, 2)
+        self.assertEqual(results, ["B"])
+
+        self.started[0][1].callback("A")
+        self.started[2][1].callback("C")
+        self.assertEqual([name for name, _ in self.started], ["a", "b", "c", "d"])
+        self.started[3][1].callback("D")
+        self.assertEqual(limiter.running, 0)
+        self.assertEqual(results, ["B", "A", "C", "D"])
+
+    def test_error_passed_and_continues(self):
+        limiter = Limiter(1)
+        results = []
+        settle(limiter.run(self._func, "a")).add_callback(results.append)
+        settle(limiter.run(self._func, "b")).add_callback(results.append)
+
+        error = ValueError("boom")
+        self.started[0][1].errback(error)
+        self.assertEqual(results, [(False, error)])
+        self.started[1][1].callback("ok")
+        self.assertEqual(results, [(False, error), (True, "ok")])
+
+    def test_function_raising(self):
+        def broken():
+            raise ValueError("boom")
+
+        results = []
+        settle(Limiter(1).run(broken)).add_callback(results.append)
+        ((ok, error),) = results
+        self.assertFalse(ok)
+        self.assertIsInstance(error, ValueError)
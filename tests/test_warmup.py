@@ -0,0 +1,201 @@
+# Copyright 2020 Facundo Batista
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 3, as published
+# by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# For further info, check  https://launchpad.net/encuentro
+
+"""Tests for the images cache warm up."""
+
+import unittest
+
+from unittest import mock
+
+from encuentro import data, warmup
+from encuentro.config import config
+
+from tests.test_httpclient import get_app
+from tests.test_image import FakeDeferred
+
+
+def _episode(url, channel="channel", section="section", image_data=None):
+    """Build an episode with the image in the URL."""
+    return data.EpisodeData(
+        channel=channel, section=section, title="title", duration=10,
+        description="description", episode_id="epid", url="http://example.com/video",
+        image_url=url, image_data=image_data)
+
+
+class FakeGetter:
+    """An images getter whose downloads finish only when told."""
+
+    def __init__(self, cached=()):
+        self.cached = set(cached)
+        self.downloads = {}
+
+    def is_cached(self, url):
+        return url in self.cached
+
+    def download(self, url):
+        deferred = FakeDeferred()
+        self.downloads[url] = deferred
+        return deferred
+
+
+class FakeScheduler:
+    """Just what the background warm up needs from the updates scheduler."""
+
+    running = False
+    idle = True
+
+    def __init__(self):
+        self.trackers = set()
+
+    def is_idle(self):
+        return self.idle
+
+    def track_input(self, tracker, wanted=True):
+        if wanted:
+            self.trackers.add(tracker)
+        else:
+            self.trackers.discard(tracker)
+
+
+class _ConfigTestCase(unittest.TestCase):
+    """Leave the failed tries in the config as they were."""
+
+    def setUp(self):
+        system = config.setdefault(config.SYSTEM, {})
+        previous = system.pop(warmup.FAILED_TRIES, None)
+
+        def restore():
+            system.pop(warmup.FAILED_TRIES, None)
+            if previous is not None:
+                system[warmup.FAILED_TRIES] = previous
+        self.addCleanup(restore)
+
+        patcher = mock.patch.object(warmup.defer, 'Deferred', FakeDeferred)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class SelectURLsTestCase(_ConfigTestCase):
+    """Tests for the choosing of the images to get."""
+
+    def test_missing_only(self):
+        episodes = [_episode("u1"), _episode("u2"), _episode(None), _episode(""),
+                    _episode("u3", image_data="aGVsbG8="), _episode("u1")]
+        getter = FakeGetter(cached=["u2"])
+        self.assertEqual(warmup.select_urls(episodes, getter), ["u1"])
+
+    def test_channel_and_section(self):
+        episodes = [_episode("u1", channel="c1", section="s1"),
+                    _episode("u2", channel="c1", section="s2"),
+                    _episode("u3", channel="c2", section="s1")]
+        getter = FakeGetter()
+        self.assertEqual(warmup.select_urls(episodes, getter, channel="c1"), ["u1", "u2"])
+        self.assertEqual(warmup.select_urls(episodes, getter, section="s1"), ["u1", "u3"])
+        self.assertEqual(warmup.select_urls(episodes, getter, "c1", "s1"), ["u1"])
+
+    def test_failed_too_much(self):
+        config[config.SYSTEM][warmup.FAILED_TRIES] = {
+            "u1": warmup.MAX_TRIES, "u2": warmup.MAX_TRIES - 1}
+        episodes = [_episode("u1"), _episode("u2")]
+        self.assertEqual(warmup.select_urls(episodes, FakeGetter()), ["u2"])
+
+
+class WarmerTestCase(_ConfigTestCase):
+    """Tests for the images downloader."""
+
+    def _warmer(self, urls, concurrency=2, rate=None):
+        self.getter = FakeGetter()
+        self.done = []
+        warmer = warmup.Warmer(self.getter, urls, concurrency=concurrency, rate=rate)
+        warmer.start().add_callback(self.done.append)
+        return warmer
+
+    def test_bounded(self):
+        self._warmer(["u1", "u2", "u3"])
+        self.assertEqual(list(self.getter.downloads), ["u1", "u2"])
+
+        self.getter.downloads["u2"].callback("path")
+        self.assertEqual(list(self.getter.downloads), ["u1", "u2", "u3"])
+
+    def test_finished(self):
+        warmer = self._warmer(["u1", "u2"])
+        self.getter.downloads["u1"].callback("path")
+        self.getter.downloads["u2"].errback(ValueError("boom"))
+
+        self.assertEqual(len(self.done), 1)
+        summary = self.done[0]
+        self.assertEqual(summary['total'], 2)
+        self.assertEqual(summary['downloaded'], 1)
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(summary['remaining'], 0)
+        self.assertEqual(warmer.summary()['downloaded'], 1)
+
+    def test_nothing_to_do(self):
+        self._warmer([])
+        self.assertEqual(self.done[0]['total'], 0)
+
+    def test_failed_tries_remembered(self):
+        config[config.SYSTEM][warmup.FAILED_TRIES] = {"u1": 1, "u2": 1}
+        self._warmer(["u1", "u2"])
+        self.getter.downloads["u1"].errback(ValueError("boom"))
+        self.getter.downloads["u2"].callback("path")
+        self.assertEqual(config[config.SYSTEM][warmup.FAILED_TRIES], {"u1": 2})
+
+    def test_pause_resume(self):
+        warmer = self._warmer(["u1", "u2", "u3"], concurrency=1)
+        warmer.pause()
+        self.getter.downloads["u1"].callback("path")
+        self.assertEqual(list(self.getter.downloads), ["u1"])
+
+        warmer.resume()
+        self.assertEqual(list(self.getter.downloads), ["u1", "u2"])
+
+    def test_rate_limited(self):
+        with mock.patch.object(warmup, 'QTimer') as fake_timer:
+            warmer = self._warmer(["u1", "u2"], rate=1)
+        self.assertEqual(list(self.getter.downloads), ["u1"])
+        self.assertEqual(fake_timer.singleShot.call_count, 1)
+
+        # when the delay ends, the next one is started
+        warmer._last_start -= 1
+        warmer._delay_ended()
+        self.assertEqual(list(self.getter.downloads), ["u1", "u2"])
+
+    def test_idle_tracks_input_only_if_work(self):
+        get_app()
+        scheduler = FakeScheduler()
+        getter = FakeGetter()
+        programs_data = {"ep1": _episode("u1")}
+        idle_warmup = warmup.IdleWarmup(getter, programs_data, scheduler)
+        self.addCleanup(idle_warmup.stop)
+
+        scheduler.idle = False
+        idle_warmup._check()
+        self.assertEqual(scheduler.trackers, {idle_warmup})
+        self.assertEqual(getter.downloads, {})
+
+        scheduler.idle = True
+        idle_warmup._check()
+        getter.downloads["u1"].callback("path")
+        idle_warmup._check()
+        self.assertEqual(scheduler.trackers, set())
+
+    def test_format_summary(self):
+        summary = dict(total=10, downloaded=5, failed=1, remaining=4, elapsed=2.0, rate=3.0)
+        self.assertEqual(
+            warmup.format_summary(summary),
+            "Imágenes: 5 descargadas, 1 con problemas, 4 pendientes (de 10); 2.0 seg, "
+            "3.00 imágenes/seg")